@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+
+# -*- encoding: utf-8 -*-
+"""
+measures the time needed to compute the job_id of requests with growing scw_list and selected_catalog
+"""
+
+import json
+import time
+import argparse
+
+from cdci_data_analysis.analysis.hash import make_hash, job_id_hash_modes
+
+
+def make_request_parameters(size):
+    return {
+        'instrument': 'isgri',
+        'product_type': 'isgri_image',
+        'RA': 83.63,
+        'DEC': 22.01,
+        'T1': '2003-03-15T23:27:40.0',
+        'T2': '2003-03-16T00:03:15.0',
+        'scw_list': [f'{i:08d}0010.001' for i in range(size)],
+        'selected_catalog': json.dumps({
+            'cat_frame': 'fk5',
+            'cat_coord_units': 'deg',
+            'cat_column_names': ['meta_ID', 'src_names', 'significance', 'ra', 'dec'],
+            'cat_column_list': [list(range(size)),
+                                [f'source {i}' for i in range(size)],
+                                [i * 0.1 for i in range(size)],
+                                [83.63 + i * 1e-3 for i in range(size)],
+                                [22.01 + i * 1e-3 for i in range(size)]],
+        }),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='number of entries in scw_list and selected_catalog')
+    parser.add_argument('-repeat', type=int, default=5, help='number of job_id computations for each size')
+
+    args = parser.parse_args(argv)
+
+    print(f"{'size':>8} " + " ".join(f"{hash_mode + ' [ms]':>16}" for hash_mode in job_id_hash_modes))
+
+    for size in args.sizes:
+        par_dic = make_request_parameters(size)
+
+        timings = []
+        for hash_mode in job_id_hash_modes:
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                make_hash(par_dic, hash_mode=hash_mode)
+            timings.append((time.perf_counter() - t0) / args.repeat * 1000)
+
+        print(f"{size:>8d} " + " ".join(f"{timing:16.3f}" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
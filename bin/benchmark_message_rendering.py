@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+
+# -*- encoding: utf-8 -*-
+"""
+measures the throughput of the rendering of the job emails and matrix messages, with and without the caches
+of the templates and of the formatted api code
+"""
+
+import time
+import types
+import logging
+import argparse
+import tempfile
+
+from cdci_data_analysis.analysis import email_helper, matrix_helper
+
+logger = logging.getLogger(__name__)
+
+
+def make_config():
+    return types.SimpleNamespace(products_url='https://www.astro.unige.ch/mmoda',
+                                 site_name='University of Geneva',
+                                 contact_email_address='contact@odahub.io',
+                                 manual_reference='possibly-non-site-specific-link')
+
+
+def make_api_code(n_scw):
+    scw_list = ",".join(f'{i:08d}0010.001' for i in range(n_scw))
+    return ("from oda_api.api import DispatcherAPI\n"
+            "disp=DispatcherAPI(url='https://www.astro.unige.ch/mmoda/dispatch-data', instrument='mock')\n"
+            "par_dict={\"instrument\": \"isgri\", \"product_type\": \"isgri_image\", \"E1_keV\": \"20\", \"E2_keV\": \"40\", "
+            f"\"scw_list\": \"{scw_list}\", \"token\": \"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9\"}}\n"
+            "data_collection = disp.get_product(**par_dict)\n")
+
+
+def render(config, api_code, scratch_dir, job_index):
+    kwargs = dict(decoded_token={'email': 'mtm@mtmco.net', 'name': 'mmeharga', 'sub': 'mtm@mtmco.net',
+                                 'mxroomid': '!room:matrix.org', 'exp': time.time() + 3600},
+                  token='token',
+                  job_id=f'{job_index:016x}',
+                  session_id='01234567890ABCDE',
+                  status='done',
+                  instrument='isgri',
+                  product_type='isgri_image',
+                  time_request=time.time() - 3600,
+                  request_url='https://www.astro.unige.ch/mmoda/?instrument=isgri',
+                  api_code=api_code,
+                  scratch_dir=scratch_dir)
+
+    email_helper.render_job_email(config, logger, **kwargs)
+    matrix_helper.render_job_message(config, logger, **kwargs)
+
+
+def clear_caches():
+    email_helper.get_templates_environment.cache_clear()
+    email_helper._wrap_python_code.cache_clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n-scw', type=int, nargs='+', default=[1, 10, 100],
+                        help='number of science windows in the api code')
+    parser.add_argument('-repeat', type=int, default=20, help='number of jobs for which the messages are rendered')
+
+    args = parser.parse_args(argv)
+
+    config = make_config()
+
+    print(f"{'n_scw':>8} {'uncached [jobs/s]':>18} {'cached [jobs/s]':>18}")
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        for n_scw in args.n_scw:
+            api_code = make_api_code(n_scw)
+
+            t0 = time.perf_counter()
+            for i in range(args.repeat):
+                clear_caches()
+                render(config, api_code, scratch_dir, i)
+            uncached_throughput = args.repeat / (time.perf_counter() - t0)
+
+            render(config, api_code, scratch_dir, 0)
+            t0 = time.perf_counter()
+            for i in range(args.repeat):
+                render(config, api_code, scratch_dir, i)
+            cached_throughput = args.repeat / (time.perf_counter() - t0)
+
+            print(f"{n_scw:>8d} {uncached_throughput:18.1f} {cached_throughput:18.1f}")
+
+
+if __name__ == "__main__":
+    main()
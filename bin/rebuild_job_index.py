@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+
+# -*- encoding: utf-8 -*-
+"""
+rebuilds the index of the job scratch directories from the content of the dispatcher working directory
+"""
+
+import os
+import argparse
+
+from cdci_data_analysis.app_logging import app_logging
+from cdci_data_analysis.analysis.job_index import JobIndex
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-work_dir', type=str, default='.', help='dispatcher working directory, containing the scratch directories')
+    parser.add_argument('-index_path', type=str, default=None, help='path of the index, relative to the working directory, by default in the temporary directory')
+    parser.add_argument('-debug', action='store_true', help='sets global logger debug')
+
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        app_logging.level_by_logger = {"": "debug"}
+    else:
+        app_logging.level_by_logger = {"": "info"}
+    app_logging.setup()
+
+    os.chdir(args.work_dir)
+
+    job_index = JobIndex(index_path=args.index_path)
+    n_entries = job_index.rebuild_from_disk()
+
+    print(f"indexed {n_entries} scratch directories in {os.path.abspath(job_index.index_path)}")
+
+
+if __name__ == "__main__":
+    main()
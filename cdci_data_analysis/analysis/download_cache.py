@@ -0,0 +1,135 @@
+"""
+Size-bounded cache of the archives built for product downloads.
+
+Archives are stored under a name derived from what determines their content
+(job, files with their size and modification time, archive options), so that
+repeated downloads of the same products are sent from the cache without being
+compressed again. When the total size of the cache exceeds its limit, the least
+recently used archives are removed.
+
+Hits do not write to the archives (the cache directory may be on NFS): the time of
+the last use is the access time set by reading the archive, when the file system
+records it. On file systems mounted with relatime it is only updated once a day, and
+with noatime never, in which case the oldest archives are removed first.
+
+The cache directory can be shared by several dispatcher processes: archives are
+written to a temporary file and renamed once complete.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import typing
+
+from .io_helper import set_default_file_mode
+
+logger = logging.getLogger(__name__)
+
+
+def store_temporary(stream) -> str:
+    """
+    writes the chunks of stream to a temporary file, and returns its path; used when the cache is disabled,
+    the caller removes the file once sent
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='dispatcher-download-')
+    try:
+        with os.fdopen(fd, 'wb') as archive_file:
+            for chunk in stream:
+                archive_file.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path
+
+
+class DownloadCache:
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.cache_dir} ({self.max_size_bytes} bytes) ]"
+
+    @property
+    def enabled(self):
+        return self.max_size_bytes is not None and self.max_size_bytes > 0
+
+    @staticmethod
+    def archive_key(job_id, file_list, file_name, return_archive) -> str:
+        files_state = []
+        for file_path in sorted(file_list):
+            file_stat = os.stat(file_path)
+            files_state.append([file_path, file_stat.st_size, file_stat.st_mtime_ns])
+
+        key_content = json.dumps([job_id, files_state, file_name, return_archive])
+        return hashlib.sha256(key_content.encode()).hexdigest()
+
+    def archive_path(self, key) -> str:
+        return os.path.abspath(os.path.join(self.cache_dir, key))
+
+    def get(self, key) -> typing.Union[str, None]:
+        """
+        returns the path of the cached archive, if any
+        """
+        archive_path = self.archive_path(key)
+        if not os.path.isfile(archive_path):
+            return None
+
+        logger.info("download archive %s found in the cache", key)
+        return archive_path
+
+    def store_stream(self, key, stream) -> typing.Iterator[bytes]:
+        """
+        passes through the chunks of stream, while storing them in the cache; the archive is added to the cache
+        only if the stream is entirely consumed
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=self.cache_dir)
+        completed = False
+        try:
+            with os.fdopen(fd, 'wb') as archive_file:
+                for chunk in stream:
+                    archive_file.write(chunk)
+                    yield chunk
+            set_default_file_mode(tmp_path)
+            os.replace(tmp_path, self.archive_path(key))
+            completed = True
+            logger.info("download archive %s added to the cache", key)
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict()
+
+    def store(self, key, stream) -> str:
+        for _ in self.store_stream(key, stream):
+            pass
+        return self.archive_path(key)
+
+    def evict(self):
+        archives = []
+        total_size = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.tmp_') or not entry.is_file():
+                    continue
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                last_used = max(entry_stat.st_atime, entry_stat.st_mtime)
+                archives.append((last_used, entry_stat.st_size, entry.path))
+                total_size += entry_stat.st_size
+
+        for last_used, size, path in sorted(archives):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+                logger.info("download archive %s evicted from the cache", os.path.basename(path))
+            except FileNotFoundError:
+                pass
+            total_size -= size
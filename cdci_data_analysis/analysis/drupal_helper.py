@@ -9,15 +9,18 @@ import requests
 import base64
 import copy
 import uuid
-import glob
 import re
+import threading
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, CancelledError, as_completed
 
 from typing import Optional, Tuple, Dict
 
 from ..flask_app.sentry import sentry
+from ..flask_app.metrics import metrics
 
 from dateutil import parser, tz
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum, auto
 from astropy.coordinates import SkyCoord, Angle
 from astropy import units as u
@@ -29,6 +32,9 @@ from ..analysis.exceptions import RequestNotUnderstood, InternalError, RequestNo
 from ..flask_app.templates import body_article_product_gallery
 from ..app_logging import app_logging
 from ..analysis.time_helper import format_time
+from ..analysis.job_index import job_index
+from ..analysis.http_client import HTTPClient
+from ..analysis.revnum_cache import RevnumCache
 
 default_algorithm = 'HS256'
 
@@ -36,9 +42,99 @@ logger = app_logging.getLogger('drupal_helper')
 
 n_max_tries = 10
 retry_sleep_s = .5
+retry_max_sleep_s = 4
+# (connect, read) timeouts of the requests to the product gallery
+request_timeout_s = (10, 300)
 
+# connections to the product gallery, and to the name resolvers, are kept open by each process,
+# and reused by the following requests
+gallery_http_client = HTTPClient('product_gallery', timeout=request_timeout_s)
+name_resolver_http_client = HTTPClient('name_resolver', timeout=request_timeout_s)
+timesystem_http_client = HTTPClient('timesystem', timeout=request_timeout_s)
+
+revnum_cache = RevnumCache()
+
+# updated by the threads uploading the files concurrently
 total_n_successful_post_requests = 0
 total_n_post_request_retries = 0
+post_request_counters_lock = threading.Lock()
+
+
+class GalleryLookupCache:
+    """
+    cache of the results of the read-only lookups to the product gallery (taxonomy terms, revolutions, astrophysical
+    entities, user ids), which change rarely; the entries are grouped, so that those affected by the content posted
+    by the dispatcher can be invalidated
+    """
+    def __init__(self, ttl_s=300, max_entries=1024):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {len(self._entries)} entries, ttl {self.ttl_s} s ]"
+
+    def configure(self, ttl_s, max_entries):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.ttl_s > 0 and self.max_entries > 0
+
+    def get_or_compute(self, group, key, compute, cache_if=None):
+        """
+        returns a copy of the cached value for key, calling compute if there is none or it expired;
+        the value is cached only if cache_if(value) is True
+        """
+        if not self.enabled:
+            return compute()
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((group, key))
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end((group, key))
+                self.hits[group] += 1
+                return copy.deepcopy(entry[1])
+            self.misses[group] += 1
+
+        value = compute()
+
+        if cache_if is None or cache_if(value):
+            with self._lock:
+                self._entries[(group, key)] = (now + self.ttl_s, copy.deepcopy(value))
+                self._entries.move_to_end((group, key))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, *groups):
+        with self._lock:
+            for entry_key in [entry_key for entry_key in self._entries if entry_key[0] in groups]:
+                del self._entries[entry_key]
+        logger.info("product gallery lookups %s removed from the cache", groups)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            groups = set(self.hits) | set(self.misses) | {entry_key[0] for entry_key in self._entries}
+            return {group: dict(hits=self.hits[group],
+                                misses=self.misses[group],
+                                entries=sum(1 for entry_key in self._entries if entry_key[0] == group))
+                    for group in groups}
+
+
+gallery_lookup_cache = GalleryLookupCache()
 
 
 class ContentType(Enum):
@@ -62,6 +158,18 @@ def analyze_drupal_output(drupal_output, operation_performed=None):
         return drupal_output.text
 
 
+def cached_drupal_lookup(cache_group, url, headers, operation_performed, sentry_dsn=None, cache_if=None):
+    """
+    returns the output of a get request to the product gallery, from the gallery_lookup_cache if possible
+    """
+    return gallery_lookup_cache.get_or_compute(
+        cache_group,
+        url,
+        lambda: analyze_drupal_output(execute_drupal_request(url, headers=headers, sentry_dsn=sentry_dsn),
+                                      operation_performed=operation_performed),
+        cache_if=cache_if)
+
+
 def get_list_terms(decoded_token, group, parent=None, disp_conf=None, sentry_dsn=None):
     gallery_secret_key = disp_conf.product_gallery_secret_key
     product_gallery_url = disp_conf.product_gallery_url
@@ -76,30 +184,30 @@ def get_list_terms(decoded_token, group, parent=None, disp_conf=None, sentry_dsn
     headers = get_drupal_request_headers(gallery_jwt_token)
     output_list = []
     output_request = None
-    log_res = None
+    request_url = None
+    cache_group = 'terms'
 
     if group is not None and str.lower(group) == 'instruments':
         if os.environ.get('DISPATCHER_DEBUG_MODE', 'no') == 'yes':
             parent = 'all'
         else:
             parent = 'production'
-        log_res = execute_drupal_request(f"{product_gallery_url}/taxonomy/term_vocabulary_parent/instruments/{parent}?_format=hal_json",
-                                         headers=headers, sentry_dsn=sentry_dsn)
+        request_url = f"{product_gallery_url}/taxonomy/term_vocabulary_parent/instruments/{parent}?_format=hal_json"
 
     elif group is not None and str.lower(group) == 'products':
         if parent is None or parent == '':
             parent = 'all'
-        log_res = execute_drupal_request(f"{product_gallery_url}/taxonomy/term_vocabulary_parent/products/{parent}?_format=hal_json",
-                                         headers=headers, sentry_dsn=sentry_dsn)
+        request_url = f"{product_gallery_url}/taxonomy/term_vocabulary_parent/products/{parent}?_format=hal_json"
 
     elif group is not None and str.lower(group) == 'sources':
-        log_res = execute_drupal_request(f"{product_gallery_url}/astro_entities/source/all?_format=hal_json",
-                                         headers=headers, sentry_dsn=sentry_dsn)
+        request_url = f"{product_gallery_url}/astro_entities/source/all?_format=hal_json"
+        cache_group = 'astro_entities'
 
-    if log_res is not None:
-        output_request = analyze_drupal_output(log_res,
-                                               operation_performed=f"retrieving the list of available {group} "
-                                                                   "from the product gallery")
+    if request_url is not None:
+        output_request = cached_drupal_lookup(cache_group, request_url, headers,
+                                              operation_performed=f"retrieving the list of available {group} "
+                                                                  "from the product gallery",
+                                              sentry_dsn=sentry_dsn)
 
     if output_request is not None and type(output_request) == list and len(output_request) >= 0:
         for output in output_request:
@@ -128,14 +236,15 @@ def get_parents_term(decoded_token, term, group=None, disp_conf=None, sentry_dsn
 
     if group is None or group == '':
         group = 'all'
-    log_res = execute_drupal_request(f"{product_gallery_url}/taxonomy/product_term_parent/{term}/{group}?_format=hal_json",
-                                     headers=headers, sentry_dsn=sentry_dsn)
 
-    if log_res is not None:
-        msg = f"retrieving the list parents for the term {term}, "
-        if group != '':
-            msg += f"from the vocabulary {group}"
-        output_request = analyze_drupal_output(log_res, operation_performed=(msg + ", from the product gallery"))
+    msg = f"retrieving the list parents for the term {term}, "
+    if group != '':
+        msg += f"from the vocabulary {group}"
+    output_request = cached_drupal_lookup('terms',
+                                          f"{product_gallery_url}/taxonomy/product_term_parent/{term}/{group}?_format=hal_json",
+                                          headers,
+                                          operation_performed=(msg + ", from the product gallery"),
+                                          sentry_dsn=sentry_dsn)
 
     if output_request is not None and type(output_request) == list and len(output_request) >= 0:
         for output in output_request:
@@ -164,9 +273,9 @@ def execute_drupal_request(url,
                 if params is None:
                     params = {}
                 params['_format'] = request_format
-                res = requests.get(url,
-                                   params={**params},
-                                   headers=headers)
+                res = gallery_http_client.request('get', url,
+                                                  params={**params},
+                                                  headers=headers)
 
             elif method == 'post':
                 if data is None:
@@ -174,35 +283,35 @@ def execute_drupal_request(url,
                 if params is None:
                     params = {}
                 params['_format'] = request_format
-                res = requests.post(url,
-                                    params={**params},
-                                    data=data,
-                                    files=files,
-                                    headers=headers
-                                    )
+                res = gallery_http_client.request('post', url,
+                                                  params={**params},
+                                                  data=data,
+                                                  files=files,
+                                                  headers=headers
+                                                  )
             elif method == 'patch':
                 if data is None:
                     data = {}
                 if params is None:
                     params = {}
                 params['_format'] = request_format
-                res = requests.patch(url,
-                                     params={**params},
-                                     data=data,
-                                     files=files,
-                                     headers=headers
-                                     )
+                res = gallery_http_client.request('patch', url,
+                                                  params={**params},
+                                                  data=data,
+                                                  files=files,
+                                                  headers=headers
+                                                  )
             elif method == 'delete':
                 if data is None:
                     data = {}
                 if params is None:
                     params = {}
                 params['_format'] = request_format
-                res = requests.delete(url,
-                                      params={**params},
-                                      data=data,
-                                      headers=headers
-                                      )
+                res = gallery_http_client.request('delete', url,
+                                                  params={**params},
+                                                  data=data,
+                                                  headers=headers
+                                                  )
             else:
                 raise NotImplementedError
             if res.status_code == 403:
@@ -238,7 +347,9 @@ def execute_drupal_request(url,
                                     status_code=500,
                                     payload={'drupal_helper_error_message': drupal_helper_error_message})
             else:
-                total_n_successful_post_requests += 1
+                with post_request_counters_lock:
+                    total_n_successful_post_requests += 1
+                metrics.inc('dispatcher_product_gallery_requests_total', dict(method=method, outcome='success'))
 
             return res
 
@@ -248,11 +359,14 @@ def execute_drupal_request(url,
                 requests.exceptions.Timeout) as e:
 
             n_tries_left -= 1
-            total_n_post_request_retries += 1
-            if total_n_successful_post_requests == 0:
-                average_retries_request = 0
-            else:
-                average_retries_request = total_n_post_request_retries/total_n_successful_post_requests
+            with post_request_counters_lock:
+                total_n_post_request_retries += 1
+                if total_n_successful_post_requests == 0:
+                    average_retries_request = 0
+                else:
+                    average_retries_request = total_n_post_request_retries/total_n_successful_post_requests
+            gallery_http_client.record_retry(method, url, error=repr(e))
+            metrics.inc('dispatcher_product_gallery_requests_total', dict(method=method, outcome='retry'))
 
             if n_tries_left > 0:
                 if n_max_tries - n_tries_left > average_retries_request:
@@ -262,16 +376,19 @@ def execute_drupal_request(url,
                     logger.warning(f"there seems to be some problem in completing the request to the url {url} of the product gallery,"
                                    " this is possibly temporary and we will retry the same request shortly")
 
+                # the delay doubles at each retry, to give the product gallery time to recover
+                sleep_s = min(retry_sleep_s * 2 ** (n_max_tries - n_tries_left - 1), retry_max_sleep_s)
                 logger.debug(f"{e} exception during a request to the url {url} of the product gallery\n"
-                             f"{n_tries_left} tries left, sleeping {retry_sleep_s} seconds until retry\n"
+                             f"{n_tries_left} tries left, sleeping {sleep_s} seconds until retry\n"
                              f"average retries per request since dispatcher start: "
                              f"{average_retries_request:.2f}")
-                time.sleep(retry_sleep_s)
+                time.sleep(sleep_s)
             else:
                 logger.warning(f"an issue occurred when performing a request to the product gallery, "
                                f"this prevented us to complete the request to the url: {url} \n"
                                f"this is likely to be a connection related problem, we are investigating and "
                                f"try to solve it as soon as possible")
+                metrics.inc('dispatcher_product_gallery_requests_total', dict(method=method, outcome='failure'))
                 sentry.capture_message(f'exception when performing a request to the product gallery: {repr(e)}')                
                 raise InternalError('issue when performing a request to the product gallery',
                                     status_code=500,
@@ -306,11 +423,13 @@ def get_user_id(product_gallery_url, user_email, sentry_dsn=None) -> Optional[st
     user_id = None
     headers = get_drupal_request_headers()
 
-    # get the user id
-    log_res = execute_drupal_request(f"{product_gallery_url}/users/{user_email}",
-                                     headers=headers,
-                                     sentry_dsn=sentry_dsn)
-    output_get = analyze_drupal_output(log_res, operation_performed="retrieving the user id")
+    # get the user id; not found users are not cached, since they might register at any time
+    output_get = cached_drupal_lookup('users',
+                                      f"{product_gallery_url}/users/{user_email}",
+                                      headers,
+                                      operation_performed="retrieving the user id",
+                                      sentry_dsn=sentry_dsn,
+                                      cache_if=lambda output: isinstance(output, list) and len(output) == 1)
     if isinstance(output_get, list) and len(output_get) == 1:
         user_id = output_get[0]['uid']
 
@@ -329,6 +448,8 @@ def delete_node_gallery(product_gallery_url, node_to_delete_id, gallery_jwt_toke
 
     logger.info(f"node with id {node_to_delete_id} successfully deleted from the product gallery")
     output_post = analyze_drupal_output(log_res, operation_performed="deleting a node from the product gallery")
+    # the node might be any content, among which those listed by the lookups of astrophysical entities and revolutions
+    gallery_lookup_cache.invalidate('astro_entities', 'revolutions')
     return output_post
 
 
@@ -378,6 +499,53 @@ def post_file_to_gallery(product_gallery_url, file, gallery_jwt_token, file_type
     output_post = analyze_drupal_output(log_res, operation_performed="posting a picture to the product gallery")
     return output_post
 
+
+def post_files_to_gallery(product_gallery_url, files, gallery_jwt_token, max_workers=4, sentry_dsn=None) -> dict:
+    """
+    uploads the files concurrently, with at most max_workers uploads at a time, and returns the fid of each of them,
+    in the order of files; if any of the uploads fails, the uploads not started yet are cancelled,
+    and the files already uploaded are deleted
+    """
+    file_names = list(files)
+    if len(file_names) == 0:
+        return {}
+
+    def upload_file(file_name):
+        output_file_post = post_file_to_gallery(product_gallery_url=product_gallery_url,
+                                                file_type="image" if file_name == 'img' else "document",
+                                                file=files[file_name],
+                                                gallery_jwt_token=gallery_jwt_token,
+                                                sentry_dsn=sentry_dsn)
+        return output_file_post['fid'][0]['value']
+
+    fids = {}
+    upload_errors = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(file_names)))) as executor:
+        upload_futures = {executor.submit(upload_file, file_name): file_name for file_name in file_names}
+        for upload_future in as_completed(upload_futures):
+            file_name = upload_futures[upload_future]
+            try:
+                fids[file_name] = upload_future.result()
+            except CancelledError:
+                logger.info(f"upload of the file {file_name} to the product gallery cancelled")
+            except Exception as e:
+                logger.warning(f"error while uploading the file {file_name} to the product gallery: {repr(e)}")
+                upload_errors.append(e)
+                # those running are completed, and then deleted with the others
+                for other_upload_future in upload_futures:
+                    other_upload_future.cancel()
+
+    if len(upload_errors) > 0:
+        for file_name, fid in fids.items():
+            try:
+                delete_file_gallery(product_gallery_url, fid, gallery_jwt_token, sentry_dsn=sentry_dsn)
+            except Exception as e:
+                logger.warning(f"error while deleting the file {file_name}, with id {fid}, "
+                               f"orphaned in the product gallery: {repr(e)}")
+        raise upload_errors[0]
+
+    return {file_name: fids[file_name] for file_name in file_names}
+
 def delete_content_gallery(decoded_token,
                            disp_conf=None,
                            **kwargs):
@@ -437,34 +605,27 @@ def post_content_to_gallery(decoded_token,
     data_product_id = None
     output_content_post = None
     if files is not None:
-        for f in files:
+        # upload files to drupal
+        fids = post_files_to_gallery(product_gallery_url=product_gallery_url,
+                                     files=files,
+                                     gallery_jwt_token=gallery_jwt_token,
+                                     max_workers=disp_conf.gallery_upload_max_workers,
+                                     sentry_dsn=sentry_dsn)
+        for f, fid in fids.items():
             if f == 'img':
-                img_file_obj = files[f]
-                # upload file to drupal
-                output_img_post = post_file_to_gallery(product_gallery_url=product_gallery_url,
-                                                       file_type="image",
-                                                       file=img_file_obj,
-                                                       gallery_jwt_token=gallery_jwt_token,
-                                                       sentry_dsn=sentry_dsn)
-                img_fid = output_img_post['fid'][0]['value']
-            else:
-                output_file_post = post_file_to_gallery(product_gallery_url=product_gallery_url,
-                                                        file_type="document",
-                                                        file=files[f],
-                                                        gallery_jwt_token=gallery_jwt_token,
-                                                        sentry_dsn=sentry_dsn)
-                if f.startswith('fits_file'):
-                    if fits_file_fid_list is None:
-                        fits_file_fid_list = []
-                    fits_file_fid_list.append(output_file_post['fid'][0]['value'])
-                elif f.startswith('html_file'):
-                    if html_file_fid_list is None:
-                        html_file_fid_list = []
-                    html_file_fid_list.append(output_file_post['fid'][0]['value'])
-                elif f.startswith('yaml_file'):
-                    if yaml_file_fid_list is None:
-                        yaml_file_fid_list = []
-                    yaml_file_fid_list.append(output_file_post['fid'][0]['value'])
+                img_fid = fid
+            elif f.startswith('fits_file'):
+                if fits_file_fid_list is None:
+                    fits_file_fid_list = []
+                fits_file_fid_list.append(fid)
+            elif f.startswith('html_file'):
+                if html_file_fid_list is None:
+                    html_file_fid_list = []
+                html_file_fid_list.append(fid)
+            elif f.startswith('yaml_file'):
+                if yaml_file_fid_list is None:
+                    yaml_file_fid_list = []
+                yaml_file_fid_list.append(fid)
     if content_type == content_type.DATA_PRODUCT:
 
         product_id = par_dic.get('product_id', None)
@@ -706,6 +867,7 @@ def post_astro_entity(product_gallery_url, gallery_jwt_token, astro_entity_name,
                                          sentry_dsn=sentry_dsn)
 
     output_post = analyze_drupal_output(log_res, operation_performed="posting a new astrophysical entity")
+    gallery_lookup_cache.invalidate('astro_entities')
 
     return output_post
 
@@ -780,15 +942,12 @@ def post_observation(product_gallery_url, gallery_jwt_token, converttime_revnum_
         t1_formatted = format_time(t1, tz_to_apply)
         t2_formatted = format_time(t2, tz_to_apply)
 
-        t1_revnum_1 = get_revnum(service_url=converttime_revnum_service_url, time_to_convert=t1_formatted)
-        if t1_revnum_1 is not None and 'revnum' in t1_revnum_1:
-            t1_revnum_1 = t1_revnum_1['revnum']
-        else:
+        revnums = get_revnums(service_url=converttime_revnum_service_url, times_to_convert=[t1_formatted, t2_formatted])
+        t1_revnum_1 = revnums.get(t1_formatted)
+        if t1_revnum_1 is None:
             logger.warning(f'error while retrieving the revolution number from corresponding to the time {t1}')
-        t2_revnum_2 = get_revnum(service_url=converttime_revnum_service_url, time_to_convert=t2_formatted)
-        if t2_revnum_2 is not None and 'revnum' in t2_revnum_2:
-            t2_revnum_2 = t2_revnum_2['revnum']
-        else:
+        t2_revnum_2 = revnums.get(t2_formatted)
+        if t2_revnum_2 is None:
             logger.warning(f'error while retrieving the revolution number from corresponding to the time {t2}')
 
         if t1_revnum_1 is not None and t2_revnum_2 is not None:
@@ -842,6 +1001,7 @@ def post_observation(product_gallery_url, gallery_jwt_token, converttime_revnum_
                                              sentry_dsn=sentry_dsn)
     if log_res is not None:
         output_post = analyze_drupal_output(log_res, operation_performed="posting a new observation")
+        gallery_lookup_cache.invalidate('revolutions')
 
     return output_post
 
@@ -855,11 +1015,11 @@ def get_instrument_product_type_id(product_gallery_url, gallery_jwt_token, produ
     if product_type is not None or instrument is not None:
         # TODO improve this REST endpoint on drupal to accept multiple input terms, and give one result per input
         # get all the taxonomy terms
-        log_res = execute_drupal_request(f"{product_gallery_url}/taxonomy/term_name/all?_format=hal_json",
-                                         headers=headers,
-                                         sentry_dsn=sentry_dsn)
-        output_post = analyze_drupal_output(log_res,
-                                            operation_performed="retrieving the taxonomy terms from the product gallery")
+        output_post = cached_drupal_lookup('terms',
+                                           f"{product_gallery_url}/taxonomy/term_name/all?_format=hal_json",
+                                           headers,
+                                           operation_performed="retrieving the taxonomy terms from the product gallery",
+                                           sentry_dsn=sentry_dsn)
         if type(output_post) == list and len(output_post) > 0:
             for output in output_post:
                 if instrument is not None and output['vid'] == 'Instruments' and output['name'] == instrument:
@@ -875,10 +1035,11 @@ def get_instrument_product_type_id(product_gallery_url, gallery_jwt_token, produ
 def get_all_revolutions(product_gallery_url, gallery_jwt_token, sentry_dsn=None) -> Optional[list]:
     entities = []
     headers = get_drupal_request_headers(gallery_jwt_token)
-    log_res = execute_drupal_request(f"{product_gallery_url}/get_revs",
-                                     headers=headers,
-                                     sentry_dsn=sentry_dsn)
-    output_get = analyze_drupal_output(log_res, operation_performed="retrieving all the revolutions from the product gallery")
+    output_get = cached_drupal_lookup('revolutions',
+                                      f"{product_gallery_url}/get_revs",
+                                      headers,
+                                      operation_performed="retrieving all the revolutions from the product gallery",
+                                      sentry_dsn=sentry_dsn)
     if isinstance(output_get, list) and len(output_get) >= 1:
         entities = list(obj['title'] for obj in output_get)
 
@@ -922,10 +1083,11 @@ def get_data_product_list_by_source_name_with_conditions(product_gallery_url, ga
 def get_all_source_astrophysical_entities(product_gallery_url, gallery_jwt_token, sentry_dsn=None) -> Optional[list]:
     entities = []
     headers = get_drupal_request_headers(gallery_jwt_token)
-    log_res = execute_drupal_request(f"{product_gallery_url}/astro_entities/source/all",
-                                     headers=headers,
-                                     sentry_dsn=sentry_dsn)
-    output_get = analyze_drupal_output(log_res, operation_performed="retrieving the astrophysical entity information")
+    output_get = cached_drupal_lookup('astro_entities',
+                                      f"{product_gallery_url}/astro_entities/source/all",
+                                      headers,
+                                      operation_performed="retrieving the astrophysical entity information",
+                                      sentry_dsn=sentry_dsn)
     if isinstance(output_get, list):
         entities = list({'title': obj['title'], 'ra': obj['field_source_ra'], 'dec': obj['field_source_dec']} for obj in output_get)
 
@@ -1136,6 +1298,7 @@ def post_revolution_processing_log_to_gallery(product_gallery_url, gallery_jwt_t
                                      headers=headers,
                                      sentry_dsn=sentry_dsn)
     output_post = analyze_drupal_output(log_res, operation_performed="posting a new revolution processing log to the gallery")
+    gallery_lookup_cache.invalidate('revolutions')
 
     return output_post
 
@@ -1194,7 +1357,7 @@ def post_data_product_to_gallery(product_gallery_url, gallery_jwt_token, convert
         # in case job_id is passed then it automatically extracts time, instrument and product_type information
         # related to the specific job, and uses them unless provided by the user
 
-        job_id_scratch_dir_list = glob.glob(f'scratch_sid_*_jid_{job_id}*')
+        job_id_scratch_dir_list = job_index.find_scratch_dirs(job_id)
         analysis_parameters_json_content_original = None
 
         if len(job_id_scratch_dir_list) >= 1:
@@ -1448,150 +1611,259 @@ def check_matching_coords(source_1_name, source_1_coord_ra, source_1_coord_dec,
     return False
 
 
-def resolve_name(local_name_resolver_url: str, external_name_resolver_url: str, entities_portal_url: str = None, name: str = None, sentry_dsn=None):
+def resolve_name(local_name_resolver_url: str, external_name_resolver_url: str, entities_portal_url: str = None, name: str = None, sentry_dsn=None,
+                 resolver_cache=None):
     resolved_obj = {}
     if name is not None:
-        quoted_name = urllib.parse.quote(name.strip())
-        local_name_resolver_url_formatted = local_name_resolver_url.format(quoted_name)
-        try:
-            res = requests.get(local_name_resolver_url_formatted)
-            if res.status_code == 200:
-                returned_resolved_obj = res.json()
-                if 'success' in returned_resolved_obj:
+        if resolver_cache is not None:
+            resolved_name, resolved_obj = resolver_cache.get_or_resolve(
+                name,
+                lambda name: query_name_resolvers(local_name_resolver_url=local_name_resolver_url,
+                                                  external_name_resolver_url=external_name_resolver_url,
+                                                  entities_portal_url=entities_portal_url,
+                                                  name=name,
+                                                  sentry_dsn=sentry_dsn))
+            if resolved_name != name:
+                # resolved for a name differing only by case, spaces or underscores
+                if 'name' in resolved_obj:
                     resolved_obj['name'] = name.replace('_', ' ')
-                    if returned_resolved_obj['success']:
-                        logger.info(f"object {name} successfully resolved")
-                        if 'ra' in returned_resolved_obj:
-                            resolved_obj['RA'] = float(returned_resolved_obj['ra'])
-                        if 'dec' in returned_resolved_obj:
-                            resolved_obj['DEC'] = float(returned_resolved_obj['dec'])
-                        if 'object_ids' in returned_resolved_obj:
-                            resolved_obj['object_ids'] = returned_resolved_obj['object_ids']
-                        if 'object_type' in returned_resolved_obj:
-                            resolved_obj['object_type'] = returned_resolved_obj['object_type']
-                        resolved_obj['entity_portal_link'] = entities_portal_url.format(quoted_name)
-                        resolved_obj['message'] = f'{name} successfully resolved'
-                    elif not returned_resolved_obj['success']:
-                        logger.info(f"resolution of the object {name} unsuccessful")
-                        resolved_obj['message'] = f'{name} could not be resolved'
-            else:
-                logger.warning("There seems to be some problem in completing the request for the resolution of the object"
-                               f" \"{name}\" using the local resolver.\n"
-                               f"The request lead to the error {res.text}, "
-                               "this might be due to an error in the url or the service "
-                               "requested is currently not available. The external resolver will be used.")
-                if sentry_dsn is not None:
-                    sentry.capture_message(f'Failed to resolve object "{name}" using the local resolver. '
-                                           f'URL: {local_name_resolver_url_formatted} '
-                                           f'Status Code: {res.status_code} '
-                                           f'Response: {res.text}')
-        except (ConnectionError,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout) as e:
-            logger.warning(f'An exception occurred while trying to resolve the object "{name}" using the local resolver. '
-                           f'using the url: {local_name_resolver_url_formatted}. Exception details: {str(e)}')
-            if sentry_dsn is not None:
-                sentry.capture_message(f'An exception occurred while trying to resolve the object "{name}" using the local resolver. '
-                                       f'URL: {local_name_resolver_url_formatted} '
-                                       f"Exception details: {str(e)}")
-        external_name_resolver_url_formatted = external_name_resolver_url.format(quoted_name)
-        try:
-            res = requests.get(external_name_resolver_url_formatted)
-            if res.status_code == 200:
-                root = ET.fromstring(res.text)
+                if 'entity_portal_link' in resolved_obj:
+                    resolved_obj['entity_portal_link'] = entities_portal_url.format(urllib.parse.quote(name.strip()))
+                if resolved_obj.get('message', '').startswith(resolved_name):
+                    resolved_obj['message'] = name + resolved_obj['message'][len(resolved_name):]
+        else:
+            resolved_obj, _ = query_name_resolvers(local_name_resolver_url=local_name_resolver_url,
+                                                   external_name_resolver_url=external_name_resolver_url,
+                                                   entities_portal_url=entities_portal_url,
+                                                   name=name,
+                                                   sentry_dsn=sentry_dsn)
+    return resolved_obj
+
+
+def query_name_resolvers(local_name_resolver_url: str, external_name_resolver_url: str, entities_portal_url: str, name: str, sentry_dsn=None):
+    """
+    queries the local and the external resolvers concurrently, the information from the external one taking precedence;
+    returns the resolved object, and True if the name was resolved, False if it was not found, or None if no
+    resolver could answer or the object information is incomplete
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        local_future = executor.submit(query_local_name_resolver, local_name_resolver_url, entities_portal_url, name,
+                                       sentry_dsn=sentry_dsn)
+        external_future = executor.submit(query_external_name_resolver, external_name_resolver_url, entities_portal_url, name,
+                                          sentry_dsn=sentry_dsn)
+        local_resolved_obj, local_answered = local_future.result()
+        external_resolved_obj, external_answered = external_future.result()
+
+    resolved_obj = {**local_resolved_obj, **external_resolved_obj}
+
+    resolved = None
+    if 'RA' in resolved_obj and 'DEC' in resolved_obj:
+        if resolved_obj.get('object_type') is not None and resolved_obj.get('object_ids') is not None:
+            resolved = True
+    elif local_answered or external_answered:
+        resolved = False
+
+    return resolved_obj, resolved
+
+
+def query_local_name_resolver(local_name_resolver_url: str, entities_portal_url: str, name: str, sentry_dsn=None):
+    resolved_obj = {}
+    answered = False
+    quoted_name = urllib.parse.quote(name.strip())
+    local_name_resolver_url_formatted = local_name_resolver_url.format(quoted_name)
+    try:
+        res = name_resolver_http_client.get(local_name_resolver_url_formatted)
+        if res.status_code == 200:
+            returned_resolved_obj = res.json()
+            if 'success' in returned_resolved_obj:
+                answered = True
                 resolved_obj['name'] = name.replace('_', ' ')
-                resolver_tag = root.find('.//Resolver')
-                if resolver_tag is not None:
-                    ra_tag = resolver_tag.find('.//jradeg')
-                    dec_tag = resolver_tag.find('.//jdedeg')
-                    if ra_tag is None or dec_tag is None:
-                        info_tag = root.find('.//INFO')
-                        resolved_obj['message'] = f'{name} could not be resolved'
-                        if info_tag is not None:
-                            message_info = info_tag.text
-                            resolved_obj['message'] += f': {message_info}'
-                    else:
-                        resolved_obj['RA'] = float(ra_tag.text)
-                        resolved_obj['DEC'] = float(dec_tag.text)
-                        resolved_obj['entity_portal_link'] = entities_portal_url.format(quoted_name)
-                        resolved_obj['message'] = f'{name} successfully resolved'
-
-                        try:
-                            Simbad.add_votable_fields("otype")
-                            result_table = Simbad.query_object(quoted_name)
-                            object_type = str(result_table[0]['OTYPE']).strip()
-                            resolved_obj['object_type'] = object_type
-                        except Exception as e:
-                            logger.warning(f"An exception occurred while using Simbad to query the object \"{name}\" "
-                                           f"while using the external resolver:\n{str(e)}")
-                            resolved_obj['object_type'] = None
-                        try:
-                            object_ids_table = Simbad.query_objectids(name)
-                            source_ids_list = object_ids_table['ID'].tolist()
-                            resolved_obj['object_ids'] = source_ids_list
-                        except Exception as e:
-                            logger.warning(f"An exception occurred while using Simbad to query the object ids for the object \"{name}\" "
-                                           f"while using the external resolver:\n{str(e)}")
-                            resolved_obj['object_ids'] = None
-                else:
-                    warning_msg = ("There seems to be some problem in completing the request for the resolution of the object"
-                                   f" \"{name}\" using the external resolver.")
+                if returned_resolved_obj['success']:
+                    logger.info(f"object {name} successfully resolved")
+                    if 'ra' in returned_resolved_obj:
+                        resolved_obj['RA'] = float(returned_resolved_obj['ra'])
+                    if 'dec' in returned_resolved_obj:
+                        resolved_obj['DEC'] = float(returned_resolved_obj['dec'])
+                    if 'object_ids' in returned_resolved_obj:
+                        resolved_obj['object_ids'] = returned_resolved_obj['object_ids']
+                    if 'object_type' in returned_resolved_obj:
+                        resolved_obj['object_type'] = returned_resolved_obj['object_type']
+                    resolved_obj['entity_portal_link'] = entities_portal_url.format(quoted_name)
+                    resolved_obj['message'] = f'{name} successfully resolved'
+                elif not returned_resolved_obj['success']:
+                    logger.info(f"resolution of the object {name} unsuccessful")
                     resolved_obj['message'] = f'{name} could not be resolved'
+        else:
+            logger.warning("There seems to be some problem in completing the request for the resolution of the object"
+                           f" \"{name}\" using the local resolver.\n"
+                           f"The request lead to the error {res.text}, "
+                           "this might be due to an error in the url or the service "
+                           "requested is currently not available. The external resolver will be used.")
+            if sentry_dsn is not None:
+                sentry.capture_message(f'Failed to resolve object "{name}" using the local resolver. '
+                                       f'URL: {local_name_resolver_url_formatted} '
+                                       f'Status Code: {res.status_code} '
+                                       f'Response: {res.text}')
+    except (ConnectionError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as e:
+        logger.warning(f'An exception occurred while trying to resolve the object "{name}" using the local resolver. '
+                       f'using the url: {local_name_resolver_url_formatted}. Exception details: {str(e)}')
+        if sentry_dsn is not None:
+            sentry.capture_message(f'An exception occurred while trying to resolve the object "{name}" using the local resolver. '
+                                   f'URL: {local_name_resolver_url_formatted} '
+                                   f"Exception details: {str(e)}")
+    return resolved_obj, answered
+
+
+def query_external_name_resolver(external_name_resolver_url: str, entities_portal_url: str, name: str, sentry_dsn=None):
+    resolved_obj = {}
+    answered = False
+    quoted_name = urllib.parse.quote(name.strip())
+    external_name_resolver_url_formatted = external_name_resolver_url.format(quoted_name)
+    try:
+        res = name_resolver_http_client.get(external_name_resolver_url_formatted)
+        if res.status_code == 200:
+            answered = True
+            root = ET.fromstring(res.text)
+            resolved_obj['name'] = name.replace('_', ' ')
+            resolver_tag = root.find('.//Resolver')
+            if resolver_tag is not None:
+                ra_tag = resolver_tag.find('.//jradeg')
+                dec_tag = resolver_tag.find('.//jdedeg')
+                if ra_tag is None or dec_tag is None:
                     info_tag = root.find('.//INFO')
+                    resolved_obj['message'] = f'{name} could not be resolved'
                     if info_tag is not None:
-                        warning_msg += (f"The request lead to the error {info_tag.text}, "
-                                       "this might be due to an error in the name of the object that ha been provided.")
-                        resolved_obj['message'] += f': {info_tag.text}'
-                    logger.warning(warning_msg)
-                    if sentry_dsn is not None:
-                        sentry.capture_message(f'Failed to resolve object "{name}" using the external resolver. '
-                                               f'URL: {external_name_resolver_url_formatted} '
-                                               f'Status Code: {res.status_code} '
-                                               f'Response: {res.text}'
-                                               f"Info returned from the resolver: {resolved_obj['message']}")
+                        message_info = info_tag.text
+                        resolved_obj['message'] += f': {message_info}'
+                else:
+                    resolved_obj['RA'] = float(ra_tag.text)
+                    resolved_obj['DEC'] = float(dec_tag.text)
+                    resolved_obj['entity_portal_link'] = entities_portal_url.format(quoted_name)
+                    resolved_obj['message'] = f'{name} successfully resolved'
+
+                    try:
+                        Simbad.add_votable_fields("otype")
+                        result_table = Simbad.query_object(quoted_name)
+                        object_type = str(result_table[0]['OTYPE']).strip()
+                        resolved_obj['object_type'] = object_type
+                    except Exception as e:
+                        logger.warning(f"An exception occurred while using Simbad to query the object \"{name}\" "
+                                       f"while using the external resolver:\n{str(e)}")
+                        resolved_obj['object_type'] = None
+                    try:
+                        object_ids_table = Simbad.query_objectids(name)
+                        source_ids_list = object_ids_table['ID'].tolist()
+                        resolved_obj['object_ids'] = source_ids_list
+                    except Exception as e:
+                        logger.warning(f"An exception occurred while using Simbad to query the object ids for the object \"{name}\" "
+                                       f"while using the external resolver:\n{str(e)}")
+                        resolved_obj['object_ids'] = None
             else:
-                logger.warning("There seems to be some problem in completing the request for the resolution of the object"
-                               f" \"{name}\" using the external resolver.\n"
-                               f"The request lead to the error {res.text}, "
-                               "this might be due to an error in the url or the service "
-                               "requested is currently not available. The object could not be resolved.")
+                warning_msg = ("There seems to be some problem in completing the request for the resolution of the object"
+                               f" \"{name}\" using the external resolver.")
+                resolved_obj['message'] = f'{name} could not be resolved'
+                info_tag = root.find('.//INFO')
+                if info_tag is not None:
+                    warning_msg += (f"The request lead to the error {info_tag.text}, "
+                                   "this might be due to an error in the name of the object that ha been provided.")
+                    resolved_obj['message'] += f': {info_tag.text}'
+                logger.warning(warning_msg)
                 if sentry_dsn is not None:
                     sentry.capture_message(f'Failed to resolve object "{name}" using the external resolver. '
                                            f'URL: {external_name_resolver_url_formatted} '
                                            f'Status Code: {res.status_code} '
-                                           f'Response: {res.text}')
-                resolved_obj['message'] = f'{name} could not be resolved: {res.text}'
-        except (ConnectionError,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout) as e:
-            logger.warning(f'An exception occurred while trying to resolve the object "{name}" using the local resolver. '
-                           f'using the url: {external_name_resolver_url_formatted}. Exception details: {str(e)}')
+                                           f'Response: {res.text}'
+                                           f"Info returned from the resolver: {resolved_obj['message']}")
+        else:
+            logger.warning("There seems to be some problem in completing the request for the resolution of the object"
+                           f" \"{name}\" using the external resolver.\n"
+                           f"The request lead to the error {res.text}, "
+                           "this might be due to an error in the url or the service "
+                           "requested is currently not available. The object could not be resolved.")
             if sentry_dsn is not None:
-                sentry.capture_message(f'An exception occurred while trying to resolve the object "{name}" using the external resolver. '
+                sentry.capture_message(f'Failed to resolve object "{name}" using the external resolver. '
                                        f'URL: {external_name_resolver_url_formatted} '
-                                       f"Exception details: {str(e)}")
-    return resolved_obj
+                                       f'Status Code: {res.status_code} '
+                                       f'Response: {res.text}')
+            resolved_obj['message'] = f'{name} could not be resolved: {res.text}'
+    except (ConnectionError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as e:
+        logger.warning(f'An exception occurred while trying to resolve the object "{name}" using the local resolver. '
+                       f'using the url: {external_name_resolver_url_formatted}. Exception details: {str(e)}')
+        if sentry_dsn is not None:
+            sentry.capture_message(f'An exception occurred while trying to resolve the object "{name}" using the external resolver. '
+                                   f'URL: {external_name_resolver_url_formatted} '
+                                   f"Exception details: {str(e)}")
+    return resolved_obj, answered
 
 
 def get_revnum(service_url: str, time_to_convert: str = None):
     resolved_obj = {}
-    try:
-        if time_to_convert is None or time_to_convert == '':
-            time_to_convert = datetime.now()
+    if time_to_convert is None or time_to_convert == '':
+        time_to_convert = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+    revnums = get_revnums(service_url=service_url, times_to_convert=[time_to_convert])
+    if time_to_convert in revnums:
+        resolved_obj['revnum'] = revnums[time_to_convert]
+    return resolved_obj
+
+
+def get_revnums(service_url: str, times_to_convert: list, max_workers=4) -> dict:
+    """
+    returns the revolution number of each of the times which could be parsed; the conversions of past times are
+    cached, the others are requested concurrently to the timesystem service
+    """
+    revnums = {}
+    times_to_request = {}
+    latest_requested_times = {}
+    for time_to_convert in times_to_convert:
+        try:
+            parsed_time = parser.parse(time_to_convert)
+        except parser.ParserError as e:
+            logger.warning(
+                f"error while parsing the time {time_to_convert}, "
+                f"please check your request and try to issue it again")
+            continue
+        formatted_time = parsed_time.strftime('%Y-%m-%dT%H:%M:%S')
+
+        revnum = revnum_cache.get(service_url, formatted_time)
+        if revnum is not None:
+            revnums[time_to_convert] = revnum
         else:
-            time_to_convert = parser.parse(time_to_convert)
-        time_to_convert = time_to_convert.strftime('%Y-%m-%dT%H:%M:%S')
-    except parser.ParserError as e:
-        logger.warning(
-            f"error while parsing the time {time_to_convert}, "
-            f"please check your request and try to issue it again")
-        return resolved_obj
-    res = requests.get(service_url.format(time_to_convert))
-
-    if res.status_code == 200:
-        resolved_obj['revnum'] = int(res.content)
-    else:
-        logger.warning(f"there seems to be some problem in completing the request for the conversion of the time: {time_to_convert}\n"
+            times_to_request.setdefault(formatted_time, []).append(time_to_convert)
+            # the timesystem service converts the formatted time in UTC, the time requested might have a timezone
+            requested_times = [parsed_time.replace(tzinfo=tz.UTC)]
+            if parsed_time.tzinfo is not None:
+                requested_times.append(parsed_time.astimezone(tz.UTC))
+            if formatted_time in latest_requested_times:
+                requested_times.append(latest_requested_times[formatted_time])
+            latest_requested_times[formatted_time] = max(requested_times)
+
+    if len(times_to_request) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(times_to_request)))) as executor:
+            converted_revnums = dict(zip(times_to_request,
+                                         executor.map(lambda formatted_time: convert_time_to_revnum(service_url, formatted_time),
+                                                      times_to_request)))
+
+        # the revolution including the current time, and the following ones, might still be adjusted
+        cacheable_before = datetime.now(tz.UTC) - timedelta(days=1)
+        for formatted_time, revnum in converted_revnums.items():
+            if latest_requested_times[formatted_time] < cacheable_before:
+                revnum_cache.store(service_url, formatted_time, revnum)
+            for time_to_convert in times_to_request[formatted_time]:
+                revnums[time_to_convert] = revnum
+
+    return revnums
+
+
+def convert_time_to_revnum(service_url: str, formatted_time: str) -> int:
+    res = timesystem_http_client.get(service_url.format(formatted_time))
+
+    if res.status_code != 200:
+        logger.warning(f"there seems to be some problem in completing the request for the conversion of the time: {formatted_time}\n"
                        f"the request lead to the error {res.text}, "
                        "this might be due to an error in the url or the service "
                        "requested is currently not available, "
@@ -1599,4 +1871,4 @@ def get_revnum(service_url: str, time_to_convert: str = None):
         raise InternalError('issue when performing a request to the timesystem service',
                             status_code=500,
                             payload={'drupal_helper_error_message': res.text})
-    return resolved_obj
+    return int(res.content)
@@ -5,16 +5,16 @@ from email.mime.application import MIMEApplication
 from collections import OrderedDict
 from urllib.parse import urlencode
 import typing
+import functools
 
 from ..flask_app.sentry import sentry
+from ..flask_app.tracing import span
+from ..flask_app.metrics import metrics
 
 from ..analysis import tokenHelper
-import smtplib
-import ssl
 import os
 import re
 import time
-import glob
 import black
 import base64
 import logging
@@ -28,11 +28,15 @@ from ..app_logging import app_logging
 from ..analysis.exceptions import BadRequest, MissingRequestParameter
 from ..analysis.hash import make_hash
 from ..analysis.time_helper import validate_time
+from ..analysis.smtp_pool import SMTPConnectionPool, get_smtp_connection_pool
+from ..analysis.job_index import job_index
 
 from datetime import datetime
 
 email_helper_logger = app_logging.getLogger('email_helper')
 
+templates_dir = os.path.join(os.path.dirname(__file__), '..', 'flask_app', 'templates')
+
 num_email_sending_max_tries = 5
 email_sending_retry_sleep_s = .5
 
@@ -44,12 +48,16 @@ class EMailNotSent(BadRequest):
     pass
 
 
+class InvalidMessageTime(ValueError):
+    pass
+
+
 def timestamp2isot(timestamp_or_string: typing.Union[str, float]):
     try:
         timestamp_or_string = validate_time(timestamp_or_string).strftime("%Y-%m-%d %H:%M:%S")
     except (ValueError, OverflowError, TypeError, OSError) as e:
         email_helper_logger.warning(f'Error when constructing the datetime object from the timestamp {timestamp_or_string}:\n{e}')
-        raise EMailNotSent(f"Email not sent: {e}")
+        raise InvalidMessageTime(e)
 
     return timestamp_or_string
 
@@ -70,6 +78,33 @@ def humanize_future(timestamp: float):
     return humanize_interval(float(timestamp) - time_.time())
 
 
+@functools.lru_cache(maxsize=None)
+def get_templates_environment() -> Environment:
+    """
+    returns the environment of the email and matrix message templates, which are loaded and compiled once per process
+    """
+    env = Environment(loader=FileSystemLoader(templates_dir), auto_reload=False)
+    env.filters['timestamp2isot'] = timestamp2isot
+    env.filters['humanize_age'] = humanize_age
+    env.filters['humanize_future'] = humanize_future
+    return env
+
+
+def render_template(template_name, data, not_sent_exception, not_sent_message):
+    """
+    renders one of the message templates, raising not_sent_exception if a time in the data can not be rendered
+    """
+    try:
+        return get_templates_environment().get_template(template_name).render(**data)
+    except InvalidMessageTime as e:
+        raise not_sent_exception(f"{not_sent_message}: {e}")
+
+
+def replace_api_code_token(api_code, replacement):
+    token_pattern = r"[\'\"]token[\'\"]:\s*?[\'\"].*?[\'\"]"
+    return re.sub(token_pattern, replacement, api_code, flags=re.DOTALL)
+
+
 def textify_email(html):
     html = re.sub('<title>.*?</title>', '', html)
     html = re.sub('<a href=(.*?)>(.*?)</a>', r'\2: \1', html)
@@ -136,6 +171,13 @@ def generate_products_url_from_par_dict(products_url, par_dict) -> str:
     return request_url
 
 def wrap_python_code(code, max_length=100, max_str_length=None):
+    # formatting with black is the most expensive step of the rendering of the messages,
+    # and the api code of a job is the same in all of its emails and matrix messages
+    return _wrap_python_code(code, max_length, max_str_length)
+
+
+@functools.lru_cache(maxsize=256)
+def _wrap_python_code(code, max_length, max_str_length):
 
     # this black currently does not split strings without spaces
 
@@ -179,37 +221,11 @@ def check_scw_list_length(
 
 
 def get_first_submitted_email_time(scratch_dir):
-    first_submitted_email_time = None
-    submitted_email_pattern = os.path.join(
-        scratch_dir,
-        'email_history',
-        'email_submitted_*.email'
-    )
-    submitted_email_files = sorted(glob.glob(submitted_email_pattern), key=os.path.getmtime)
-
-    if len(submitted_email_files) >= 1:
-        f_name, f_ext = os.path.splitext(os.path.basename(submitted_email_files[0]))
-        f_name_split = f_name.split('_')
-        if len(f_name_split) == 4:
-            try:
-                validate_time(f_name_split[3])
-                first_submitted_email_time = float(f_name_split[3])
-            except (ValueError, OverflowError, TypeError, OSError) as e:
-                email_helper_logger.warning(f'Error when extracting the time of the first submitted email.'
-                                            f'The value extracted {first_submitted_email_time} raised the following error:\n{e}')
-                first_submitted_email_time = None
-                sentry.capture_message(f'Error when extracting the time of the first submitted email.'
-                               f'The value extracted {first_submitted_email_time} raised the following error:\n{e}')
-        else:
-            email_helper_logger.warning(f'Error when extracting the time of the first submitted email: '
-                                        f'the name of the email file has been found not properly formatted, therefore, '
-                                        f'the time of the first submitted email could not be extracted.')
-            first_submitted_email_time = None
-            sentry.capture_message(f'Error when extracting the time of the first submitted email: '
-                           f'the name of the email file has been found not properly formatted, therefore, '
-                           f'the time of the first submitted email could not be extracted.')
+    first_submitted_email = job_index.first_notification('email', 'submitted', scratch_dir)
+    if first_submitted_email is None:
+        return None
 
-    return first_submitted_email_time
+    return first_submitted_email['first_submitted_time']
 
 
 def send_incident_report_email(
@@ -224,11 +240,6 @@ def send_incident_report_email(
 
     sending_time = time_.time()
 
-    env = Environment(loader=FileSystemLoader('%s/../flask_app/templates/' % os.path.dirname(__file__)))
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
     email_data = {
         'request': {
             'job_id': job_id,
@@ -239,8 +250,7 @@ def send_incident_report_email(
         'content': incident_content
     }
 
-    template = env.get_template('incident_report_email.html')
-    email_body_html = template.render(**email_data)
+    email_body_html = render_template('incident_report_email.html', email_data, EMailNotSent, "Email not sent")
 
     email_subject = re.search("<title>(.*?)</title>", email_body_html).group(1)
     email_text = textify_email(email_body_html)
@@ -263,13 +273,15 @@ def send_incident_report_email(
                          scratch_dir=scratch_dir,
                          smtp_server_password=config.smtp_server_password,
                          sending_time=sending_time,
-                         logger=logger)
+                         logger=logger,
+                         connection_pool=get_smtp_connection_pool(config, config.incident_report_sender_email_address))
 
     store_incident_report_email_info(message, scratch_dir, sending_time=sending_time)
 
     return message
 
 
+@span('send_email')
 def send_job_email(
         config,
         logger,
@@ -285,34 +297,55 @@ def send_job_email(
         request_url="",
         api_code="",
         scratch_dir=None):
+    rendered_email = render_job_email(config,
+                                      logger,
+                                      decoded_token,
+                                      token,
+                                      job_id,
+                                      session_id,
+                                      status=status,
+                                      status_details=status_details,
+                                      instrument=instrument,
+                                      product_type=product_type,
+                                      time_request=time_request,
+                                      request_url=request_url,
+                                      api_code=api_code,
+                                      scratch_dir=scratch_dir)
+
+    return deliver_job_email(config, logger, rendered_email, scratch_dir)
+
+
+def render_job_email(
+        config,
+        logger,
+        decoded_token,
+        token,
+        job_id,
+        session_id,
+        status="done",
+        status_details=None,
+        instrument="",
+        product_type="",
+        time_request=None,
+        request_url="",
+        api_code="",
+        scratch_dir=None) -> dict:
+    """
+    renders the email about the job, returning everything needed to send it, in a json-serializable form
+    """
     sending_time = time_.time()
 
-    # let's get the needed email template;
-    # TODO: should get from pkgresources or so
-    env = Environment(loader=FileSystemLoader('%s/../flask_app/templates/' % os.path.dirname(__file__)))
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
     # api_code = adapt_line_length_api_code(api_code, line_break="\n", add_line_continuation="\\")
-    api_code_no_token = re.sub('"token": ".*?"', '"token": "<PLEASE-INSERT-YOUR-TOKEN-HERE>"', api_code)
+    api_code_no_token = replace_api_code_token(api_code, '"token": "<PLEASE-INSERT-YOUR-TOKEN-HERE>"')
     api_code_no_token = wrap_python_code(api_code_no_token)
 
     api_code = wrap_python_code(api_code)
     api_code_too_long = invalid_email_line_length(api_code) or invalid_email_line_length(api_code_no_token)
 
-    api_code_email_attachment = None
+    attachment_file_path = None
     if api_code_too_long:
         # TODO: send us a sentry alert here
         attachment_file_path = store_email_api_code_attachment(api_code, status, scratch_dir, sending_time=sending_time)
-        with open(attachment_file_path, "r") as fil:
-            api_code_email_attachment = MIMEApplication(
-                fil.read(),
-                Name=os.path.basename(attachment_file_path)
-            )
-        api_code_email_attachment.add_header('Content-Disposition',
-                                             'attachment',
-                                             filename="api_code.py")
 
     status_details_message = None
     status_details_title = status
@@ -367,8 +400,7 @@ and if this is not what you expected, you probably need to modify the request pa
             'permanent_url': permanent_url,
         }
     }
-    template = env.get_template('email.html')
-    email_body_html = template.render(**email_data)
+    email_body_html = render_template('email.html', email_data, EMailNotSent, "Email not sent")
 
     email_subject = re.search("<title>(.*?)</title>", email_body_html).group(1)
     email_text = textify_email(email_body_html)
@@ -378,23 +410,57 @@ and if this is not what you expected, you probably need to modify the request pa
         open("debug_email_lines_too_long.text", "w").write(email_text)
         raise EMailNotSent(f"email not sent, lines too long!")
 
+    return dict(status=status,
+                status_details=status_details,
+                sending_time=sending_time,
+                time_request=time_request,
+                receiver_email_addresses=tokenHelper.get_token_user_email_address(decoded_token),
+                reply_to_email_address=email_data['oda_site']['contact'],
+                email_subject=email_subject,
+                email_text=email_text,
+                email_body_html=email_body_html,
+                attachment_file_path=attachment_file_path)
+
+
+def deliver_job_email(config, logger, rendered_email, scratch_dir, max_tries=None):
+    """
+    sends an email rendered by render_job_email, and records it in the email history of the job
+    """
+    api_code_email_attachment = None
+    if rendered_email['attachment_file_path'] is not None:
+        with open(rendered_email['attachment_file_path'], "r") as fil:
+            api_code_email_attachment = MIMEApplication(
+                fil.read(),
+                Name=os.path.basename(rendered_email['attachment_file_path'])
+            )
+        api_code_email_attachment.add_header('Content-Disposition',
+                                             'attachment',
+                                             filename="api_code.py")
+
     message = send_email(config.smtp_server,
                          config.smtp_port,
                          config.sender_email_address,
                          config.cc_receivers_email_addresses,
                          config.bcc_receivers_email_addresses,
-                         tokenHelper.get_token_user_email_address(decoded_token),
-                         email_data['oda_site']['contact'],
-                         email_subject,
-                         email_text,
-                         email_body_html,
+                         rendered_email['receiver_email_addresses'],
+                         rendered_email['reply_to_email_address'],
+                         rendered_email['email_subject'],
+                         rendered_email['email_text'],
+                         rendered_email['email_body_html'],
                          config.smtp_server_password,
-                         sending_time=sending_time,
+                         sending_time=rendered_email['sending_time'],
                          scratch_dir=scratch_dir,
                          logger=logger,
-                         attachment=api_code_email_attachment)
+                         attachment=api_code_email_attachment,
+                         max_tries=max_tries,
+                         connection_pool=get_smtp_connection_pool(config))
 
-    store_status_email_info(message, status, scratch_dir, logger, sending_time=sending_time, first_submitted_time=time_request)
+    store_status_email_info(message,
+                            rendered_email['status'],
+                            scratch_dir,
+                            logger,
+                            sending_time=rendered_email['sending_time'],
+                            first_submitted_time=rendered_email['time_request'])
 
     return message
 
@@ -413,15 +479,18 @@ def send_email(smtp_server,
                logger,
                sending_time=None,
                scratch_dir=None,
-               attachment=None
+               attachment=None,
+               max_tries=None,
+               connection_pool=None
                ):
 
-    server = None
     logger.info(f"Sending email through the smtp server: {smtp_server}:{smtp_port}")
     # Create the plain-text and HTML version of your message,
     # since emails with HTML content might be, sometimes, not supported
 
-    n_tries_left = num_email_sending_max_tries
+    n_tries_left = max_tries
+    if n_tries_left is None:
+        n_tries_left = num_email_sending_max_tries
 
     if not isinstance(receiver_email_addresses, list):
         receiver_email_addresses = [receiver_email_addresses]
@@ -448,23 +517,20 @@ def send_email(smtp_server,
     message.attach(part1)
     message.attach(part2)
 
+    if connection_pool is None:
+        # a connection just for this email
+        connection_pool = SMTPConnectionPool(smtp_server,
+                                             smtp_port,
+                                             sender_email_address,
+                                             smtp_server_password,
+                                             max_idle_connections=0)
+
     while True:
         try:
-            # Create a secure SSL context
-            context = ssl.create_default_context()
-            #
-            # Try to log in to server and send email
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            # just for testing purposes, not ssl is established
-            if smtp_server != "localhost":
-                try:
-                    server.starttls(context=context)
-                except Exception as e:
-                    logger.warning(f'unable to start TLS: {e}')
-            if smtp_server_password is not None and smtp_server_password != '':
-                server.login(sender_email_address, smtp_server_password)
-            server.sendmail(sender_email_address, receivers_email_addresses, message.as_string())
+            with connection_pool.session() as server:
+                server.sendmail(sender_email_address, receivers_email_addresses, message.as_string())
             logger.info("email successfully sent")
+            metrics.inc('dispatcher_notifications_total', dict(channel='email', outcome='sent'))
 
             return message
         except Exception as e:
@@ -486,6 +552,7 @@ def send_email(smtp_server,
                              f"{e}")
 
                 store_not_sent_email(email_body_html, scratch_dir, sending_time=sending_time)
+                metrics.inc('dispatcher_notifications_total', dict(channel='email', outcome='failed'))
 
                 sentry.capture_message((f'multiple attempts to send an email with title {email_subject} '
                                         f'have been detected, the following error has been generated:\n"'
@@ -493,10 +560,6 @@ def send_email(smtp_server,
 
                 raise EMailNotSent(f"email not sent: {e}")
 
-        finally:
-            if server:
-                server.quit()
-
 
 def store_status_email_info(message, status, scratch_dir, logger, sending_time=None, first_submitted_time=None):
     path_email_history_folder = os.path.join(scratch_dir, 'email_history')
@@ -528,11 +591,16 @@ def store_status_email_info(message, status, scratch_dir, logger, sending_time=N
                                    f'The value {first_submitted_time} raised the following error:\n{e}')
 
     email_file_name = f'email_{status}_{str(sending_time)}_{str(first_submitted_time)}.email'
+    email_file_path = os.path.join(path_email_history_folder, email_file_name)
 
     # record the email just sent in a dedicated file
-    with open(os.path.join(path_email_history_folder, email_file_name), 'w+') as outfile:
+    with open(email_file_path, 'w+') as outfile:
         outfile.write(message.as_string())
 
+    job_index.record_notification(scratch_dir, 'email', status, email_file_path,
+                                  sending_time=float(sending_time),
+                                  first_submitted_time=float(first_submitted_time))
+
 
 def store_not_sent_email(email_body, scratch_dir, sending_time=None):
     path_email_history_folder = os.path.join(scratch_dir, 'email_history')
@@ -634,29 +702,13 @@ def is_email_to_send_run_query(logger, status, time_original_request, scratch_di
         logger.info("email_sending_job_submitted_interval: %s", email_sending_job_submitted_interval)
         log_additional_info_obj['email_sending_job_submitted_interval'] = f'{email_sending_job_submitted_interval}, {info_parameter}'
 
-        email_history_dir = os.path.join(scratch_dir + '/email_history')
-        logger.info("email_history_dir: %s", email_history_dir)
-
-        email_history_dirs_same_job_id = f"scratch_*_{job_id}*/email_history"
-        logger.info("email_history_dirs_same_job_id: %s", email_history_dirs_same_job_id)
-
-        # find all
-        submitted_email_pattern = os.path.join(
-                email_history_dirs_same_job_id,
-                'email_submitted_*.email'
-            )
-        submitted_email_files = glob.glob(submitted_email_pattern)
+        submitted_emails = job_index.find_notifications('email', 'submitted', job_id=job_id)
+        submitted_email_files = [email['notification_file'] for email in submitted_emails]
         logger.info("submitted_email_files: %s as %s", len(submitted_email_files), submitted_email_files)
         log_additional_info_obj['submitted_email_files'] = submitted_email_files
 
-        if len(submitted_email_files) >= 1:
-            times = []
-            for f in submitted_email_files:
-                f_name, f_ext = os.path.splitext(os.path.basename(f))
-                if f_ext == '.email' and f_name:
-                    times.append(float(f_name.split('_')[2]))
-
-            time_last_email_submitted_sent = max(times)
+        if len(submitted_emails) >= 1:
+            time_last_email_submitted_sent = submitted_emails[-1]['sending_time']
             time_from_last_submitted_email = time_check - float(time_last_email_submitted_sent)
             interval_ok = time_from_last_submitted_email > email_sending_job_submitted_interval
 
@@ -732,7 +784,8 @@ def is_email_to_send_callback(logger, status, time_original_request, scratch_dir
             logger.info("email_sending_timeout and duration_query > timeout_threshold_email %s",
                         email_sending_timeout and duration_query > timeout_threshold_email)
 
-            done_email_files = glob.glob(f'scratch_*_jid_{job_id}*/email_history/email_done_*')
+            done_email_files = [email['notification_file']
+                                for email in job_index.find_notifications('email', 'done', job_id=job_id)]
             log_additional_info_obj['done_email_files'] = done_email_files
             if len(done_email_files) >= 1:
                 logger.info("the email cannot be sent because the number of done emails sent is too high: %s", len(done_email_files))
@@ -1,5 +1,4 @@
 import hashlib
-import subprocess
 import json
 from collections import OrderedDict
 
@@ -14,31 +13,88 @@ default_kw_black_list = ('session_id',
                  'async_dispatcher')
 
 
-def make_hash(o):
+job_id_hash_modes = ('legacy', 'canonical')
+default_job_id_hash_mode = 'legacy'
+
+
+def _legacy_digest(hashes):
+    # same as hashlib.md5(json.dumps(sorted(hashes)).encode()), the hashes being hex strings which need no escaping
+    return hashlib.md5(
+        ('["' + '", "'.join(sorted(hashes)) + '"]').encode() if hashes else b'[]'
+    ).hexdigest()[:16]
+
+
+def _legacy_leaf_hash(dumped_o):
+    if len(dumped_o) < 1024:
+        return hashlib.md5(json.dumps(sorted(dumped_o)).encode()).hexdigest()[:16]
+
+    # same as above, without building the list of all the characters of long strings
+    return hashlib.md5(
+        ('[' + ''.join((json.dumps(c) + ', ') * dumped_o.count(c) for c in sorted(set(dumped_o)))[:-2] + ']').encode()
+    ).hexdigest()[:16]
+
+
+def _make_hash_legacy(o):
+    if isinstance(o, (set, tuple, list)):
+        return _legacy_digest([_make_hash_legacy(x) for x in o])
+
+    elif isinstance(o, (dict, OrderedDict)):
+        return _legacy_digest([_legacy_digest([_make_hash_legacy(k), _make_hash_legacy(v)]) for k, v in o.items()])
+
+    # this takes care of various strange objects which can not be properly represented
+    return _legacy_leaf_hash(json.dumps(o))
+
+
+def canonical_serialization(o) -> str:
+    """
+    Serializes a dictionary, list, tuple or set to any level in a form independent of the order
+    of the dictionary items and of the sequence elements (as it was always the case for the job_id)
+    """
+    if isinstance(o, (set, tuple, list)):
+        return '[' + ','.join(sorted(map(canonical_serialization, o))) + ']'
+
+    elif isinstance(o, (dict, OrderedDict)):
+        return '{' + ','.join(sorted(canonical_serialization(k) + ':' + canonical_serialization(v)
+                                     for k, v in o.items())) + '}'
+
+    return json.dumps(o)
+
+
+def format_canonical_hash(serialization):
+    return hashlib.md5(serialization.encode()).hexdigest()[:16]
+
+
+def make_hash(o, hash_mode=default_job_id_hash_mode):
     """
     Makes a hash from a dictionary, list, tuple or set to any level, that contains
     only other hashable types (including any lists, tuples, sets, and
     dictionaries).
 
+    In the "legacy" mode every element is hashed separately, and the hashes are combined level by level:
+    the values are the same as they always were, and they can be compared with existing job_ids.
+    In the "canonical" mode the object is serialized once, and a single digest is computed.
     """
 
     # note that even strings change hash() value between python invocations, so it's not safe to do so
-    def format_hash(x): return hashlib.md5(
-        json.dumps(sorted(x)).encode()
-    ).hexdigest()[:16]
+    if hash_mode == 'legacy':
+        return _make_hash_legacy(o)
+    elif hash_mode == 'canonical':
+        return format_canonical_hash(canonical_serialization(o))
 
-    if isinstance(o, (set, tuple, list)):
-        return format_hash(tuple(map(make_hash, o)))
+    raise ValueError(f"unknown hash mode {hash_mode}, should be one of {job_id_hash_modes}")
 
-    elif isinstance(o, (dict, OrderedDict)):
-        return make_hash(tuple(o.items()))        
 
-    # this takes care of various strange objects which can not be properly represented
-    return format_hash(json.dumps(o))
+default_file_hash_algorithm = 'md5'
+default_file_hash_chunk_size = 1024 * 1024
+
 
+def make_hash_stream(stream, hash_algorithm=default_file_hash_algorithm, chunk_size=default_file_hash_chunk_size):
+    file_hash = hashlib.new(hash_algorithm)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
 
-def make_hash_file(file_path):
-    command = ["md5sum", file_path]
 
-    output = subprocess.check_output(command)
-    return output.decode().split()[0]
+def make_hash_file(file_path, hash_algorithm=default_file_hash_algorithm, chunk_size=default_file_hash_chunk_size):
+    with open(file_path, 'rb') as f:
+        return make_hash_stream(f, hash_algorithm=hash_algorithm, chunk_size=chunk_size)
@@ -0,0 +1,124 @@
+"""
+HTTP client keeping the connections to a service open between requests.
+
+Using the module-level requests functions opens a new connection, with its TLS handshake, for every request.
+An HTTPClient holds one requests.Session per process, whose connections are kept alive and reused by the following
+requests to the same host. Cookies are not kept, since the session is shared by the requests of all the users.
+
+The client counts the requests, retries and errors, and passes every event to the hooks added with add_hook,
+e.g. to export them as metrics.
+"""
+
+import os
+import time
+import logging
+import threading
+import http.cookiejar
+import typing
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+event_counters = {'request': 'requests', 'retry': 'retries', 'error': 'errors'}
+
+
+class HTTPClient:
+    def __init__(self, name, timeout=(10, 300), pool_connections=4, pool_maxsize=10):
+        self.name = name
+        self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._counters = {counter: 0 for counter in event_counters.values()}
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.name} ]"
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    # a session inherited through a fork would share its sockets with the parent process
+                    self._session = self._make_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _make_session(self) -> requests.Session:
+        session = requests.Session()
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def add_hook(self, hook: typing.Callable):
+        """
+        hook is called as hook(client_name, event, **info), event being one of 'request', 'retry' or 'error'
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: typing.Callable):
+        self._hooks.remove(hook)
+
+    def _notify(self, event, **info):
+        with self._lock:
+            self._counters[event_counters[event]] += 1
+
+        for hook in self._hooks:
+            try:
+                hook(self.name, event, **info)
+            except Exception as e:
+                logger.warning("error in the instrumentation hook %s of the http client %s: %s", hook, self.name, repr(e))
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+
+        t0 = time.perf_counter()
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except Exception as e:
+            self._notify('error', method=method, url=url, error=repr(e), duration_s=time.perf_counter() - t0)
+            raise
+
+        self._notify('request', method=method, url=url, status_code=res.status_code, duration_s=time.perf_counter() - t0)
+        return res
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request('get', url, **kwargs)
+
+    def record_retry(self, method, url, error=None):
+        self._notify('retry', method=method, url=url, error=error)
+
+    def stats(self) -> dict:
+        """
+        returns the counters of the client, and the state of the connection pools of the current process
+        """
+        with self._lock:
+            stats = dict(self._counters)
+
+        pools = {}
+        if self._session is not None and self._pid == os.getpid():
+            for adapter in set(self._session.adapters.values()):
+                for pool_key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[pool_key]
+                    pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = dict(
+                        connections_opened=pool.num_connections,
+                        requests=pool.num_requests,
+                    )
+        stats['pools'] = pools
+        stats['connections_opened'] = sum(pool['connections_opened'] for pool in pools.values())
+
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
@@ -24,6 +24,8 @@ import os
 from builtins import (bytes, str, open, super, range,
                       zip, round, input, int, pow, object, map, zip)
 
+import copy
+import threading
 import string
 import json
 import logging
@@ -41,12 +43,15 @@ from .catalog import BasicCatalog
 from .products import QueryOutput
 from .queries import ProductQuery, SourceQuery, InstrumentQuery
 from .io_helper import upload_file, upload_files_request
+from .hash import default_file_hash_algorithm, default_file_hash_chunk_size
 
 from .exceptions import RequestNotUnderstood, RequestNotAuthorized, InternalError, ProductProcessingError
 from ..flask_app.sentry import sentry
 
 from oda_api.api import DispatcherAPI, RemoteException, Unauthorized, DispatcherException, DispatcherNotAvailable, UnexpectedDispatcherStatusCode, RequestNotUnderstood as RequestNotUnderstoodOdaApi
 
+logger = logging.getLogger(__name__)
+
 __author__ = "Andrea Tramacere"
 
 # Standard library
@@ -254,7 +259,9 @@ class Instrument:
                            bind_port,
                            request_files_dir,
                            decoded_token,
-                           sentry_dsn=None):
+                           sentry_dsn=None,
+                           upload_hash_algorithm=default_file_hash_algorithm,
+                           upload_hash_chunk_size=default_file_hash_chunk_size):
         error_message = 'Error while {step} {temp_dir_content_msg}{additional}'
         # TODO probably exception handling can be further improved and/or optmized
         try:
@@ -278,7 +285,9 @@ class Instrument:
             # any other file
             step = 'uploading other files'
             uploaded_files_obj = upload_files_request(request=request,
-                                                       upload_dir=upload_dir)
+                                                       upload_dir=upload_dir,
+                                                       hash_algorithm=upload_hash_algorithm,
+                                                       chunk_size=upload_hash_chunk_size)
             step = 'updating par_dic with the uploaded files'
             self.update_par_dic_with_uploaded_files(par_dic=par_dic,
                                                     uploaded_files_obj=uploaded_files_obj,
@@ -871,12 +880,112 @@ def build_catalog(cat_dic,catalog_selected_objects=None):
 
     return user_catalog
 
+class InstrumentRegistryEntry:
+    """
+    name and access rules of the instrument built by a factory; the factory is called only when
+    they are not available as attributes, and the instruments serving the requests are built on demand
+    """
+    def __init__(self, instrument_factory):
+        self.instrument_factory = instrument_factory
+        self.copy_template = True
+
+        _instrument = None
+        if hasattr(instrument_factory, 'instr_name'):
+            self.name = instrument_factory.instr_name
+        else:
+            _instrument = instrument_factory()
+            self.name = _instrument.name
+
+        if _instrument is None and hasattr(instrument_factory, 'instrument_query'):
+            self.instrument_query = instrument_factory.instrument_query
+        else:
+            if _instrument is None:
+                _instrument = instrument_factory()
+            self.instrument_query = _instrument.instrumet_query
+
+        # an instrument which was just built can be used as template
+        self._instrument_template = _instrument
+        self._instrument_template_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.name} ]"
+
+    def check_instrument_access(self, roles=None, email=None):
+        return self.instrument_query.check_instrument_access(roles, email)
+
+    def build_instrument(self, use_template=True):
+        """
+        the instruments are copies of a template built once per process, and never used to serve a request;
+        if the template can not be copied, the factory is called for each instrument
+        """
+        if not use_template or not self.copy_template:
+            return self.instrument_factory()
+
+        if self._instrument_template is None:
+            # built once, also when the first requests arrive together
+            with self._instrument_template_lock:
+                if self._instrument_template is None:
+                    self._instrument_template = self.instrument_factory()
+
+        try:
+            return copy.deepcopy(self._instrument_template)
+        except Exception as e:
+            logger.warning('unable to copy the template of the instrument %s, it will be built for each request: %s',
+                           self.name, repr(e))
+            self.copy_template = False
+            return self.instrument_factory()
+
+
 class InstrumentFactoryIterator:
     def __init__(self):
         self._partlist = []
+        # instrument factory -> registry entry
+        self._registry_entries = {}
+        self._registry_lock = threading.Lock()
         
     def extend(self, lst):
         self._partlist.append(lst)
+        # registered right away, so that broken factories are reported when the plugins are loaded
+        try:
+            self.registry
+        except Exception:
+            pass
     
     def __iter__(self):
-        return (y for x in self._partlist for y in x)
\ No newline at end of file
+        return (y for x in self._partlist for y in x)
+
+    @property
+    def registry(self):
+        """
+        entries of the factories currently in the extended lists, each registered at its first access;
+        a factory failing to be registered is attempted again at each access, and the error raised, so that
+        the requests listing or choosing the instruments report it instead of missing the instrument
+        """
+        registry = []
+        registration_error = None
+        with self._registry_lock:
+            for instrument_factory in self:
+                if instrument_factory not in self._registry_entries:
+                    try:
+                        self._registry_entries[instrument_factory] = InstrumentRegistryEntry(instrument_factory)
+                    except Exception as e:
+                        message = f'failed to register instrument factory {instrument_factory}: {repr(e)}'
+                        logger.error(message)
+                        sentry.capture_message(message)
+                        if registration_error is None:
+                            registration_error = e
+                        continue
+
+                registry.append(self._registry_entries[instrument_factory])
+
+        if registration_error is not None:
+            raise registration_error
+
+        return registry
+
+    @property
+    def instrument_names(self):
+        return [entry.name for entry in self.registry]
+
+    def accessible_instrument_names(self, roles=None, email=None):
+        return [entry.name for entry in self.registry if entry.check_instrument_access(roles, email)]
\ No newline at end of file
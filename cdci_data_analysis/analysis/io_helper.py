@@ -32,13 +32,19 @@ __author__ = "Andrea Tramacere"
 # eg copy
 # absolute import rg:from copy import deepcopy
 import  os
+import time
+import hashlib
+import tempfile
+import zlib
+import struct
+import tarfile
 from pathlib import Path
 from astropy.io import fits as pf
 from flask import request
 from werkzeug.utils import secure_filename
 import decorator
 
-from .hash import make_hash_file
+from .hash import default_file_hash_algorithm, default_file_hash_chunk_size
 
 # Dependencies
 # eg numpy 
@@ -193,6 +199,23 @@ def view_traceback():
     del tb
 
 
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# read once, os.umask can only be read by setting it, which is not thread-safe
+process_umask = _get_umask()
+
+
+def set_default_file_mode(file_path):
+    """
+    gives to a file created by tempfile.mkstemp, only accessible by its owner, the permissions of a file created by open
+    """
+    os.chmod(file_path, 0o666 & ~process_umask)
+
+
 def upload_file(name, dir):
     if name not in request.files:
         return None
@@ -209,19 +232,52 @@ def upload_file(name, dir):
         return file_path
 
 
-def upload_files_request(request, upload_dir):
+def upload_file_by_hash(file, upload_dir,
+                        hash_algorithm=default_file_hash_algorithm,
+                        chunk_size=default_file_hash_chunk_size):
+    """
+    stores the uploaded file in upload_dir, named after the hash of its content;
+    the file is read once, and its copy dropped if an identical one is already there
+    """
+    stream = file.stream
+    file_hash_obj = hashlib.new(hash_algorithm)
+
+    # hashed while written, under a temporary name, to never expose partial content
+    fd, tmp_file_path = tempfile.mkstemp(prefix='.upload_', dir=upload_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                file_hash_obj.update(chunk)
+                f_out.write(chunk)
+
+        file_hash = file_hash_obj.hexdigest()
+        file_path = os.path.join(upload_dir, file_hash)
+        if not os.path.exists(file_path):
+            set_default_file_mode(tmp_file_path)
+            os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+
+    return file_hash
+
+
+def upload_files_request(request, upload_dir,
+                         hash_algorithm=default_file_hash_algorithm,
+                         chunk_size=default_file_hash_chunk_size):
     uploaded_files_obj = {}
     if request.method == 'POST':
         for f in request.files:
             # TODO needed since those two files are extracted in a previous step
             if f != 'user_scw_list_file' and f != 'user_catalog_file':
-                f_path = upload_file(f, upload_dir)
-                if f_path is not None:
-                    file_hash = make_hash_file(f_path)
-                    new_file_name = file_hash
-                    new_file_path = os.path.join(upload_dir, new_file_name)
-                    uploaded_files_obj[f] = new_file_name
-                    os.rename(f_path, new_file_path)
+                file = request.files[f]
+                # if user does not select file, browser also
+                # submit a empty part without filename
+                if file.filename == '' or file.filename is None:
+                    continue
+                uploaded_files_obj[f] = upload_file_by_hash(file, upload_dir,
+                                                            hash_algorithm=hash_algorithm,
+                                                            chunk_size=chunk_size)
     return uploaded_files_obj
 
 
@@ -235,4 +291,110 @@ def format_size(size_bytes, format_returned='M'):
     elif format_returned == 'G':
         return "%.2fG" % size_gb
     else:
-        return "%.2fkb" % size_kb
\ No newline at end of file
+        return "%.2fkb" % size_kb
+
+download_chunk_size = 1024 * 1024
+
+
+class GzipStreamCompressor(object):
+    """
+    incrementally produces a gzip member, with the same layout as the one written by gzip.open
+    """
+
+    def __init__(self, fname='', compresslevel=9, mtime=None):
+        self.compresslevel = compresslevel
+        self.fname = fname
+        self.mtime = int(time.time()) if mtime is None else int(mtime)
+        self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        self._crc = zlib.crc32(b"")
+        self._size = 0
+
+    def header(self):
+        fname = self.fname.encode('latin-1', errors='replace')
+        flags = b'\x08' if fname else b'\x00'
+        xfl = b'\x02' if self.compresslevel == 9 else (b'\x04' if self.compresslevel == 1 else b'\x00')
+        header = b'\x1f\x8b\x08' + flags + struct.pack("<L", self.mtime) + xfl + b'\xff'
+        if fname:
+            header += fname + b'\x00'
+        return header
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush() + struct.pack("<LL", self._crc, self._size & 0xffffffff)
+
+
+def iter_file_chunks(file_path, chunk_size=download_chunk_size, size=None):
+    """
+    reads a file by chunks; if size is given, exactly size bytes are produced
+    """
+    n_read = 0
+    with open(file_path, 'rb') as f_in:
+        while size is None or n_read < size:
+            to_read = chunk_size if size is None else min(chunk_size, size - n_read)
+            chunk = f_in.read(to_read)
+            if not chunk:
+                break
+            n_read += len(chunk)
+            yield chunk
+
+    if size is not None and n_read < size:
+        # the file was truncated meanwhile, the declared size has to be kept
+        yield b'\0' * (size - n_read)
+
+
+def iter_gzip_stream(file_path, fname='', mtime=None, chunk_size=download_chunk_size):
+    gz = GzipStreamCompressor(fname=fname, mtime=mtime)
+    yield gz.header()
+    for chunk in iter_file_chunks(file_path, chunk_size=chunk_size):
+        compressed = gz.compress(chunk)
+        if compressed:
+            yield compressed
+    yield gz.flush()
+
+
+def iter_tar_stream(file_list, arcname_dir, chunk_size=download_chunk_size):
+    """
+    produces an uncompressed tar archive with the given files, stored in arcname_dir
+    """
+    n_written = 0
+    for file_path in file_list:
+        file_stat = os.stat(file_path)
+        tarinfo = tarfile.TarInfo('%s/%s' % (arcname_dir, os.path.basename(file_path)))
+        tarinfo.size = file_stat.st_size
+        tarinfo.mtime = file_stat.st_mtime
+        tarinfo.mode = file_stat.st_mode & 0o7777
+
+        header = tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape')
+        n_written += len(header)
+        yield header
+
+        for chunk in iter_file_chunks(file_path, chunk_size=chunk_size, size=tarinfo.size):
+            yield chunk
+        n_written += tarinfo.size
+
+        remainder = tarinfo.size % tarfile.BLOCKSIZE
+        if remainder > 0:
+            n_written += tarfile.BLOCKSIZE - remainder
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+    # end of archive marker, and padding to the record size, as done by tarfile
+    end_blocks = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    n_written += len(end_blocks)
+    remainder = n_written % tarfile.RECORDSIZE
+    if remainder > 0:
+        end_blocks += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    yield end_blocks
+
+
+def iter_tar_gz_stream(file_list, arcname_dir, fname='', mtime=None, chunk_size=download_chunk_size):
+    gz = GzipStreamCompressor(fname=fname, mtime=mtime)
+    yield gz.header()
+    for chunk in iter_tar_stream(file_list, arcname_dir, chunk_size=chunk_size):
+        compressed = gz.compress(chunk)
+        if compressed:
+            yield compressed
+    yield gz.flush()
@@ -0,0 +1,628 @@
+"""
+Persistent index of the job scratch directories.
+
+Looking up the scratch directories (``scratch_sid_<session_id>_jid_<job_id>[_aliased]``) with glob lists the whole
+working directory, which is slow when it holds many jobs. They are recorded instead in a local SQLite database
+(see ``local_sqlite``), maintained when the dispatcher creates, updates or deletes them, and built from disk when it
+is first created (see ``bin/rebuild_job_index.py``). The directories created by other hosts, or outside the
+dispatcher, are found by scanning the working directory when the index has no entry for a job, for the jobs already
+known when their scratch directory is set, and before listing the index.
+
+The index also keeps a ledger of the notifications sent about each job, pointing to the files of their history,
+which are read when the ledger has no notification of the kind and status looked for.
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import logging
+import typing
+
+from .time_helper import validate_time
+from .local_sqlite import LocalDatabase, default_path
+from ..flask_app.sentry import sentry
+
+logger = logging.getLogger(__name__)
+
+
+scratch_dir_pattern = re.compile(
+    r"^scratch(?:_sid_(?P<session_id>[^/]*?))?_jid_(?P<job_id>[^_/]+)(?P<aliased_marker>_aliased|)$")
+
+
+notification_file_patterns = {
+    'email': (os.path.join('email_history', 'email_*.email'),
+              re.compile(r"^email_(?P<status>[^_]+)_(?P<sending_time>[^_]+)_(?P<first_submitted_time>[^_]+)\.email$")),
+    'matrix': (os.path.join('matrix_message_history', 'matrix_message_*.json'),
+               re.compile(r"^matrix_message_(?P<status>[^_]+)_(?P<sending_time>[^_]+)_(?P<first_submitted_time>[^_]+)\.json$")),
+}
+
+# stands in the ledger for the notifications still to be delivered by the notification outbox
+pending_notification_prefix = 'pending:'
+
+
+def parse_scratch_dir_name(scratch_dir) -> typing.Union[dict, None]:
+    r = scratch_dir_pattern.match(os.path.basename(os.path.normpath(scratch_dir)))
+    if r is None:
+        return None
+
+    return dict(session_id=r.group('session_id'),
+                job_id=r.group('job_id'),
+                aliased=r.group('aliased_marker') == '_aliased')
+
+
+class JobIndex:
+    def __init__(self, index_path=None):
+        self._index_path = index_path
+        self._database = LocalDatabase(self._initialize)
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.index_path} ]"
+
+    @property
+    def index_path(self):
+        # resolved at every access, since the dispatcher working directory is the current one
+        if self._index_path is not None:
+            return self._index_path
+        return default_path('job-index', 'DISPATCHER_JOB_INDEX_PATH')
+
+    def _connect(self):
+        return self._database.connect(self.index_path)
+
+    def _initialize(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS scratch_dirs ("
+                         "scratch_dir TEXT PRIMARY KEY, "
+                         "session_id TEXT, "
+                         "job_id TEXT NOT NULL, "
+                         "aliased INTEGER NOT NULL DEFAULT 0, "
+                         "status TEXT, "
+                         "ctime REAL, "
+                         "mtime REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS scratch_dirs_job_id ON scratch_dirs (job_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS scratch_dirs_session_id ON scratch_dirs (session_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS scratch_dirs_mtime ON scratch_dirs (mtime)")
+            conn.execute("CREATE TABLE IF NOT EXISTS index_info (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS notifications ("
+                         "notification_file TEXT PRIMARY KEY, "
+                         "scratch_dir TEXT NOT NULL, "
+                         "job_id TEXT NOT NULL, "
+                         "kind TEXT NOT NULL, "
+                         "status TEXT NOT NULL, "
+                         "sending_time REAL, "
+                         "first_submitted_time REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS notifications_job_id ON notifications (job_id, kind, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS notifications_scratch_dir ON notifications (scratch_dir, kind, status)")
+
+            built = conn.execute("SELECT value FROM index_info WHERE key = 'built_from_disk'").fetchone()
+            if built is None:
+                n_entries = self._rebuild_from_disk(conn)
+                logger.info("job index %s initialized from disk with %s scratch directories", self.index_path, n_entries)
+
+            notifications_built = conn.execute("SELECT value FROM index_info WHERE key = 'notifications_built_from_disk'").fetchone()
+            if notifications_built is None:
+                # index created before the notifications were recorded in it
+                n_notifications = 0
+                for row in conn.execute("SELECT scratch_dir, job_id FROM scratch_dirs").fetchall():
+                    n_notifications += self._insert_notifications_from_disk(conn, row['scratch_dir'], row['job_id'])
+                conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES ('notifications_built_from_disk', ?)",
+                             (str(time.time()),))
+                logger.info("job index %s initialized from disk with %s notifications", self.index_path, n_notifications)
+
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _rebuild_from_disk(self, conn) -> int:
+        conn.execute("DELETE FROM scratch_dirs")
+        conn.execute("DELETE FROM notifications")
+        conn.execute("DELETE FROM index_info WHERE key LIKE 'scanned_from_disk_%'")
+        n_entries = 0
+        for scratch_dir in glob.glob("scratch*_jid_*"):
+            scratch_dir_info = parse_scratch_dir_name(scratch_dir)
+            if scratch_dir_info is None or not os.path.isdir(scratch_dir):
+                continue
+
+            scratch_dir_stat = os.stat(scratch_dir)
+            self._insert(conn, scratch_dir, scratch_dir_info,
+                         status=self._read_status(scratch_dir),
+                         ctime=scratch_dir_stat.st_ctime,
+                         mtime=scratch_dir_stat.st_mtime)
+            self._insert_notifications_from_disk(conn, self._normalize(scratch_dir), scratch_dir_info['job_id'])
+            n_entries += 1
+
+        conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES ('built_from_disk', ?)", (str(time.time()),))
+        conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES ('notifications_built_from_disk', ?)",
+                     (str(time.time()),))
+        return n_entries
+
+    @staticmethod
+    def _read_status(scratch_dir):
+        try:
+            with open(os.path.join(scratch_dir, 'job_monitor.json')) as job_monitor_file:
+                return json.load(job_monitor_file).get('status', None)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _insert_notifications_from_disk(conn, scratch_dir, job_id, only_kind=None, only_status=None, replace=True) -> int:
+        n_notifications = 0
+        for kind, (file_pattern, file_name_pattern) in notification_file_patterns.items():
+            if only_kind is not None and kind != only_kind:
+                continue
+            for notification_file in glob.glob(os.path.join(scratch_dir, file_pattern)):
+                r = file_name_pattern.match(os.path.basename(notification_file))
+                if r is None:
+                    message = (f'Error when extracting the times of the {kind} notification {notification_file}: '
+                               f'the name of the file has been found not properly formatted, therefore, '
+                               f'the notification could not be recorded in the job index.')
+                    logger.warning(message)
+                    sentry.capture_message(message)
+                    continue
+                if only_status is not None and r.group('status') != only_status:
+                    continue
+                try:
+                    validate_time(r.group('sending_time'))
+                    sending_time = float(r.group('sending_time'))
+                except (ValueError, OverflowError, TypeError, OSError) as e:
+                    message = (f'Error when extracting the times of the {kind} notification {notification_file}. '
+                               f'The values extracted raised the following error:\n{e}')
+                    logger.warning(message)
+                    sentry.capture_message(message)
+                    continue
+
+                # recorded without it, so that the time of the first submitted notification is not taken from it
+                try:
+                    validate_time(r.group('first_submitted_time'))
+                    first_submitted_time = float(r.group('first_submitted_time'))
+                except (ValueError, OverflowError, TypeError, OSError) as e:
+                    message = (f'Error when extracting the first submitted time of the {kind} notification {notification_file}. '
+                               f'The value extracted raised the following error:\n{e}')
+                    logger.warning(message)
+                    sentry.capture_message(message)
+                    first_submitted_time = None
+
+                conn.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO notifications "
+                             "(notification_file, scratch_dir, job_id, kind, status, sending_time, first_submitted_time) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (notification_file, scratch_dir, job_id, kind, r.group('status'),
+                              sending_time, first_submitted_time))
+                n_notifications += 1
+
+        return n_notifications
+
+    @staticmethod
+    def _insert(conn, scratch_dir, scratch_dir_info, status=None, ctime=None, mtime=None, replace=True):
+        conn.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO scratch_dirs "
+                     "(scratch_dir, session_id, job_id, aliased, status, ctime, mtime) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (scratch_dir,
+                      scratch_dir_info['session_id'],
+                      scratch_dir_info['job_id'],
+                      int(scratch_dir_info['aliased']),
+                      status,
+                      ctime,
+                      mtime))
+
+    @staticmethod
+    def _normalize(scratch_dir):
+        return os.path.normpath(scratch_dir)
+
+    def rebuild_from_disk(self) -> int:
+        """
+        drops the current content of the index and scans the working directory again
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                n_entries = self._rebuild_from_disk(conn)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        logger.info("job index %s rebuilt from disk with %s scratch directories", self.index_path, n_entries)
+        return n_entries
+
+    def register_scratch_dir(self, scratch_dir, status=None):
+        scratch_dir = self._normalize(scratch_dir)
+        scratch_dir_info = parse_scratch_dir_name(scratch_dir)
+        if scratch_dir_info is None:
+            logger.debug("%s is not a job scratch directory, not indexed", scratch_dir)
+            return
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            # an already registered directory (e.g. job resubmitted in the same session) keeps its creation time
+            conn.execute("INSERT INTO scratch_dirs "
+                         "(scratch_dir, session_id, job_id, aliased, status, ctime, mtime) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                         "ON CONFLICT (scratch_dir) DO UPDATE SET "
+                         "mtime = excluded.mtime, status = COALESCE(excluded.status, status)",
+                         (scratch_dir,
+                          scratch_dir_info['session_id'],
+                          scratch_dir_info['job_id'],
+                          int(scratch_dir_info['aliased']),
+                          status,
+                          now,
+                          now))
+        finally:
+            conn.close()
+
+    def update_status(self, scratch_dir, status):
+        scratch_dir = self._normalize(scratch_dir)
+        if parse_scratch_dir_name(scratch_dir) is None:
+            return
+
+        conn = self._connect()
+        try:
+            cursor = conn.execute("UPDATE scratch_dirs SET status = ?, mtime = ? WHERE scratch_dir = ?",
+                                  (status, time.time(), scratch_dir))
+            registered = cursor.rowcount > 0
+        finally:
+            conn.close()
+
+        if not registered and os.path.isdir(scratch_dir):
+            self.register_scratch_dir(scratch_dir, status=status)
+
+    def remove_scratch_dir(self, scratch_dir):
+        scratch_dir_info = parse_scratch_dir_name(scratch_dir)
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM scratch_dirs WHERE scratch_dir = ?", (self._normalize(scratch_dir),))
+            conn.execute("DELETE FROM notifications WHERE scratch_dir = ?", (self._normalize(scratch_dir),))
+            if scratch_dir_info is not None:
+                # the state of the working directory at the last scan for the job is kept as long as the job has directories
+                conn.execute("DELETE FROM index_info WHERE key = ? "
+                             "AND NOT EXISTS (SELECT 1 FROM scratch_dirs WHERE job_id = ?)",
+                             (f"scanned_from_disk_{scratch_dir_info['job_id']}", scratch_dir_info['job_id']))
+        finally:
+            conn.close()
+
+    def record_notification(self, scratch_dir, kind, status, notification_file, sending_time=None, first_submitted_time=None):
+        """
+        records in the ledger a notification sent about the job of scratch_dir, and stored in notification_file
+        """
+        scratch_dir = self._normalize(scratch_dir)
+        scratch_dir_info = parse_scratch_dir_name(scratch_dir)
+        if scratch_dir_info is None:
+            logger.debug("%s is not a job scratch directory, the notification is not indexed", scratch_dir)
+            return
+
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO notifications "
+                         "(notification_file, scratch_dir, job_id, kind, status, sending_time, first_submitted_time) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (os.path.normpath(notification_file),
+                          scratch_dir,
+                          scratch_dir_info['job_id'],
+                          kind,
+                          status,
+                          sending_time,
+                          first_submitted_time))
+        finally:
+            conn.close()
+
+    def remove_notification(self, notification_file):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM notifications WHERE notification_file = ?", (os.path.normpath(notification_file),))
+        finally:
+            conn.close()
+
+    def find_notifications(self, kind, status, job_id=None, scratch_dir=None) -> typing.List[dict]:
+        """
+        lists the notifications of a kind and status sent for a job, or from a scratch directory, by sending time;
+        the ledger is read, and, when it has none, the history of the scratch directories, since the notification
+        might have been sent by another host sharing the working directory
+        """
+        if job_id is not None:
+            where_clause = "job_id = ?"
+            parameters = (job_id,)
+        elif scratch_dir is not None:
+            where_clause = "scratch_dir = ?"
+            parameters = (self._normalize(scratch_dir),)
+        else:
+            raise ValueError("either job_id or scratch_dir should be given")
+
+        query = (f"SELECT * FROM notifications WHERE {where_clause} AND kind = ? AND status = ? "
+                 f"ORDER BY sending_time, notification_file")
+        conn = self._connect()
+        try:
+            rows = conn.execute(query, parameters + (kind, status)).fetchall()
+        finally:
+            conn.close()
+
+        if len(rows) == 0 and self.register_notifications_from_disk(kind, status, job_id=job_id, scratch_dir=scratch_dir) > 0:
+            conn = self._connect()
+            try:
+                rows = conn.execute(query, parameters + (kind, status)).fetchall()
+            finally:
+                conn.close()
+
+        return [dict(row) for row in rows]
+
+    def register_notifications_from_disk(self, kind, status, job_id=None, scratch_dir=None) -> int:
+        """
+        records in the ledger the notifications of a kind and status found in the history of the scratch directories
+        of a job, or of a scratch directory, and missing in the ledger
+        """
+        if job_id is not None:
+            scratch_dirs = [(record['scratch_dir'], job_id) for record in self.find_job_records(job_id)]
+        else:
+            scratch_dir = self._normalize(scratch_dir)
+            scratch_dir_info = parse_scratch_dir_name(scratch_dir)
+            if scratch_dir_info is None or not os.path.isdir(scratch_dir):
+                return 0
+            scratch_dirs = [(scratch_dir, scratch_dir_info['job_id'])]
+
+        conn = self._connect()
+        try:
+            n_notifications_before = conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for notifications_scratch_dir, notifications_job_id in scratch_dirs:
+                    self._insert_notifications_from_disk(conn, notifications_scratch_dir, notifications_job_id,
+                                                         only_kind=kind, only_status=status, replace=False)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            n_registered = conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0] - n_notifications_before
+        finally:
+            conn.close()
+
+        if n_registered > 0:
+            logger.info("%s notifications found in the history of the scratch directories registered in the job index",
+                        n_registered)
+        return n_registered
+
+    def find_notifications_by_file_prefix(self, prefix, sent_before=None) -> typing.List[dict]:
+        """
+        lists the notifications of the ledger whose file starts with prefix, e.g. those still to be delivered
+        """
+        where_clause = "notification_file >= ? AND notification_file < ?"
+        parameters = (prefix, prefix + '\U0010ffff')
+        if sent_before is not None:
+            where_clause += " AND sending_time < ?"
+            parameters += (sent_before,)
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT * FROM notifications WHERE {where_clause} ORDER BY sending_time",
+                                parameters).fetchall()
+        finally:
+            conn.close()
+
+        return [dict(row) for row in rows]
+
+    def last_notification_time(self, kind, status, job_id) -> typing.Union[float, None]:
+        notifications = self.find_notifications(kind, status, job_id=job_id)
+        if len(notifications) == 0:
+            return None
+        return notifications[-1]['sending_time']
+
+    def first_notification(self, kind, status, scratch_dir) -> typing.Union[dict, None]:
+        """
+        the first notification of a kind and status sent from a scratch directory; its file is checked, since
+        the times of the following notifications are derived from it, and dropped from the ledger when missing
+        """
+        while True:
+            notifications = self.find_notifications(kind, status, scratch_dir=scratch_dir)
+            if len(notifications) == 0:
+                return None
+
+            notification_file = notifications[0]['notification_file']
+            if notification_file.startswith(pending_notification_prefix) or os.path.exists(notification_file):
+                return notifications[0]
+
+            logger.warning("notification file %s not existing anymore, removing it from the job index", notification_file)
+            self.remove_notification(notification_file)
+
+    def _exists(self, scratch_dir) -> bool:
+        if os.path.isdir(scratch_dir):
+            return True
+
+        logger.info("scratch_dir %s not existing anymore, removing it from the job index", scratch_dir)
+        self.remove_scratch_dir(scratch_dir)
+        return False
+
+    def _select(self, where_clause="", parameters=(), order_by="scratch_dir", check_exists=False) -> typing.List[dict]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT * FROM scratch_dirs {where_clause} ORDER BY {order_by}", parameters).fetchall()
+        finally:
+            conn.close()
+
+        records = []
+        for row in rows:
+            if check_exists and not self._exists(row['scratch_dir']):
+                continue
+
+            record = dict(row)
+            record['aliased'] = bool(record['aliased'])
+            records.append(record)
+
+        return records
+
+    def _register_scratch_dirs_from_disk(self, scratch_dir_pattern, job_id=None) -> int:
+        n_registered = 0
+        conn = self._connect()
+        try:
+            for scratch_dir in glob.glob(scratch_dir_pattern):
+                scratch_dir_info = parse_scratch_dir_name(scratch_dir)
+                if scratch_dir_info is None or not os.path.isdir(scratch_dir):
+                    continue
+                if job_id is not None and scratch_dir_info['job_id'] != job_id:
+                    continue
+
+                scratch_dir = self._normalize(scratch_dir)
+                if conn.execute("SELECT 1 FROM scratch_dirs WHERE scratch_dir = ?", (scratch_dir,)).fetchone() is not None:
+                    continue
+
+                logger.info("scratch_dir %s not in the job index, registering it", scratch_dir)
+                scratch_dir_stat = os.stat(scratch_dir)
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._insert(conn, scratch_dir, scratch_dir_info,
+                                 status=self._read_status(scratch_dir),
+                                 ctime=scratch_dir_stat.st_ctime,
+                                 mtime=scratch_dir_stat.st_mtime,
+                                 replace=False)
+                    self._insert_notifications_from_disk(conn, scratch_dir, scratch_dir_info['job_id'])
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                n_registered += 1
+        finally:
+            conn.close()
+
+        return n_registered
+
+    def register_job_scratch_dirs_from_disk(self, job_id, if_changed=False) -> int:
+        """
+        scans the working directory for the scratch directories of a job, and registers those missing in the index
+
+        with if_changed, the scan is skipped if the working directory was not modified since the previous one for the job
+        """
+        scan_key = f'scanned_from_disk_{job_id}'
+        work_dir_mtime = os.stat('.').st_mtime_ns
+        conn = self._connect()
+        try:
+            if if_changed:
+                last_scan = conn.execute("SELECT value FROM index_info WHERE key = ?", (scan_key,)).fetchone()
+                if last_scan is not None and int(last_scan['value']) == work_dir_mtime:
+                    return 0
+            if time.time_ns() - work_dir_mtime > 1e9:
+                # with a coarse time resolution, a modification following closely might not change the time
+                conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES (?, ?)", (scan_key, str(work_dir_mtime)))
+        finally:
+            conn.close()
+
+        return self._register_scratch_dirs_from_disk(f"scratch*_jid_{glob.escape(job_id)}*", job_id=job_id)
+
+    def register_scratch_dirs_from_disk(self, min_interval=None) -> int:
+        """
+        scans the working directory for the scratch directories missing in the index (e.g. created by another host), and registers them
+
+        the scan is skipped if the previous one is more recent than min_interval seconds
+        """
+        conn = self._connect()
+        try:
+            if min_interval is not None:
+                last_scan = conn.execute("SELECT value FROM index_info WHERE key = 'scanned_from_disk'").fetchone()
+                if last_scan is not None and time.time() - float(last_scan['value']) < min_interval:
+                    return 0
+            conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES ('scanned_from_disk', ?)",
+                         (str(time.time()),))
+        finally:
+            conn.close()
+
+        n_registered = self._register_scratch_dirs_from_disk("scratch*_jid_*")
+        if n_registered > 0:
+            logger.info("registered %s scratch directories found on disk in the job index %s", n_registered, self.index_path)
+        return n_registered
+
+    def find_job_records(self, job_id, aliased=None, scan_disk=None) -> typing.List[dict]:
+        """
+        lists the scratch directories of a job, dropping from the index those not existing anymore
+
+        the working directory is scanned if scan_disk is set and it was modified since the previous scan for the job,
+        or, if scan_disk is None, when the index has no entry for the job
+        """
+        where_clause = "WHERE job_id = ?"
+        parameters = (job_id,)
+        if aliased is not None:
+            where_clause += " AND aliased = ?"
+            parameters += (int(aliased),)
+
+        records = self._select(where_clause, parameters, check_exists=True)
+        if scan_disk or (scan_disk is None and len(records) == 0):
+            if self.register_job_scratch_dirs_from_disk(job_id, if_changed=bool(scan_disk)) > 0:
+                records = self._select(where_clause, parameters, check_exists=True)
+
+        return records
+
+    def find_scratch_dirs(self, job_id, aliased=None, scan_disk=None) -> typing.List[str]:
+        return [r['scratch_dir'] for r in self.find_job_records(job_id, aliased=aliased, scan_disk=scan_disk)]
+
+    def list_records(self,
+                     min_mtime=None,
+                     max_mtime=None,
+                     job_id_prefix=None,
+                     status=None,
+                     after=None,
+                     limit=None,
+                     check_exists=False) -> typing.List[dict]:
+        """
+        lists the indexed scratch directories, sorted by modification time (the time of the last status update)
+
+        after is the (mtime, scratch_dir) of the last record of a previous listing, only records following it are returned;
+        with check_exists, the directories listed are checked on disk, and those not existing anymore dropped from the index,
+        otherwise they are to be dropped with remove_scratch_dir by the caller
+        """
+        conditions = []
+        parameters = ()
+        if min_mtime is not None:
+            conditions.append("mtime >= ?")
+            parameters += (min_mtime,)
+        if max_mtime is not None:
+            conditions.append("mtime <= ?")
+            parameters += (max_mtime,)
+        if job_id_prefix is not None:
+            # range condition, so that the job_id index can be used
+            conditions.append("job_id >= ? AND job_id < ?")
+            parameters += (job_id_prefix, job_id_prefix + '\U0010ffff')
+        if status is not None:
+            if isinstance(status, str):
+                status = [status]
+            conditions.append(f"status IN ({', '.join('?' * len(status))})")
+            parameters += tuple(status)
+
+        if limit is None:
+            return self._select(self._where_clause(conditions, after), parameters + self._after_parameters(after),
+                                order_by="mtime, scratch_dir", check_exists=check_exists)
+
+        records = []
+        while len(records) < limit:
+            n_missing = limit - len(records)
+            page = self._select(self._where_clause(conditions, after),
+                                parameters + self._after_parameters(after) + (n_missing,),
+                                order_by="mtime, scratch_dir LIMIT ?")
+            records += [r for r in page if not check_exists or self._exists(r['scratch_dir'])]
+            if len(page) < n_missing:
+                break
+            after = page[-1]['mtime'], page[-1]['scratch_dir']
+
+        return records
+
+    @staticmethod
+    def _where_clause(conditions, after=None):
+        if after is not None:
+            conditions = conditions + ["(mtime > ? OR (mtime = ? AND scratch_dir > ?))"]
+
+        if len(conditions) > 0:
+            return "WHERE " + " AND ".join(conditions)
+        return ""
+
+    @staticmethod
+    def _after_parameters(after=None):
+        if after is None:
+            return ()
+        after_mtime, after_scratch_dir = after
+        return after_mtime, after_mtime, after_scratch_dir
+
+    def list_scratch_dirs(self, **kwargs) -> typing.List[str]:
+        return [r['scratch_dir'] for r in self.list_records(**kwargs)]
+
+
+job_index = JobIndex()
@@ -29,8 +29,11 @@ import glob
 
 import json
 import  os
+import fcntl
+import tempfile
 
 import logging
+from contextlib import contextmanager
 
 from urllib.parse import urlencode
 
@@ -47,7 +50,10 @@ logger = logging.getLogger(__name__)
 # Project
 # relative import eg: from .mod import f
 
-from ..analysis.io_helper import FilePath
+from ..analysis.io_helper import FilePath, set_default_file_mode
+from ..analysis.job_index import job_index
+from ..flask_app.tracing import span
+from ..flask_app.metrics import metrics
 
 
 class Job(object):
@@ -186,6 +192,7 @@ class Job(object):
 
         return self.monitor
 
+    @span('write_dataserver_status')
     def write_dataserver_status(self, status_dictionary_value=None,
                                 full_dict=None,
                                 email_status=None,
@@ -195,6 +202,8 @@ class Job(object):
                                 call_back_status=None):
         # TODO: write to specific name coming for call_back
 
+        previous_status = self.monitor.get('status')
+
         if status_dictionary_value is None:
             pass
         else:
@@ -226,9 +235,23 @@ class Job(object):
         if full_dict is not None:
             self.monitor['full_report_dict'] = full_dict
 
-        with open(self.file_path, 'w') as outfile:
-            my_json_str = json.dumps(self.monitor)
-            outfile.write(u'%s' % my_json_str)
+        with job_monitor_lock(self.work_dir):
+            # the outcome of the notifications might have been updated meanwhile, by the notification workers
+            stored_monitor = read_job_monitor(self.file_path)
+            notification_fields = dict(email_status=email_status,
+                                       email_status_details=email_status_details,
+                                       matrix_message_status=matrix_message_status,
+                                       matrix_message_status_details=matrix_message_status_details)
+            for field, value in notification_fields.items():
+                if value is None and field in stored_monitor:
+                    self.monitor[field] = stored_monitor[field]
+
+            write_job_monitor(self.file_path, self.monitor)
+
+        job_index.update_status(self.work_dir, self.monitor.get('status'))
+
+        metrics.inc('dispatcher_job_status_transitions_total',
+                    dict(previous_status=previous_status, status=self.monitor.get('status')))
 
     def get_call_back_url(self):
         if self.dispatcher_callback_url_base is not None:
@@ -389,6 +412,54 @@ class OsaJob(Job):
         return self.monitor
 
 
+@contextmanager
+def job_monitor_lock(work_dir):
+    """
+    serializes the updates of the job monitor of work_dir, made by the requests and by the notification workers
+    """
+    with open(os.path.join(work_dir, '.job_monitor.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_job_monitor(file_path) -> dict:
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path) as infile:
+            return json.load(infile)
+    except ValueError as e:
+        logger.warning("unable to read the job monitor %s: %s", file_path, e)
+        return {}
+
+
+def write_job_monitor(file_path, monitor):
+    # written under a temporary name, so that the job monitor is never read partially written
+    fd, tmp_file_path = tempfile.mkstemp(prefix='.job_monitor_', dir=os.path.dirname(file_path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            outfile.write(json.dumps(monitor))
+        set_default_file_mode(tmp_file_path)
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+
+
+def update_job_monitor(work_dir, file_name='job_monitor.json', **monitor_fields):
+    """
+    updates some fields of the job monitor stored in work_dir, e.g. the outcome of the notifications sent after the request
+    """
+    file_path = os.path.join(work_dir, file_name)
+    with job_monitor_lock(work_dir):
+        monitor = read_job_monitor(file_path)
+        monitor.update({k: v for k, v in monitor_fields.items() if v is not None})
+        write_job_monitor(file_path, monitor)
+
+
 def job_factory(instrument_name, scratch_dir, dispatcher_host, dispatcher_port, dispatcher_callback_url_base, session_id, job_id, par_dic, aliased=False, token=None, time_request=None):
     # TODO does this list need to be updated?
     osa_list = ['jemx', 'isgri', 'empty-async']
@@ -0,0 +1,59 @@
+"""
+SQLite databases of the dispatcher kept on the local disk.
+
+SQLite relies on file locks, which are not reliable on NFS, where the working directory of the dispatcher
+often is. The databases of the dispatcher (job index, notification outbox, name resolver cache, metrics) are
+therefore kept by default in the temporary directory of the host, one per working directory, and shared by the
+dispatcher processes of the host. When several hosts share the working directory, each of them has its own.
+Their path can be set with an environment variable or in the configuration, and should not be on NFS either.
+"""
+
+import os
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import typing
+
+
+def default_path(name, env_var=None) -> str:
+    """
+    path of the database called name for the current working directory, unless set with the env_var variable
+    """
+    if env_var is not None and os.environ.get(env_var):
+        return os.environ[env_var]
+
+    work_dir = os.path.abspath(os.getcwd())
+    work_dir_hash = hashlib.sha1(work_dir.encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f'dispatcher-{name}-{work_dir_hash}.sqlite')
+
+
+class LocalDatabase:
+    """
+    connections to SQLite databases, in autocommit mode, whose tables are created by initialize(conn)
+    at the first connection of the process to each database
+    """
+    def __init__(self, initialize: typing.Callable[[sqlite3.Connection], None]):
+        self._initialize = initialize
+        self._initialized_paths = set()
+        self._lock = threading.Lock()
+
+    def connect(self, path) -> sqlite3.Connection:
+        path = os.path.abspath(path)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+
+        if path not in self._initialized_paths:
+            with self._lock:
+                if path not in self._initialized_paths:
+                    self._initialize(conn)
+                    self._initialized_paths.add(path)
+
+        return conn
+
+    def reset(self):
+        """
+        the tables are created again at the next connection, e.g. once the database is moved
+        """
+        with self._lock:
+            self._initialized_paths.clear()
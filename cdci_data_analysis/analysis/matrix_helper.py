@@ -2,21 +2,21 @@ import html
 import time as time_
 import os
 import requests
-import glob
 import json
 import re
-import typing
 
 from ..analysis import tokenHelper
-from ..analysis.email_helper import humanize_age, humanize_future, wrap_python_code
+from ..analysis.email_helper import wrap_python_code, render_template
 from ..analysis.exceptions import BadRequest, MissingRequestParameter
 from ..analysis.hash import make_hash
 from ..analysis.time_helper import validate_time
+from ..analysis.job_index import job_index
 from ..flask_app.sentry import sentry
+from ..flask_app.tracing import span
+from ..flask_app.metrics import metrics
 from ..app_logging import app_logging
 
 from datetime import datetime
-from jinja2 import Environment, FileSystemLoader
 from bs4 import BeautifulSoup
 from urllib import parse
 
@@ -32,16 +32,6 @@ class MatrixMessageNotSent(BadRequest):
 class MultipleDoneMatrixMessage(BadRequest):
     pass
 
-def timestamp2isot(timestamp_or_string: typing.Union[str, float]):
-    try:
-        timestamp_or_string = validate_time(timestamp_or_string).strftime("%Y-%m-%d %H:%M:%S")
-    except (ValueError, OverflowError, TypeError, OSError) as e:
-        matrix_helper_logger.warning(f'Error when constructing the datetime object from the timestamp {timestamp_or_string}:\n{e}')
-        raise MatrixMessageNotSent(f"Matrix message not sent: {e}")
-
-    return timestamp_or_string
-
-
 def textify_matrix_message(html):
     html = re.sub('<a href=(.*?)>(.*?)</a>', r'\2: \1', html)
 
@@ -55,37 +45,11 @@ def textify_matrix_message(html):
 
 
 def get_first_submitted_matrix_message_time(scratch_dir):
-    first_submitted_matrix_message_time = None
-    submitted_matrix_message_pattern = os.path.join(
-        scratch_dir,
-        'matrix_message_history',
-        'matrix_message_submitted_*.json'
-    )
-    submitted_matrix_message_files = sorted(glob.glob(submitted_matrix_message_pattern), key=os.path.getmtime)
-    matrix_helper_logger.info(f"get_first_submitted_matrix_message_time, files: {submitted_matrix_message_files}")
-    if len(submitted_matrix_message_files) >= 1:
-        f_name, f_ext = os.path.splitext(os.path.basename(submitted_matrix_message_files[0]))
-        f_name_split = f_name.split('_')
-        if len(f_name_split) == 5:
-            try:
-                validate_time(f_name_split[4])
-                first_submitted_matrix_message_time = float(f_name_split[4])
-            except (ValueError, OverflowError, TypeError, OSError) as e:
-                matrix_helper_logger.warning(f'Error when extracting the time of the first message submitted via matrix.'
-                               f'The value extracted {first_submitted_matrix_message_time} raised the following error:\n{e}')
-                first_submitted_matrix_message_time = None
-                sentry.capture_message(f'Error when extracting the time of the first message submitted via matrix.'
-                               f'The value extracted {first_submitted_matrix_message_time} raised the following error:\n{e}')
-        else:
-            matrix_helper_logger.warning(f'Error when extracting the time of the first message submitted via matrix: '
-                           f'the name of the message file has been found not properly formatted, therefore, '
-                           f'the time of the first message submitted via matrix could not be extracted.')
-            first_submitted_matrix_message_time = None
-            sentry.capture_message(f'Error when extracting the time of the first message submitted via matrix: '
-                           f'the name of the message file has been found not properly formatted, therefore, '
-                           f'the time of the first message submitted via matrix could not be extracted.')
+    first_submitted_matrix_message = job_index.first_notification('matrix', 'submitted', scratch_dir)
+    if first_submitted_matrix_message is None:
+        return None
 
-    return first_submitted_matrix_message_time
+    return first_submitted_matrix_message['first_submitted_time']
 
 
 def send_incident_report_message(
@@ -100,11 +64,6 @@ def send_incident_report_message(
 
     sending_time = time_.time()
 
-    env = Environment(loader=FileSystemLoader('%s/../flask_app/templates/' % os.path.dirname(__file__)))
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
     matrix_server_url = config.matrix_server_url
 
     incident_report_receivers_room_ids = config.matrix_incident_report_receivers_room_ids
@@ -120,8 +79,8 @@ def send_incident_report_message(
         'content': incident_content
     }
 
-    template = env.get_template('incident_report_matrix_message.html')
-    message_body_html = template.render(**matrix_message_data)
+    message_body_html = render_template('incident_report_matrix_message.html', matrix_message_data,
+                                        MatrixMessageNotSent, "Matrix message not sent")
     message_text = textify_matrix_message(message_body_html)
 
     # TODO to understand about the line length limit in matrix (if there is any)
@@ -169,6 +128,7 @@ def send_incident_report_message(
     return res_content
 
 
+@span('send_matrix_message')
 def send_job_message(
         config,
         logger,
@@ -184,6 +144,42 @@ def send_job_message(
         request_url="",
         api_code="",
         scratch_dir=None):
+    rendered_message = render_job_message(config,
+                                          logger,
+                                          decoded_token,
+                                          token,
+                                          job_id,
+                                          session_id,
+                                          status=status,
+                                          status_details=status_details,
+                                          instrument=instrument,
+                                          product_type=product_type,
+                                          time_request=time_request,
+                                          request_url=request_url,
+                                          api_code=api_code,
+                                          scratch_dir=scratch_dir)
+
+    return deliver_job_message(config, logger, rendered_message, scratch_dir)
+
+
+def render_job_message(
+        config,
+        logger,
+        decoded_token,
+        token,
+        job_id,
+        session_id,
+        status="done",
+        status_details=None,
+        instrument="",
+        product_type="",
+        time_request=None,
+        request_url="",
+        api_code="",
+        scratch_dir=None) -> dict:
+    """
+    renders the matrix message about the job, returning everything needed to send it, in a json-serializable form
+    """
     sending_time = time_.time()
 
     status_details_message = None
@@ -212,16 +208,13 @@ def send_job_message(
         possibly_compressed_request_url = request_url
         permanent_url = True
 
-    matrix_server_url = config.matrix_server_url
-    matrix_sender_access_token = config.matrix_sender_access_token
     receiver_room_id = tokenHelper.get_token_user_matrix_room_id(decoded_token)
 
-    bcc_receivers_room_ids = config.matrix_bcc_receivers_room_ids
+    # escaped once formatted, sharing the formatting with the emails of the job
+    api_code = wrap_python_code(api_code)
 
     api_code = html.escape(api_code, quote=False)
 
-    api_code = wrap_python_code(api_code)
-
     matrix_message_data = {
         'oda_site': {
             'site_name': config.site_name,
@@ -243,15 +236,31 @@ def send_job_message(
         }
     }
 
-    env = Environment(loader=FileSystemLoader(f'{os.path.dirname(__file__)}/../flask_app/templates/'))
+    message_body_html = render_template('matrix_message.html', matrix_message_data,
+                                        MatrixMessageNotSent, "Matrix message not sent")
+    message_text = textify_matrix_message(message_body_html)
 
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
+    return dict(status=status,
+                status_details=status_details,
+                sending_time=sending_time,
+                time_request=time_request,
+                receiver_room_id=receiver_room_id,
+                message_text=message_text,
+                message_body_html=message_body_html)
+
+
+def deliver_job_message(config, logger, rendered_message, scratch_dir):
+    """
+    sends a message rendered by render_job_message, and records it in the matrix message history of the job
+    """
+    matrix_server_url = config.matrix_server_url
+    matrix_sender_access_token = config.matrix_sender_access_token
+    bcc_receivers_room_ids = config.matrix_bcc_receivers_room_ids
+
+    receiver_room_id = rendered_message['receiver_room_id']
+    message_text = rendered_message['message_text']
+    message_body_html = rendered_message['message_body_html']
 
-    template = env.get_template('matrix_message.html')
-    message_body_html = template.render(**matrix_message_data)
-    message_text = textify_matrix_message(message_body_html)
     res_content = {
         'res_content_bcc_users': [],
         'res_content_bcc_users_failed': []
@@ -312,7 +321,12 @@ def send_job_message(
                 logger.warning(f"Issue in sending a message in the room {bcc_receiver_room_id} using matrix: {e.message}")
                 res_content['res_content_bcc_users_failed'].append(f"Issue in sending a message in the room {bcc_receiver_room_id} using matrix: {e.message}")
 
-    store_status_matrix_message_info(message_data, status, scratch_dir, logger, sending_time=sending_time, first_submitted_time=time_request)
+    store_status_matrix_message_info(message_data,
+                                     rendered_message['status'],
+                                     scratch_dir,
+                                     logger,
+                                     sending_time=rendered_message['sending_time'],
+                                     first_submitted_time=rendered_message['time_request'])
 
     return res_content
 
@@ -391,6 +405,7 @@ def send_message(
                                      "this might be due to an error in the url or the page requested no longer exists, "
                                      "please check it and try to issue again the request")
         matrix_error_message = error_msg
+        metrics.inc('dispatcher_notifications_total', dict(channel='matrix', outcome='failed'))
 
         sentry.capture_message(f'issue in sending a message via matrix, the requested url {url} lead to the error '
                                f'{matrix_error_message}')
@@ -404,6 +419,7 @@ def send_message(
     }
 
     logger.info("Message successfully sent")
+    metrics.inc('dispatcher_notifications_total', dict(channel='matrix', outcome='sent'))
 
     return res_data
 
@@ -459,29 +475,13 @@ def is_message_to_send_run_query(logger, status, time_original_request, scratch_
         log_additional_info_obj[
             'matrix_message_sending_job_submitted_interval'] = f'{matrix_message_sending_job_submitted_interval}, {info_parameter}'
 
-        matrix_message_history_dir = os.path.join(scratch_dir, 'matrix_message_history')
-        matrix_helper_logger.info("matrix_message_history_dir: %s", matrix_message_history_dir)
-
-        matrix_message_history_dirs_same_job_id = f"scratch_*_{job_id}*/matrix_message_history"
-        matrix_helper_logger.info("matrix_message_history_dirs_same_job_id: %s", matrix_message_history_dirs_same_job_id)
-
-        # find all
-        submitted_matrix_message_pattern = os.path.join(
-            matrix_message_history_dirs_same_job_id,
-            'matrix_message_submitted_*.json'
-        )
-        submitted_matrix_message_files = glob.glob(submitted_matrix_message_pattern)
+        submitted_matrix_messages = job_index.find_notifications('matrix', 'submitted', job_id=job_id)
+        submitted_matrix_message_files = [message['notification_file'] for message in submitted_matrix_messages]
         logger.info("submitted_matrix_message_files: %s as %s", len(submitted_matrix_message_files), submitted_matrix_message_files)
         log_additional_info_obj['submitted_matrix_message_files'] = submitted_matrix_message_files
 
-        if len(submitted_matrix_message_files) >= 1:
-            times = []
-            for f in submitted_matrix_message_files:
-                f_name, f_ext = os.path.splitext(os.path.basename(f))
-                if f_ext == '.json' and f_name:
-                    times.append(float(f_name.split('_')[3]))
-
-            time_last_matrix_message_submitted_sent = max(times)
+        if len(submitted_matrix_messages) >= 1:
+            time_last_matrix_message_submitted_sent = submitted_matrix_messages[-1]['sending_time']
             time_from_last_submitted_matrix_message = time_check - float(time_last_matrix_message_submitted_sent)
             interval_ok = time_from_last_submitted_matrix_message > matrix_message_sending_job_submitted_interval
 
@@ -566,7 +566,8 @@ def is_message_to_send_callback(logger, status, time_original_request, scratch_d
             logger.info("matrix_message_sending_timeout and duration_query > timeout_threshold_matrix_message %s",
                         matrix_message_sending_timeout and duration_query > timeout_threshold_matrix_message)
 
-            done_matrix_message_files = glob.glob(f'scratch_*_jid_{job_id}*/matrix_message_history/matrix_message_done_*')
+            done_matrix_message_files = [message['notification_file']
+                                         for message in job_index.find_notifications('matrix', 'done', job_id=job_id)]
             log_additional_info_obj['done_matrix_message_files'] = done_matrix_message_files
             if len(done_matrix_message_files) >= 1:
                 logger.info("the message cannot be sent via matrix because the number of done messages sent is too high: %s", len(done_matrix_message_files))
@@ -670,11 +671,16 @@ def store_status_matrix_message_info(message, status, scratch_dir, logger, sendi
                                    f'The value {first_submitted_time} raised the following error:\n{e}')
 
     matrix_message_file_name = f'matrix_message_{status}_{str(sending_time)}_{str(first_submitted_time)}.json'
+    matrix_message_file_path = os.path.join(matrix_message_history_folder, matrix_message_file_name)
 
     # record the matrix_message just sent in a dedicated file
-    with open(os.path.join(matrix_message_history_folder, matrix_message_file_name), 'w+') as outfile:
+    with open(matrix_message_file_path, 'w+') as outfile:
         outfile.write(json.dumps(message, indent=4))
 
+    job_index.record_notification(scratch_dir, 'matrix', status, matrix_message_file_path,
+                                  sending_time=float(sending_time),
+                                  first_submitted_time=float(first_submitted_time))
+
 
 def store_incident_report_matrix_message(message, scratch_dir, sending_time=None):
     matrix_message_history_folder_path = os.path.join(scratch_dir, 'matrix_message_history')
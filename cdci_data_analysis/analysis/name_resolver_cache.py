@@ -0,0 +1,176 @@
+"""
+Persistent cache of the resolution of the names of the astrophysical objects.
+
+Resolving a name queries the local and the external resolvers, and Simbad, and the same popular sources are
+resolved over and over. The resolved objects are stored in a small SQLite database, shared by the dispatcher
+processes and kept across restarts, by normalised name. The names which could not be resolved are kept for a
+shorter time, since they might be added to the resolvers in the meantime.
+
+Concurrent lookups of the same name within a process share a single resolution.
+
+The database is a local one (see ``local_sqlite``), its default path can be set with DISPATCHER_NAME_RESOLVER_CACHE_PATH.
+"""
+
+import os
+import copy
+import json
+import time
+import sqlite3
+import logging
+import threading
+import types
+import typing
+from collections import Counter
+
+from .local_sqlite import LocalDatabase, default_path
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_path() -> str:
+    return default_path('name-resolver-cache', 'DISPATCHER_NAME_RESOLVER_CACHE_PATH')
+
+
+def normalise_name(name: str) -> str:
+    return ' '.join(name.replace('_', ' ').split()).casefold()
+
+
+class NameResolverCache:
+    def __init__(self, cache_path=None, positive_ttl_s=7 * 24 * 3600, negative_ttl_s=3600):
+        if cache_path is None:
+            cache_path = default_cache_path()
+        self.cache_path = cache_path
+        self.positive_ttl_s = positive_ttl_s
+        self.negative_ttl_s = negative_ttl_s
+        self.counters = Counter()
+
+        self._database = LocalDatabase(self._initialize)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.cache_path} ]"
+
+    @staticmethod
+    def _initialize(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS resolved_names ("
+                     "name_key TEXT PRIMARY KEY, "
+                     "name TEXT NOT NULL, "
+                     "resolved_obj TEXT NOT NULL, "
+                     "resolved INTEGER NOT NULL, "
+                     "expiry REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS resolved_names_expiry ON resolved_names (expiry)")
+
+    def _connect(self):
+        return self._database.connect(self.cache_path)
+
+    def get(self, name) -> typing.Union[typing.Tuple[str, dict], None]:
+        """
+        returns the name for which the object was resolved, and the resolved object, if not expired
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT name, resolved_obj FROM resolved_names WHERE name_key = ? AND expiry > ?",
+                               (normalise_name(name), time.time())).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+
+        return row['name'], json.loads(row['resolved_obj'])
+
+    def store(self, name, resolved_obj, resolved: bool):
+        now = time.time()
+        expiry = now + (self.positive_ttl_s if resolved else self.negative_ttl_s)
+
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO resolved_names (name_key, name, resolved_obj, resolved, expiry) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (normalise_name(name), name, json.dumps(resolved_obj), int(resolved), expiry))
+            conn.execute("DELETE FROM resolved_names WHERE expiry <= ?", (now,))
+        finally:
+            conn.close()
+
+    def invalidate(self, name):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM resolved_names WHERE name_key = ?", (normalise_name(name),))
+        finally:
+            conn.close()
+
+    def get_or_resolve(self, name, resolve: typing.Callable) -> typing.Tuple[str, dict]:
+        """
+        returns the name for which the object was resolved, and the resolved object, calling resolve(name) if
+        the name is not in the cache; resolve returns the resolved object, and True if it was resolved, False if
+        it was not found, or None if the result should not be cached (e.g. the resolvers could not be reached)
+        """
+        name_key = normalise_name(name)
+
+        with self._lock:
+            flight = self._in_flight.get(name_key)
+            is_leader = flight is None
+            if is_leader:
+                flight = types.SimpleNamespace(done=threading.Event(), result=None, error=None)
+                self._in_flight[name_key] = flight
+
+        if not is_leader:
+            self.counters['shared'] += 1
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+
+        try:
+            try:
+                cached = self.get(name)
+            except sqlite3.Error as e:
+                logger.warning("unable to read the name resolver cache %s: %s", self.cache_path, repr(e))
+                cached = None
+
+            if cached is not None:
+                self.counters['hits'] += 1
+                flight.result = cached
+            else:
+                self.counters['misses'] += 1
+                resolved_obj, resolved = resolve(name)
+                if resolved is not None:
+                    try:
+                        self.store(name, resolved_obj, resolved)
+                    except sqlite3.Error as e:
+                        logger.warning("unable to store %s in the name resolver cache %s: %s",
+                                       name, self.cache_path, repr(e))
+                flight.result = (name, resolved_obj)
+
+            return copy.deepcopy(flight.result)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[name_key]
+            flight.done.set()
+
+    def stats(self) -> dict:
+        return dict(hits=self.counters['hits'], misses=self.counters['misses'], shared=self.counters['shared'])
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_name_resolver_cache(config) -> typing.Union[NameResolverCache, None]:
+    """
+    returns the name resolver cache set in the configuration, if any
+    """
+    if config.name_resolver_cache_path is None:
+        return None
+
+    cache_path = os.path.abspath(config.name_resolver_cache_path)
+    with _caches_lock:
+        if cache_path not in _caches:
+            _caches[cache_path] = NameResolverCache(cache_path,
+                                                    positive_ttl_s=config.name_resolver_cache_positive_ttl_s,
+                                                    negative_ttl_s=config.name_resolver_cache_negative_ttl_s)
+        return _caches[cache_path]
@@ -0,0 +1,524 @@
+"""
+Durable outbox of the notifications (emails and matrix messages) about the jobs.
+
+Sending them during the requests puts the SMTP connections and the matrix HTTP calls, with their
+retries, on the latency path of /run_analysis and /call_back. Instead, the requests only render the
+notifications and store them in a small SQLite database; they are delivered by a pool of background
+threads of the dispatcher process, with retries spaced by an increasing delay.
+
+As when they were sent during the requests, the outcome of the delivery is recorded in the job
+monitor, and the notifications sent are stored in the email/matrix message history of the job.
+Until then, the queued notifications are recorded in the ledger of the job index, so that the
+decisions about sending further notifications take them into account.
+Notifications claimed by a process which stopped before delivering them are delivered again
+once their lease expires. The emails due together are sent in a batch, over a single connection
+to the SMTP server. The notifications delivered, or given up, are removed from the outbox
+after a retention time, and the pending notifications recorded in the ledger of the job index
+once the outbox does not hold them anymore, whichever process delivered them.
+
+The outbox is a local SQLite database (see ``local_sqlite``): the notifications are delivered by the
+host which queued them. Its path can be set in the configuration, or with DISPATCHER_NOTIFICATION_OUTBOX_PATH.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextlib
+import typing
+
+from . import email_helper, matrix_helper
+from .smtp_pool import get_smtp_connection_pool
+from .job_manager import update_job_monitor
+from .job_index import job_index, pending_notification_prefix
+from .local_sqlite import LocalDatabase, default_path
+from ..flask_app.sentry import sentry
+
+logger = logging.getLogger(__name__)
+
+
+def default_outbox_path() -> str:
+    return default_path('notification-outbox', 'DISPATCHER_NOTIFICATION_OUTBOX_PATH')
+
+
+notification_kinds = ('email', 'matrix')
+
+
+class NotificationOutbox:
+    def __init__(self, outbox_path=None, lease_s=600):
+        if outbox_path is None:
+            outbox_path = default_outbox_path()
+        self.outbox_path = outbox_path
+        self.lease_s = lease_s
+        self._database = LocalDatabase(self._initialize)
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.outbox_path} ]"
+
+    @staticmethod
+    def _initialize(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS notifications ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "kind TEXT NOT NULL, "
+                     "scratch_dir TEXT NOT NULL, "
+                     "job_id TEXT, "
+                     "status TEXT, "
+                     "payload TEXT NOT NULL, "
+                     "state TEXT NOT NULL DEFAULT 'pending', "
+                     "attempts INTEGER NOT NULL DEFAULT 0, "
+                     "next_attempt_time REAL NOT NULL, "
+                     "created REAL NOT NULL, "
+                     "last_error TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS notifications_state "
+                     "ON notifications (state, next_attempt_time)")
+
+    def _connect(self):
+        return self._database.connect(self.outbox_path)
+
+    def enqueue(self, kind, scratch_dir, job_id, status, payload) -> int:
+        if kind not in notification_kinds:
+            raise ValueError(f"unknown notification kind {kind}, should be one of {notification_kinds}")
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute("INSERT INTO notifications "
+                                  "(kind, scratch_dir, job_id, status, payload, next_attempt_time, created) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (kind, scratch_dir, job_id, status, json.dumps(payload), now, now))
+            notification_id = cursor.lastrowid
+        finally:
+            conn.close()
+
+        logger.info("%s notification %s enqueued for job %s with status %s", kind, notification_id, job_id, status)
+        return notification_id
+
+    def claim(self, now=None) -> typing.Union[dict, None]:
+        """
+        returns the next notification due, if any, leasing it to the caller
+        """
+        if now is None:
+            now = time.time()
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM notifications "
+                                   "WHERE state IN ('pending', 'sending') AND next_attempt_time <= ? "
+                                   "ORDER BY next_attempt_time LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE notifications SET state = 'sending', attempts = attempts + 1, "
+                                 "next_attempt_time = ? WHERE id = ?", (now + self.lease_s, row['id']))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+
+        record = dict(row)
+        record['payload'] = json.loads(record['payload'])
+        record['attempts'] += 1
+        return record
+
+    def reclaim_expired(self, now=None) -> int:
+        """
+        makes the notifications whose lease expired, claimed by processes which stopped, pending again
+        """
+        if now is None:
+            now = time.time()
+
+        conn = self._connect()
+        try:
+            cursor = conn.execute("UPDATE notifications SET state = 'pending' "
+                                  "WHERE state = 'sending' AND next_attempt_time <= ?", (now,))
+            n_reclaimed = cursor.rowcount
+        finally:
+            conn.close()
+
+        if n_reclaimed > 0:
+            logger.warning("%s notifications claimed by stopped processes are pending again", n_reclaimed)
+        return n_reclaimed
+
+    def _set_state(self, notification_id, state, next_attempt_time=None, last_error=None):
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE notifications SET state = ?, next_attempt_time = COALESCE(?, next_attempt_time), "
+                         "last_error = ? WHERE id = ?",
+                         (state, next_attempt_time, last_error, notification_id))
+        finally:
+            conn.close()
+
+    def mark_sent(self, notification_id):
+        self._set_state(notification_id, 'sent')
+
+    def mark_retry(self, notification_id, delay_s, error):
+        self._set_state(notification_id, 'pending', next_attempt_time=time.time() + delay_s, last_error=error)
+
+    def mark_failed(self, notification_id, error):
+        self._set_state(notification_id, 'failed', last_error=error)
+
+    def list_notifications(self, job_id=None, state=None) -> list:
+        query = "SELECT * FROM notifications"
+        conditions = []
+        args = []
+        if job_id is not None:
+            conditions.append("job_id = ?")
+            args.append(job_id)
+        if state is not None:
+            conditions.append("state = ?")
+            args.append(state)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(query + " ORDER BY id", args).fetchall()
+        finally:
+            conn.close()
+
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    def queued_pending_notification_files(self) -> set:
+        """
+        returns the files standing in the ledger of the job index for the notifications still to be delivered
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT json_extract(payload, '$.pending_notification_file') AS pending_notification_file "
+                                "FROM notifications WHERE state IN ('pending', 'sending')").fetchall()
+        finally:
+            conn.close()
+
+        return {row['pending_notification_file'] for row in rows if row['pending_notification_file'] is not None}
+
+    def purge(self, older_than_s) -> int:
+        """
+        removes the notifications delivered, or given up, before the given age
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute("DELETE FROM notifications WHERE state IN ('sent', 'failed') AND created < ?",
+                                  (time.time() - older_than_s,))
+            n_purged = cursor.rowcount
+        finally:
+            conn.close()
+
+        if n_purged > 0:
+            logger.info("%s notifications delivered, or given up, purged from the outbox", n_purged)
+        return n_purged
+
+
+def job_monitor_file_name(record):
+    # the job monitor where the notification was recorded as queued, e.g. that of the node of an OsaJob callback
+    return record['payload'].get('job_monitor_file_name', 'job_monitor.json')
+
+
+def deliver_email_notification(config, record):
+    email_helper.deliver_job_email(config, logger, record['payload'], record['scratch_dir'], max_tries=1)
+    update_job_monitor(record['scratch_dir'],
+                       file_name=job_monitor_file_name(record),
+                       email_status='email sent',
+                       email_status_details=record['payload']['status_details'])
+
+
+def fail_email_notification(config, record, error):
+    # the email not sent is already stored by email_helper.send_email
+    update_job_monitor(record['scratch_dir'],
+                       file_name=job_monitor_file_name(record),
+                       email_status='sending email failed')
+
+
+def deliver_matrix_notification(config, record):
+    res_content = matrix_helper.deliver_job_message(config, logger, record['payload'], record['scratch_dir'])
+
+    matrix_message_status_details = {
+        "res_content": res_content
+    }
+    if record['payload']['status_details'] is not None:
+        matrix_message_status_details['status_details'] = record['payload']['status_details']
+
+    matrix_message_status = 'matrix message sent'
+    if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
+        matrix_message_status = 'sending message via matrix failed'
+
+    update_job_monitor(record['scratch_dir'],
+                       file_name=job_monitor_file_name(record),
+                       matrix_message_status=matrix_message_status,
+                       matrix_message_status_details=json.dumps(matrix_message_status_details))
+
+
+def fail_matrix_notification(config, record, error):
+    update_job_monitor(record['scratch_dir'],
+                       file_name=job_monitor_file_name(record),
+                       matrix_message_status='sending message via matrix failed',
+                       matrix_message_status_details=json.dumps({'error': error}))
+
+
+delivery_handlers = {
+    'email': (deliver_email_notification, fail_email_notification),
+    'matrix': (deliver_matrix_notification, fail_matrix_notification),
+}
+
+
+class NotificationWorkerPool:
+    """
+    background threads delivering the notifications of the outbox; they are started in the process which uses them,
+    so that each process forked by the server (e.g. gunicorn workers) has its own
+    """
+    def __init__(self, outbox, config, n_workers=2, max_attempts=5, retry_delay_s=10, poll_interval_s=5,
+                 retention_s=604800, purge_interval_s=3600, batch_size=20):
+        self.outbox = outbox
+        self.config = config
+        self.n_workers = n_workers
+        self.max_attempts = max_attempts
+        self.retry_delay_s = retry_delay_s
+        self.poll_interval_s = poll_interval_s
+        self.retention_s = retention_s
+        self.purge_interval_s = purge_interval_s
+        self.batch_size = batch_size
+
+        self._threads = []
+        self._pid = None
+        self._last_purge = 0
+        self._restart_after_fork = False
+        self._wake_up = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.outbox.outbox_path} ({self.n_workers} workers) ]"
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._threads = []
+                self._pid = os.getpid()
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            self._stop.clear()
+            while len(self._threads) < self.n_workers:
+                thread = threading.Thread(target=self._run,
+                                          name=f'notification-worker-{len(self._threads)}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def start(self):
+        """
+        starts the workers of this process, and of the processes forked from it, after making the notifications
+        left by stopped processes deliverable
+        """
+        self.outbox.reclaim_expired()
+        self.ensure_started()
+
+        with self._lock:
+            if not self._restart_after_fork:
+                os.register_at_fork(after_in_child=self._restart_in_child)
+                self._restart_after_fork = True
+
+    def _restart_in_child(self):
+        if self._stop.is_set():
+            return
+
+        # the threads of the parent are not running in the child, and its locks might have been held by them
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._threads = []
+        self.ensure_started()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake_up.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def enqueue(self, kind, scratch_dir, job_id, status, payload, sending_time=None, first_submitted_time=None) -> int:
+        if sending_time is not None:
+            # stands for the notification in the ledger of the job index, until it is delivered
+            pending_notification_file = f'{pending_notification_prefix}{kind}:{uuid.uuid4().hex}'
+            job_index.record_notification(scratch_dir, kind, status, pending_notification_file,
+                                          sending_time=sending_time,
+                                          first_submitted_time=first_submitted_time)
+            payload = dict(payload, pending_notification_file=pending_notification_file)
+
+        notification_id = self.outbox.enqueue(kind, scratch_dir, job_id, status, payload)
+        self.ensure_started()
+        self._wake_up.set()
+        return notification_id
+
+    def purge_if_due(self):
+        with self._lock:
+            if time.time() - self._last_purge < self.purge_interval_s:
+                return
+            self._last_purge = time.time()
+
+        self.outbox.purge(self.retention_s)
+        self.remove_delivered_pending_notifications()
+
+    def remove_delivered_pending_notifications(self, min_age_s=60) -> int:
+        """
+        removes from the ledger of the job index the pending notifications which are not in the outbox anymore,
+        e.g. delivered by the process of another host sharing the outbox; those recorded in the last min_age_s
+        seconds are kept, they might not be queued yet
+        """
+        queued_pending_notification_files = self.outbox.queued_pending_notification_files()
+        n_removed = 0
+        for notification in job_index.find_notifications_by_file_prefix(pending_notification_prefix,
+                                                                        sent_before=time.time() - min_age_s):
+            if notification['notification_file'] not in queued_pending_notification_files:
+                job_index.remove_notification(notification['notification_file'])
+                n_removed += 1
+
+        if n_removed > 0:
+            logger.info("%s pending notifications not in the outbox anymore removed from the job index", n_removed)
+        return n_removed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.purge_if_due()
+                delivered = self.deliver_batch() > 0
+            except Exception as e:
+                logger.exception("unexpected error in the notification worker: %s", repr(e))
+                delivered = False
+
+            if not delivered:
+                self._wake_up.wait(self.poll_interval_s)
+                self._wake_up.clear()
+
+    def deliver_batch(self) -> int:
+        """
+        delivers up to batch_size notifications due, sending their emails over a single connection to the SMTP server;
+        returns the number of notifications delivered, or given up
+        """
+        if self.config is None:
+            email_batch = contextlib.nullcontext()
+        else:
+            email_batch = get_smtp_connection_pool(self.config).batch()
+
+        n_delivered = 0
+        with email_batch:
+            while n_delivered < self.batch_size and not self._stop.is_set() and self.deliver_next():
+                n_delivered += 1
+
+        return n_delivered
+
+    def deliver_next(self) -> bool:
+        """
+        delivers the next notification due, returning False if there was none
+        """
+        record = self.outbox.claim()
+        if record is None:
+            return False
+
+        deliver, fail = delivery_handlers[record['kind']]
+        try:
+            deliver(self.config, record)
+        except Exception as e:
+            error = repr(e)
+            if record['attempts'] < self.max_attempts:
+                delay_s = self.retry_delay_s * 2 ** (record['attempts'] - 1)
+                logger.warning("delivery of the %s notification %s for job %s failed (attempt %s of %s), "
+                               "retrying in %s s: %s",
+                               record['kind'], record['id'], record['job_id'],
+                               record['attempts'], self.max_attempts, delay_s, error)
+                self.outbox.mark_retry(record['id'], delay_s, error)
+            else:
+                logger.error("delivery of the %s notification %s for job %s failed after %s attempts: %s",
+                             record['kind'], record['id'], record['job_id'], record['attempts'], error)
+                self.outbox.mark_failed(record['id'], error)
+                sentry.capture_message(f"delivery of the {record['kind']} notification for job {record['job_id']} "
+                                       f"failed after {record['attempts']} attempts: {error}")
+                try:
+                    fail(self.config, record, error)
+                except Exception as fail_e:
+                    logger.error("unable to record the failed delivery of the notification %s: %s",
+                                 record['id'], repr(fail_e))
+                self._remove_pending_notification(record)
+        else:
+            self.outbox.mark_sent(record['id'])
+            # replaced by the notification stored in the history of the job
+            self._remove_pending_notification(record)
+            logger.info("%s notification %s for job %s delivered", record['kind'], record['id'], record['job_id'])
+
+        return True
+
+    @staticmethod
+    def _remove_pending_notification(record):
+        pending_notification_file = record['payload'].get('pending_notification_file')
+        if pending_notification_file is not None:
+            job_index.remove_notification(pending_notification_file)
+
+
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+
+
+def get_notification_worker_pool(config) -> NotificationWorkerPool:
+    """
+    returns the worker pool delivering the notifications of the outbox set in the configuration
+    """
+    outbox_path = os.path.abspath(config.notification_outbox_path or default_outbox_path())
+    with _worker_pools_lock:
+        if outbox_path not in _worker_pools:
+            _worker_pools[outbox_path] = NotificationWorkerPool(
+                NotificationOutbox(outbox_path),
+                config,
+                n_workers=config.notification_outbox_workers,
+                max_attempts=config.notification_outbox_max_attempts,
+                retry_delay_s=config.notification_outbox_retry_delay_s,
+                retention_s=config.notification_outbox_retention_s)
+        return _worker_pools[outbox_path]
+
+
+def start_notification_workers(config) -> NotificationWorkerPool:
+    """
+    starts delivering the notifications of the outbox set in the configuration, in this process and the forked ones
+    """
+    worker_pool = get_notification_worker_pool(config)
+    worker_pool.start()
+    logger.info("notification workers started: %s", worker_pool)
+    return worker_pool
+
+
+def notification_times(rendered_notification) -> dict:
+    # as they will be recorded once the notification is delivered
+    sending_time = float(rendered_notification['sending_time'])
+    try:
+        first_submitted_time = float(rendered_notification['time_request'])
+    except (TypeError, ValueError):
+        first_submitted_time = sending_time
+
+    return dict(sending_time=sending_time, first_submitted_time=first_submitted_time)
+
+
+def enqueue_job_email(config, logger, job_id, scratch_dir, job_monitor_file_name='job_monitor.json', **render_kwargs) -> int:
+    """
+    renders the job email as email_helper.send_job_email would, and leaves its delivery to the workers,
+    which record its outcome in the job monitor job_monitor_file_name
+    """
+    rendered_email = email_helper.render_job_email(config, logger, job_id=job_id, scratch_dir=scratch_dir, **render_kwargs)
+    rendered_email['job_monitor_file_name'] = job_monitor_file_name
+    return get_notification_worker_pool(config).enqueue('email', scratch_dir, job_id, rendered_email['status'], rendered_email,
+                                                        **notification_times(rendered_email))
+
+
+def enqueue_job_message(config, logger, job_id, scratch_dir, job_monitor_file_name='job_monitor.json', **render_kwargs) -> int:
+    """
+    renders the job matrix message as matrix_helper.send_job_message would, and leaves its delivery to the workers,
+    which record its outcome in the job monitor job_monitor_file_name
+    """
+    rendered_message = matrix_helper.render_job_message(config, logger, job_id=job_id, scratch_dir=scratch_dir, **render_kwargs)
+    rendered_message['job_monitor_file_name'] = job_monitor_file_name
+    return get_notification_worker_pool(config).enqueue('matrix', scratch_dir, job_id, rendered_message['status'], rendered_message,
+                                                        **notification_times(rendered_message))
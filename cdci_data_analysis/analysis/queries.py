@@ -18,9 +18,7 @@ __author__ = "Andrea Tramacere"
 
 
 import logging
-import time as _time
 import json
-from collections import OrderedDict
 
 import decorator
 import traceback
@@ -47,6 +45,7 @@ from .parameters import (Parameter,
 from .products import SpectralFitProduct, QueryOutput, QueryProductList, ImageProduct
 from .io_helper import FilePath
 from .exceptions import RequestNotUnderstood, InternalError, ProductProcessingError
+from ..flask_app.tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -708,30 +707,27 @@ class ProductQuery(BaseQuery):
 
         logger.info(f'--> running query for {instrument.name} with config {config if config is not None else []}')
 
-        self._t_query_steps = OrderedDict()
-        self._t_query_steps['start'] = _time.time()
-
-        query_out = self.test_communication(instrument, job, query_type=query_type, logger=logger, config=config, sentry_dsn=sentry_dsn)
-        self._t_query_steps['after_test_communication'] = _time.time()
+        with span('query.test_communication'):
+            query_out = self.test_communication(instrument, job, query_type=query_type, logger=logger, config=config, sentry_dsn=sentry_dsn)
 
         input_prod_list=None
         if query_out.status_dictionary['status'] == 0:
-            query_out=self.test_has_products(instrument, job, query_type=query_type, logger=logger, config=config, scratch_dir=scratch_dir, sentry_dsn=sentry_dsn)
+            with span('query.test_has_products'):
+                query_out=self.test_has_products(instrument, job, query_type=query_type, logger=logger, config=config, scratch_dir=scratch_dir, sentry_dsn=sentry_dsn)
             input_prod_list=query_out.prod_dictionary['input_prod_list']
-            self._t_query_steps['after_test_has_products'] = _time.time()
 
         if query_out.status_dictionary['status'] == 0:
-            query_out = self.get_query_products(instrument,
-                                                job,
-                                                run_asynch,
-                                                query_type=query_type,
-                                                logger=logger,
-                                                config=config,
-                                                scratch_dir=scratch_dir,
-                                                sentry_dsn=sentry_dsn,
-                                                api=api,
-                                                return_progress=return_progress)
-            self._t_query_steps['after_get_query_products'] = _time.time()
+            with span('query.get_query_products'):
+                query_out = self.get_query_products(instrument,
+                                                    job,
+                                                    run_asynch,
+                                                    query_type=query_type,
+                                                    logger=logger,
+                                                    config=config,
+                                                    scratch_dir=scratch_dir,
+                                                    sentry_dsn=sentry_dsn,
+                                                    api=api,
+                                                    return_progress=return_progress)
 
         if query_out.status_dictionary['status'] == 0:
             if job.status != 'done' and not return_progress:
@@ -753,16 +749,16 @@ class ProductQuery(BaseQuery):
                         backend_warning = query_out.status_dictionary['warning']
                     else:
                         backend_warning=''
-                    query_out = self.process_query_product(instrument,
-                                                           job,
-                                                           logger=logger,
-                                                           config=config,
-                                                           sentry_dsn=sentry_dsn,
-                                                           api=api,
-                                                           return_progress=return_progress,
-                                                           backend_comment=backend_comment,
-                                                           backend_warning=backend_warning)
-                    self._t_query_steps['after_process_query_products'] = _time.time()
+                    with span('query.process_query_product'):
+                        query_out = self.process_query_product(instrument,
+                                                               job,
+                                                               logger=logger,
+                                                               config=config,
+                                                               sentry_dsn=sentry_dsn,
+                                                               api=api,
+                                                               return_progress=return_progress,
+                                                               backend_comment=backend_comment,
+                                                               backend_warning=backend_warning)
 
                     #print('-->', query_out.status_dictionary)
             #attach this at the end, anyhow
@@ -771,10 +767,6 @@ class ProductQuery(BaseQuery):
 
         print(f"\033[32mquery output, prod_dictionary keys {query_out.prod_dictionary.keys()}")
         print(f"query output, status_dictionary{query_out.status_dictionary}\033[0m")
-        
-        L = list(self._t_query_steps)
-        for s1, s2 in zip(L[:-1], L[1:]):
-            print(f"\033[33m {s1} - {s2} : {self._t_query_steps[s2] - self._t_query_steps[s1]:3.2g}\033[0m")
 
         return query_out
 
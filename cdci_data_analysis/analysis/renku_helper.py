@@ -1,11 +1,16 @@
 import os.path
 import re
+import time
+import uuid
+import fcntl
+import hashlib
 import tempfile
 import traceback
 import nbformat as nbf
 import shutil
 import giturlparse
 import copy
+from contextlib import contextmanager
 
 from git import Repo, Actor, RemoteProgress
 from configparser import ConfigParser
@@ -13,12 +18,15 @@ from configparser import ConfigParser
 from ..flask_app.sentry import sentry
 from ..app_logging import app_logging
 from .exceptions import RequestNotUnderstood
-from .email_helper import generate_products_url_from_par_dict
+from .email_helper import generate_products_url_from_par_dict, replace_api_code_token
 from .hash import make_hash
 
 logger = app_logging.getLogger('renku_helper')
 progress_logger = app_logging.getLogger('progress_git_commands_renku_helper')
 
+# worktrees of a mirror older than this are considered left by processes which stopped before removing them
+stale_worktree_age_s = 3600
+
 
 class MyProgressPrinter(RemoteProgress):
     def update(self, op_code, cur_count, max_count=None, message=""):
@@ -35,19 +43,26 @@ def push_api_code(api_code,
                   user_name=None,
                   user_email=None,
                   products_url=None,
-                  request_dict=None):
+                  request_dict=None,
+                  renku_repository_mirror_dir=None):
     error_message = 'Error while {step}\n{exception_message}'
     repo = None
     try:
-        step = 'cloning repository'
-        logger.info(step)
-        repo = clone_renku_repo(renku_gitlab_repository_url,
-                                renku_gitlab_ssh_key_path=renku_gitlab_ssh_key_path)
+        if renku_repository_mirror_dir is not None:
+            step = 'creating a worktree of the repository from its local mirror'
+            logger.info(step)
+            repo = create_renku_repo_worktree(renku_gitlab_repository_url,
+                                              renku_repository_mirror_dir,
+                                              renku_gitlab_ssh_key_path=renku_gitlab_ssh_key_path)
+        else:
+            step = 'cloning repository'
+            logger.info(step)
+            repo = clone_renku_repo(renku_gitlab_repository_url,
+                                    renku_gitlab_ssh_key_path=renku_gitlab_ssh_key_path)
 
         step = f'removing token from the api_code'
         logger.info(step)
-        token_pattern = r"[\'\"]token[\'\"]:\s*?[\'\"].*?[\'\"]"
-        api_code = re.sub(token_pattern, '"token": os.environ[\'ODA_TOKEN\'],', api_code, flags=re.DOTALL)
+        api_code = replace_api_code_token(api_code, '"token": os.environ[\'ODA_TOKEN\'],')
         api_code = "import os\n\n" + api_code
 
         step = 'creating new notebook with the api code'
@@ -160,6 +175,12 @@ def get_repo_local_path(repository_url):
     return tempfile.mkdtemp(prefix=get_repo_name(repository_url))    
 
 
+def get_git_env(renku_gitlab_ssh_key_path):
+    # TODO or store known hosts on build/boot
+    git_ssh_cmd = f'ssh -i {renku_gitlab_ssh_key_path} -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'
+    return dict(GIT_SSH_COMMAND=git_ssh_cmd)
+
+
 def clone_renku_repo(renku_repository_url, repo_dir=None, renku_gitlab_ssh_key_path=None):
     logger.info('clone_renku_repo with renku_repository_url=%s, repo_dir=%s, renku_gitlab_ssh_key_file=%s', renku_repository_url, repo_dir, renku_gitlab_ssh_key_path)
 
@@ -167,16 +188,117 @@ def clone_renku_repo(renku_repository_url, repo_dir=None, renku_gitlab_ssh_key_p
         repo_dir = get_repo_local_path(renku_repository_url)
         logger.info('constructing repo_dir=%s', repo_dir)
 
-    # TODO or store known hosts on build/boot
-    git_ssh_cmd = f'ssh -i {renku_gitlab_ssh_key_path} -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'
-
-    repo = Repo.clone_from(renku_repository_url, repo_dir, branch='master', env=dict(GIT_SSH_COMMAND=git_ssh_cmd), progress=MyProgressPrinter())
+    repo = Repo.clone_from(renku_repository_url, repo_dir, branch='master', env=get_git_env(renku_gitlab_ssh_key_path), progress=MyProgressPrinter())
 
     logger.info(f'repository {renku_repository_url} successfully cloned')
 
     return repo
 
 
+def get_repo_mirror_path(repository_url, mirror_dir):
+    url_hash = hashlib.sha256(repository_url.encode()).hexdigest()[:16]
+    return os.path.join(os.path.abspath(mirror_dir), f'{get_repo_name(repository_url)}_{url_hash}.git')
+
+
+@contextmanager
+def lock_repo_mirror(mirror_path):
+    # the mirror is shared by the threads and processes of the dispatcher, only one of them updates it at a time
+    with open(mirror_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def create_renku_repo_worktree(renku_repository_url, mirror_dir, renku_gitlab_ssh_key_path=None):
+    """
+    returns a new worktree of the master branch of the repository, created from a bare mirror of the repository,
+    kept in mirror_dir and fetched incrementally, instead of cloning the whole repository;
+    mirror_dir should be on the local disk of the host, rather than on NFS
+    """
+    logger.info('create_renku_repo_worktree with renku_repository_url=%s, mirror_dir=%s, renku_gitlab_ssh_key_file=%s', renku_repository_url, mirror_dir, renku_gitlab_ssh_key_path)
+
+    git_env = get_git_env(renku_gitlab_ssh_key_path)
+    mirror_path = get_repo_mirror_path(renku_repository_url, mirror_dir)
+    os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+
+    with lock_repo_mirror(mirror_path):
+        if os.path.exists(os.path.join(mirror_path, 'HEAD')):
+            mirror = Repo(mirror_path)
+        else:
+            logger.info('creating the mirror %s of the repository %s', mirror_path, renku_repository_url)
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            mirror = Repo.init(mirror_path, bare=True)
+            mirror.create_remote('origin', renku_repository_url)
+        mirror.git.update_environment(**git_env)
+
+        mirror.git.fetch('--prune', 'origin')
+        logger.info(f'mirror {mirror_path} of the repository {renku_repository_url} successfully fetched')
+
+        remove_stale_worktrees(mirror)
+
+        # the worktrees are kept next to the mirror, where all the processes sharing it see them
+        worktrees_dir = mirror_path + '.worktrees'
+        os.makedirs(worktrees_dir, exist_ok=True)
+        repo_dir = tempfile.mkdtemp(prefix=get_repo_name(renku_repository_url), dir=worktrees_dir)
+        mirror.git.worktree('add', '--detach', repo_dir, 'origin/master')
+        logger.info('worktree repo_dir=%s created', repo_dir)
+
+    repo = Repo(repo_dir)
+    repo.git.update_environment(**git_env)
+
+    return repo
+
+
+def remove_stale_worktrees(mirror):
+    """
+    removes the worktrees, and the local branches, left by processes which stopped before removing them;
+    to be called holding the lock of the mirror
+    """
+    mirror.git.worktree('prune')
+
+    checked_out_branches = set()
+    for worktree_entry in mirror.git.worktree('list', '--porcelain').split('\n\n'):
+        worktree_info = dict(line.split(' ', 1) if ' ' in line else (line, None)
+                             for line in worktree_entry.splitlines())
+        worktree_path = worktree_info.get('worktree')
+        if worktree_path is None or 'bare' in worktree_info:
+            continue
+
+        if time.time() - os.path.getmtime(worktree_path) > stale_worktree_age_s:
+            logger.warning('removing the stale worktree %s of the mirror %s', worktree_path, mirror.git_dir)
+            try:
+                mirror.git.worktree('remove', '--force', worktree_path)
+                continue
+            except Exception as e:
+                logger.error(f'unable to remove the stale worktree {worktree_path} !\n{e}')
+
+        if worktree_info.get('branch') is not None:
+            checked_out_branches.add(worktree_info['branch'])
+
+    for head in mirror.heads:
+        if head.path not in checked_out_branches:
+            logger.warning('removing the stale branch %s of the mirror %s', head.name, mirror.git_dir)
+            mirror.git.branch('-D', head.name)
+
+
+def remove_repo_worktree(repo, renku_repository_url):
+    mirror_path = os.path.abspath(repo.common_dir)
+    mirror = Repo(mirror_path)
+    repo_working_dir_path = repo.working_dir
+    branch_name = None if repo.head.is_detached else repo.active_branch.name
+
+    logger.info('removing the worktree repo_working_dir_path=%s created for renku_repository_url=%s', repo_working_dir_path, renku_repository_url)
+    with lock_repo_mirror(mirror_path):
+        try:
+            mirror.git.worktree('remove', '--force', repo_working_dir_path)
+            if branch_name is not None:
+                mirror.git.branch('-D', branch_name)
+        except Exception as e:
+            logger.error(f'unable to remove the worktree repo_working_dir_path={repo_working_dir_path} !\n{e}')
+
+
 def get_list_remote_branches_repo(repo):
 
     list_branches = repo.git.branch("-ar", "--format=%(refname:short)").split("\n")
@@ -208,10 +330,24 @@ def get_branch_name(job_id=None, notebook_hash=None, renku_ini_hash=None):
     return branch_name
 
 
+def get_local_branch_name(repo, branch_name):
+    # the local branches are shared by the worktrees of a mirror, and several of them might push the same branch
+    if os.path.abspath(repo.git_dir) != os.path.abspath(repo.common_dir):
+        return f'{branch_name}_{uuid.uuid4().hex[:8]}'
+    return branch_name
+
+
 def checkout_branch_renku_repo(repo, branch_name, pull=False):
-    repo.git.checkout('-b', branch_name)
+    local_branch_name = get_local_branch_name(repo, branch_name)
+    repo.git.checkout('-B', local_branch_name)
+    if local_branch_name != branch_name:
+        # the local branch tracks branch_name in the repository, whatever its own name;
+        # the configuration is shared by the worktrees of the mirror, and only written holding its lock
+        with lock_repo_mirror(os.path.abspath(repo.common_dir)):
+            repo.git.config(f'branch.{local_branch_name}.remote', repo.remote().name)
+            repo.git.config(f'branch.{local_branch_name}.merge', f'refs/heads/{branch_name}')
     if pull:
-        repo.git.pull("--set-upstream", repo.remote().name, str(repo.head.ref))
+        repo.git.pull(repo.remote().name, branch_name)
         logger.info("pull operation complete")
 
     return repo
@@ -245,7 +381,10 @@ def add_commit_push(repo, commit_msg, files_path_to_add, user_name=None, user_em
     repo.remote(name="origin")
     # TODO make it work with methods from GitPython
     # e.g. push_info = origin.push(refspec='origin:' + str(repo.head.ref))
-    repo.git.push("--set-upstream", repo.remote().name, str(repo.head.ref))
+    tracking_branch = repo.head.ref.tracking_branch()
+    remote_branch_name = str(repo.head.ref) if tracking_branch is None else tracking_branch.remote_head
+    # the upstream is not set, it would write the configuration shared by the worktrees of a mirror
+    repo.git.push(repo.remote().name, f'{repo.head.ref}:refs/heads/{remote_branch_name}')
 
     return commit_info
 
@@ -371,6 +510,9 @@ def commit_and_push_notebook_file(repo, file_path, user_name=None, user_email=No
 def remove_repository(repo, renku_repository_url):
     repo_working_dir_path = None
     if repo is not None:
+        if os.path.abspath(repo.git_dir) != os.path.abspath(repo.common_dir):
+            remove_repo_worktree(repo, renku_repository_url)
+            return
         repo_working_dir_path = repo.working_dir
 
     if repo_working_dir_path is not None and os.path.exists(repo_working_dir_path):
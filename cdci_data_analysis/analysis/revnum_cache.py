@@ -0,0 +1,101 @@
+"""
+Cache of the conversions of times to INTEGRAL revolution numbers.
+
+The revolution number of a past time never changes, so each conversion done by the timesystem service is kept in
+memory by the process, with a bounded number of entries, and optionally in a SQLite database shared by the
+dispatcher processes and kept across restarts.
+"""
+
+import sqlite3
+import logging
+import threading
+import typing
+from collections import OrderedDict, Counter
+
+from .local_sqlite import LocalDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class RevnumCache:
+    def __init__(self, cache_path=None, max_entries=4096):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.counters = Counter()
+
+        self._entries = OrderedDict()
+        self._database = LocalDatabase(self._initialize)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {len(self._entries)} entries, {self.cache_path} ]"
+
+    def configure(self, cache_path, max_entries):
+        with self._lock:
+            self.cache_path = cache_path
+            self.max_entries = max_entries
+            self._entries.clear()
+            self._database.reset()
+
+    @staticmethod
+    def _initialize(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS revnums ("
+                     "service_url TEXT NOT NULL, "
+                     "time TEXT NOT NULL, "
+                     "revnum INTEGER NOT NULL, "
+                     "PRIMARY KEY (service_url, time))")
+
+    def _connect(self):
+        return self._database.connect(self.cache_path)
+
+    def _remember(self, key, revnum):
+        with self._lock:
+            self._entries[key] = revnum
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, service_url, time_to_convert) -> typing.Union[int, None]:
+        key = (service_url, time_to_convert)
+        with self._lock:
+            revnum = self._entries.get(key)
+            if revnum is not None:
+                self._entries.move_to_end(key)
+
+        if revnum is None and self.cache_path is not None:
+            try:
+                conn = self._connect()
+                try:
+                    row = conn.execute("SELECT revnum FROM revnums WHERE service_url = ? AND time = ?",
+                                       key).fetchone()
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.warning("unable to read the revnum cache %s: %s", self.cache_path, repr(e))
+                row = None
+
+            if row is not None:
+                revnum = row[0]
+                self._remember(key, revnum)
+
+        self.counters['hits' if revnum is not None else 'misses'] += 1
+        return revnum
+
+    def store(self, service_url, time_to_convert, revnum):
+        key = (service_url, time_to_convert)
+        self._remember(key, revnum)
+
+        if self.cache_path is not None:
+            try:
+                conn = self._connect()
+                try:
+                    conn.execute("INSERT OR REPLACE INTO revnums (service_url, time, revnum) VALUES (?, ?, ?)",
+                                 (service_url, time_to_convert, revnum))
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.warning("unable to store the revnum of %s in the cache %s: %s",
+                               time_to_convert, self.cache_path, repr(e))
+
+    def stats(self) -> dict:
+        return dict(hits=self.counters['hits'], misses=self.counters['misses'], entries=len(self._entries))
@@ -0,0 +1,214 @@
+"""
+Pool of the connections to the SMTP server used to send the emails.
+
+Opening a connection costs a TCP handshake, STARTTLS and a login, which is more than sending the email itself,
+and bursts of callbacks for many jobs would open as many connections to the relay. The connections are instead kept
+open after use, checked with a NOOP before being used again, and replaced when the server closed them.
+Several emails can also be sent in a batch, over a single connection held by the thread for the whole batch, without
+returning it to the pool, nor checking it, between them (see SMTPConnectionPool.batch).
+
+Each process (e.g. each gunicorn worker) has its own connections, and its own TLS context.
+"""
+
+import os
+import time
+import ssl
+import smtplib
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+_tls_context = None
+_tls_context_pid = None
+
+
+def get_tls_context() -> ssl.SSLContext:
+    global _tls_context, _tls_context_pid
+
+    if _tls_context is None or _tls_context_pid != os.getpid():
+        _tls_context = ssl.create_default_context()
+        _tls_context_pid = os.getpid()
+
+    return _tls_context
+
+
+class SMTPConnectionPool:
+    def __init__(self,
+                 smtp_server,
+                 smtp_port,
+                 sender_email_address,
+                 smtp_server_password,
+                 max_idle_connections=2,
+                 max_idle_time_s=60):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.sender_email_address = sender_email_address
+        self.smtp_server_password = smtp_server_password
+        self.max_idle_connections = max_idle_connections
+        self.max_idle_time_s = max_idle_time_s
+
+        self._idle = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._batch = threading.local()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.smtp_server}:{self.smtp_port} ({len(self._idle)} idle connections) ]"
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        try:
+            # just for testing purposes, not ssl is established
+            if self.smtp_server != "localhost":
+                try:
+                    server.starttls(context=get_tls_context())
+                except Exception as e:
+                    logger.warning(f'unable to start TLS: {e}')
+            if self.smtp_server_password is not None and self.smtp_server_password != '':
+                server.login(self.sender_email_address, self.smtp_server_password)
+        except Exception:
+            self.discard(server)
+            raise
+
+        logger.info("new connection to the smtp server %s:%s", self.smtp_server, self.smtp_port)
+        return server
+
+    @staticmethod
+    def _is_alive(server) -> bool:
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self) -> smtplib.SMTP:
+        """
+        returns a connection to the smtp server, for the exclusive use of the caller until it is released
+        """
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # the connections of the parent process are not ours to use
+                    self._idle = []
+                    self._pid = os.getpid()
+
+                if not self._idle:
+                    break
+                server, released_time = self._idle.pop()
+
+            if time.time() - released_time > self.max_idle_time_s or not self._is_alive(server):
+                self.discard(server)
+                continue
+
+            return server
+
+        return self._connect()
+
+    def release(self, server):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.max_idle_connections:
+                self._idle.append((server, time.time()))
+                return
+
+        self.discard(server)
+
+    @staticmethod
+    def discard(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        provides a connection to send an email; the connection is returned to the pool afterwards, unless an error
+        occurred, so that the next email reuses it
+
+        within a batch of the same thread, the connection of the batch is provided instead, and kept for the next email
+        """
+        if getattr(self._batch, 'active', False):
+            if self._batch.server is None:
+                self._batch.server = self.acquire()
+            server = self._batch.server
+            try:
+                yield server
+            except Exception:
+                # the next email of the batch opens a new connection
+                self._batch.server = None
+                self.discard(server)
+                raise
+            return
+
+        server = self.acquire()
+        try:
+            yield server
+        except Exception:
+            self.discard(server)
+            raise
+        else:
+            self.release(server)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        sends all the emails of the sessions opened by this thread within the batch over a single connection, which is
+        only taken from the pool by the first of them, and returned to it at the end of the batch
+        """
+        if getattr(self._batch, 'active', False):
+            # nested in another batch of the thread
+            yield self
+            return
+
+        self._batch.active = True
+        self._batch.server = None
+        try:
+            yield self
+        finally:
+            server = self._batch.server
+            self._batch.active = False
+            self._batch.server = None
+            if server is not None:
+                self.release(server)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+
+        for server, _ in idle:
+            self.discard(server)
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_smtp_connection_pool(config, sender_email_address=None) -> SMTPConnectionPool:
+    """
+    returns the connection pool for the smtp server of the configuration; with smtp_connection_pool_size set to 0,
+    the connections are closed after each use
+    """
+    if sender_email_address is None:
+        sender_email_address = config.sender_email_address
+
+    key = (config.smtp_server,
+           config.smtp_port,
+           sender_email_address,
+           config.smtp_server_password,
+           config.smtp_connection_pool_size,
+           config.smtp_connection_max_idle_s)
+
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = SMTPConnectionPool(config.smtp_server,
+                                                        config.smtp_port,
+                                                        sender_email_address,
+                                                        config.smtp_server_password,
+                                                        max_idle_connections=config.smtp_connection_pool_size,
+                                                        max_idle_time_s=config.smtp_connection_max_idle_s)
+        return _connection_pools[key]
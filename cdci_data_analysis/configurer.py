@@ -8,11 +8,13 @@ from typing import Union, List
 
 import sys
 import os
+import tempfile
 import logging
 
 from typing import List, Union
 from cdci_data_analysis import conf_dir
 from cdci_data_analysis.analysis.io_helper import FilePath
+from cdci_data_analysis.analysis.name_resolver_cache import default_cache_path as default_name_resolver_cache_path
 import yaml
 
 __author__ = "Andrea Tramacere"
@@ -269,6 +271,39 @@ class ConfigEnv(object):
                                      disp_dict.get('renku_options', {}).get('renku_gitlab_repository_url', None),
                                      disp_dict.get('renku_options', {}).get('renku_base_project_url', None),
                                      disp_dict.get('renku_options', {}).get('ssh_key_path', None),
+                                     disp_dict.get('download_options', {}).get('download_cache_dir', '.download_cache'),
+                                     disp_dict.get('download_options', {}).get('download_cache_max_size_mb', 1024),
+                                     disp_dict.get('upload_options', {}).get('upload_hash_algorithm', 'md5'),
+                                     disp_dict.get('upload_options', {}).get('upload_hash_chunk_size', 1048576),
+                                     disp_dict.get('job_id_hash_mode', 'legacy'),
+                                     disp_dict.get('reuse_instrument_templates', False),
+                                     disp_dict.get('notification_outbox_options', {}).get('notification_outbox_enabled', False),
+                                     disp_dict.get('notification_outbox_options', {}).get('notification_outbox_path', None),
+                                     disp_dict.get('notification_outbox_options', {}).get('notification_outbox_workers', 2),
+                                     disp_dict.get('notification_outbox_options', {}).get('notification_outbox_max_attempts', 5),
+                                     disp_dict.get('notification_outbox_options', {}).get('notification_outbox_retry_delay_s', 10),
+                                     disp_dict['email_options'].get('smtp_connection_pool_size', 2),
+                                     disp_dict['email_options'].get('smtp_connection_max_idle_s', 60),
+                                     disp_dict.get('product_gallery_options', {}).get('gallery_lookup_cache_ttl_s', 300),
+                                     disp_dict.get('product_gallery_options', {}).get('gallery_lookup_cache_max_entries', 1024),
+                                     disp_dict.get('product_gallery_options', {}).get('gallery_upload_max_workers', 4),
+                                     disp_dict.get('product_gallery_options', {}).get('name_resolver_cache_path', default_name_resolver_cache_path()),
+                                     disp_dict.get('product_gallery_options', {}).get('name_resolver_cache_positive_ttl_s', 604800),
+                                     disp_dict.get('product_gallery_options', {}).get('name_resolver_cache_negative_ttl_s', 3600),
+                                     disp_dict.get('product_gallery_options', {}).get('revnum_cache_path', None),
+                                     disp_dict.get('product_gallery_options', {}).get('revnum_cache_max_entries', 4096),
+                                     disp_dict.get('renku_options', {}).get('renku_repository_mirror_dir', os.path.join(tempfile.gettempdir(), 'dispatcher-renku-mirrors')),
+                                     disp_dict.get('logstash_options', {}).get('logstash_queue_size', 1000),
+                                     disp_dict.get('logstash_options', {}).get('logstash_batch_size', 100),
+                                     disp_dict.get('sentry_capture_window_s', 60),
+                                     disp_dict.get('sentry_capture_max_messages', 20),
+                                     disp_dict.get('logstash_options', {}).get('request_summary_max_field_length', 1000),
+                                     disp_dict.get('tracing_options', {}).get('server_timing', True),
+                                     disp_dict.get('tracing_options', {}).get('opentelemetry_spans', False),
+                                     disp_dict.get('metrics_options', {}).get('metrics_path', None),
+                                     disp_dict.get('metrics_options', {}).get('metrics_flush_interval_s', 1),
+                                     disp_dict.get('notification_outbox_options', {}).get('notification_outbox_retention_s', 604800),
+                                     disp_dict.get('logstash_options', {}).get('logstash_codec', 'json'),
                                      )
 
         # not used?
@@ -348,6 +383,39 @@ class ConfigEnv(object):
                             renku_gitlab_repository_url,
                             renku_base_project_url,
                             renku_gitlab_ssh_key_path,
+                            download_cache_dir,
+                            download_cache_max_size_mb,
+                            upload_hash_algorithm,
+                            upload_hash_chunk_size,
+                            job_id_hash_mode,
+                            reuse_instrument_templates,
+                            notification_outbox_enabled,
+                            notification_outbox_path,
+                            notification_outbox_workers,
+                            notification_outbox_max_attempts,
+                            notification_outbox_retry_delay_s,
+                            smtp_connection_pool_size,
+                            smtp_connection_max_idle_s,
+                            gallery_lookup_cache_ttl_s,
+                            gallery_lookup_cache_max_entries,
+                            gallery_upload_max_workers,
+                            name_resolver_cache_path,
+                            name_resolver_cache_positive_ttl_s,
+                            name_resolver_cache_negative_ttl_s,
+                            revnum_cache_path,
+                            revnum_cache_max_entries,
+                            renku_repository_mirror_dir,
+                            logstash_queue_size,
+                            logstash_batch_size,
+                            sentry_capture_window_s,
+                            sentry_capture_max_messages,
+                            request_summary_max_field_length,
+                            server_timing,
+                            opentelemetry_spans,
+                            metrics_path,
+                            metrics_flush_interval_s,
+                            notification_outbox_retention_s,
+                            logstash_codec,
                             ):
         # Generic to dispatcher
         #print(dispatcher_url, dispatcher_port)
@@ -400,6 +468,39 @@ class ConfigEnv(object):
         self.renku_gitlab_repository_url = renku_gitlab_repository_url
         self.renku_gitlab_ssh_key_path = renku_gitlab_ssh_key_path
         self.renku_base_project_url = renku_base_project_url
+        self.download_cache_dir = download_cache_dir
+        self.download_cache_max_size_mb = download_cache_max_size_mb
+        self.upload_hash_algorithm = upload_hash_algorithm
+        self.upload_hash_chunk_size = upload_hash_chunk_size
+        self.job_id_hash_mode = job_id_hash_mode
+        self.reuse_instrument_templates = reuse_instrument_templates
+        self.notification_outbox_enabled = notification_outbox_enabled
+        self.notification_outbox_path = notification_outbox_path
+        self.notification_outbox_workers = notification_outbox_workers
+        self.notification_outbox_max_attempts = notification_outbox_max_attempts
+        self.notification_outbox_retry_delay_s = notification_outbox_retry_delay_s
+        self.smtp_connection_pool_size = smtp_connection_pool_size
+        self.smtp_connection_max_idle_s = smtp_connection_max_idle_s
+        self.gallery_lookup_cache_ttl_s = gallery_lookup_cache_ttl_s
+        self.gallery_lookup_cache_max_entries = gallery_lookup_cache_max_entries
+        self.gallery_upload_max_workers = gallery_upload_max_workers
+        self.name_resolver_cache_path = name_resolver_cache_path
+        self.name_resolver_cache_positive_ttl_s = name_resolver_cache_positive_ttl_s
+        self.name_resolver_cache_negative_ttl_s = name_resolver_cache_negative_ttl_s
+        self.revnum_cache_path = revnum_cache_path
+        self.revnum_cache_max_entries = revnum_cache_max_entries
+        self.renku_repository_mirror_dir = renku_repository_mirror_dir
+        self.logstash_queue_size = logstash_queue_size
+        self.logstash_batch_size = logstash_batch_size
+        self.sentry_capture_window_s = sentry_capture_window_s
+        self.sentry_capture_max_messages = sentry_capture_max_messages
+        self.request_summary_max_field_length = request_summary_max_field_length
+        self.server_timing = server_timing
+        self.opentelemetry_spans = opentelemetry_spans
+        self.metrics_path = metrics_path
+        self.metrics_flush_interval_s = metrics_flush_interval_s
+        self.notification_outbox_retention_s = notification_outbox_retention_s
+        self.logstash_codec = logstash_codec
 
     def get_data_serve_conf(self, instr_name):
         if instr_name in self.data_server_conf_dict.keys():
@@ -5,7 +5,6 @@ Created on Wed May 10 10:55:20 2017
 
 @author: Andrea Tramcere, Volodymyr Savchenko
 """
-import glob
 import string
 import random
 import hashlib
@@ -29,8 +28,11 @@ from flask_restx import Api, Resource
 import time as _time
 from urllib.parse import urlencode, urlparse
 
-from cdci_data_analysis.analysis import drupal_helper, tokenHelper, renku_helper, email_helper, matrix_helper
+from cdci_data_analysis.analysis import drupal_helper, tokenHelper, renku_helper, email_helper, matrix_helper, \
+    name_resolver_cache, notification_outbox
 from .logstash import logstash_message
+from . import tracing
+from .metrics import metrics, default_metrics_path
 from .schemas import QueryOutJSON, dispatcher_strict_validate
 from marshmallow.exceptions import ValidationError
 
@@ -38,7 +40,9 @@ from ..plugins import importer
 
 from ..analysis.queries import *
 from ..analysis.io_helper import FitsFile
+from ..analysis.job_index import job_index
 from .dispatcher_query import InstrumentQueryBackEnd
+from .meta_data_cache import meta_data_cache, meta_data_response
 from ..analysis.exceptions import APIerror, MissingRequestParameter
 from ..app_logging import app_logging
 
@@ -51,7 +55,6 @@ from oda_api.api import DispatcherAPI
 from oda_api.plot_tools_utils import Image
 
 from cdci_data_analysis.configurer import ConfigEnv
-from cdci_data_analysis.timer import block_timer
 
 logger = app_logging.getLogger('flask_app')
 
@@ -76,10 +79,39 @@ ns_conf = api.namespace('api/v1.0/oda', description='api')
 def before_request():
     g.request_start_time = _time.time()
 
+
+@app.after_request
+def add_server_timing(response):
+    if getattr(app.config.get('conf'), 'server_timing', False):
+        total_s = None
+        if g.get('request_start_time') is not None:
+            total_s = _time.time() - g.request_start_time
+        response.headers['Server-Timing'] = tracing.server_timing_header(tracing.request_spans(), total_s=total_s)
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    # the rule, rather than the path, keeps the number of endpoints bounded
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.inc('dispatcher_requests_total',
+                dict(endpoint=endpoint, method=request.method, status_code=response.status_code))
+    if g.get('request_start_time') is not None:
+        metrics.observe('dispatcher_request_duration_seconds',
+                        _time.time() - g.request_start_time,
+                        dict(endpoint=endpoint))
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/reload-plugin/<name>')
 def reload_plugin(name):
     try:
         importer.reload_plugin(name)
+        meta_data_cache.clear()
         return f'Plugin {name} reloaded\n'
     except ModuleNotFoundError as e:
         return f'Plugin {name} not found\n', 400
@@ -87,8 +119,8 @@ def reload_plugin(name):
     
 @app.route("/api/meta-data")
 def run_api_meta_data():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_meta_data()
+    return meta_data_response(app, 'meta-data',
+                              lambda: InstrumentQueryBackEnd(app, get_meta_data=True).get_meta_data())
 
 
 @app.route("/api/parameters")
@@ -121,14 +153,14 @@ def run_api_instr_list():
 
 @app.route('/meta-data')
 def meta_data():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_meta_data()
+    return meta_data_response(app, 'meta-data',
+                              lambda: InstrumentQueryBackEnd(app, get_meta_data=True).get_meta_data())
 
 
 @app.route('/api/par-names')
 def get_api_par_names():
-    query = InstrumentQueryBackEnd(app, get_meta_data=True)
-    return query.get_api_par_names()
+    return meta_data_response(app, 'par-names',
+                              lambda: InstrumentQueryBackEnd(app, get_meta_data=True).get_api_par_names())
 
 
 @app.route('/check_satus')
@@ -245,17 +277,7 @@ def common_exception_payload():
     payload['cdci_data_analysis_version_details'] = os.getenv('DISPATCHER_VERSION_DETAILS', 'unknown')
     payload['oda_api_version'] = oda_api.__version__
     
-    with block_timer(logger=logger, 
-                     message_template="Instrument factory iteration took {:.1f} seconds"): 
-        _l = []
-        for instrument_factory in importer.instrument_factory_iter:
-            if hasattr(instrument_factory, 'instr_name'):
-                iname = instrument_factory.instr_name
-            else:
-                iname = instrument_factory().name
-            _l.append(str(iname))
-
-    payload['installed_instruments'] = _l
+    payload['installed_instruments'] = [str(iname) for iname in importer.instrument_factory_iter.instrument_names]
 
     payload['debug_mode'] = os.environ.get(
         'DISPATCHER_DEBUG_MODE', 'no')  # change the default
@@ -334,7 +356,7 @@ def inspect_state():
     if output_code is not None:
         return make_response(output, output_code)
     state_data_obj = InstrumentQueryBackEnd.inspect_state()
-    return jsonify(dict(records=state_data_obj['records']))
+    return jsonify(state_data_obj)
 
 
 @app.route('/instr-list')
@@ -369,8 +391,7 @@ def push_renku_branch():
         # TODO check job_id is provided with the request
         job_id = par_dic.pop('job_id')
         # Get the API code to push to the new renku branch
-        scratch_dir_pattern = f'scratch_sid_*_jid_{job_id}*'
-        list_scratch_folders = glob.glob(scratch_dir_pattern)
+        list_scratch_folders = job_index.find_scratch_dirs(job_id)
         if len(list_scratch_folders) >= 1:
             analysis_parameters_content_original = None
             for scratch_folder in list_scratch_folders:
@@ -393,6 +414,7 @@ def push_renku_branch():
         renku_gitlab_repository_url = app_config.renku_gitlab_repository_url
         renku_gitlab_ssh_key_path = app_config.renku_gitlab_ssh_key_path
         renku_base_project_url = app_config.renku_base_project_url
+        renku_repository_mirror_dir = app_config.renku_repository_mirror_dir
         products_url = app_config.products_url
 
         renku_logger = logger.getChild('push_renku_branch')
@@ -410,7 +432,8 @@ def push_renku_branch():
                                                   renku_gitlab_ssh_key_path=renku_gitlab_ssh_key_path,
                                                   user_name=user_name, user_email=user_email,
                                                   products_url=products_url,
-                                                  request_dict=analysis_parameters_content_original)
+                                                  request_dict=analysis_parameters_content_original,
+                                                  renku_repository_mirror_dir=renku_repository_mirror_dir)
 
         return api_code_url
 
@@ -471,7 +494,7 @@ def run_analysis():
             'client-name', 'unknown'), _time.time() - t0)
 
         logger.info("towards log_run_query_result")
-        log_run_query_result(request_summary, r[0])
+        log_run_query_result(request_summary, r[0], query.response_summary)
 
         return r
 
@@ -651,7 +674,8 @@ def resolve_name():
                                                 external_name_resolver_url=external_name_resolver_url,
                                                 entities_portal_url=entities_portal_url,
                                                 name=name,
-                                                sentry_dsn=sentry_dsn)
+                                                sentry_dsn=sentry_dsn,
+                                                resolver_cache=name_resolver_cache.get_name_resolver_cache(app_config))
 
     return resolve_object
 
@@ -665,9 +689,16 @@ def get_revnum():
     app_config = app.config.get('conf')
 
     time_to_convert = par_dic.get('time_to_convert', None)
+    # several comma-separated times, converted together
+    times_to_convert = par_dic.get('times_to_convert', None)
 
     converttime_revnum_service_url = app_config.converttime_revnum_service_url
 
+    if times_to_convert is not None:
+        times_to_convert = [t.strip() for t in times_to_convert.split(',') if t.strip() != '']
+        revnums = drupal_helper.get_revnums(service_url=converttime_revnum_service_url, times_to_convert=times_to_convert)
+        return dict(revnums=revnums)
+
     resolve_object = drupal_helper.get_revnum(service_url=converttime_revnum_service_url, time_to_convert=time_to_convert)
 
     return resolve_object
@@ -1311,6 +1342,15 @@ def conf_app(conf):
                                         set_by=f'command line {__file__}:{__name__}')
 
     app.config['conf'] = conf
+    drupal_helper.gallery_lookup_cache.configure(ttl_s=conf.gallery_lookup_cache_ttl_s,
+                                                 max_entries=conf.gallery_lookup_cache_max_entries)
+    drupal_helper.revnum_cache.configure(cache_path=conf.revnum_cache_path,
+                                         max_entries=conf.revnum_cache_max_entries)
+    tracing.configure(opentelemetry_spans=conf.opentelemetry_spans)
+    metrics.configure(metrics_path=conf.metrics_path if conf.metrics_path is not None else default_metrics_path(),
+                      flush_interval_s=conf.metrics_flush_interval_s)
+    if conf.notification_outbox_enabled:
+        notification_outbox.start_notification_workers(conf)
     if getattr(conf, 'sentry_url', None) is not None:
         sentry = Sentry(app, dsn=conf.sentry_url)
         logger.warning("sentry not used")
@@ -1326,6 +1366,18 @@ def run_app(conf, debug=False, threaded=False):
             debug=debug, threaded=threaded)
 
 
+def truncate_request_value(value, max_length):
+    if isinstance(value, bytes):
+        value = value[:max_length + 1].decode(errors='replace')
+    if isinstance(value, str) and len(value) > max_length:
+        return value[:max_length] + f'... [truncated to {max_length} characters]'
+    return value
+
+
+def truncate_request_values(values, max_length):
+    return {key: truncate_request_value(value, max_length) for key, value in values.items()}
+
+
 def log_run_query_request():
     request_summary = {}
 
@@ -1339,19 +1391,21 @@ def log_run_query_request():
         if request_json is None:
             request_json = {}
 
+        max_length = app.config['conf'].request_summary_max_field_length
+
         logger.debug("output json request")
         logger.debug("request.args: %s", request.args)
         logger.debug("request.host: %s", request.host)
-        request_summary['dispatcher-state'] = 'requested'
+        # the large values, like user catalogs or raw uploaded data, are truncated
         request_summary = {'origin': 'dispatcher-run-analysis',
                      'request-data': {
-                        'headers': dict(request.headers),
+                        'headers': truncate_request_values(request.headers, max_length),
                         'host_url': request.host_url,
                         'host': request.host,
-                        'args': dict(request.args),
-                        'json-data': dict(request_json),
-                        'form-data': dict(request.form or {}),
-                        'raw-data': dict(request.data or ""),
+                        'args': truncate_request_values(request.args, max_length),
+                        'json-data': truncate_request_values(request_json, max_length),
+                        'form-data': truncate_request_values(request.form or {}, max_length),
+                        'raw-data': truncate_request_value(request.data or "", max_length),
                     }}
 
         try:
@@ -1360,34 +1414,39 @@ def log_run_query_request():
         except Exception as e:
             logger.warning("unable to extract client")
 
+        # encoded once, for the log and for logstash
         request_summary_json = json.dumps(request_summary)
         logger.info("request_summary: %s", request_summary_json)
         logstash_message(app, request_summary_json)
     except Exception as e:
-        logger.error("failed to logstash request in log_run_query_request: %s\n%s", repr(e), traceback.format_exception())
+        logger.error("failed to logstash request in log_run_query_request: %s\n%s", repr(e), traceback.format_exc())
         raise
 
     return request_summary
     
 
-def log_run_query_result(request_summary, result):
+def log_run_query_result(request_summary, result, response_summary=None):
     logger.info("IN log_run_query_result")
     try:
-        request_summary['dispatcher-state'] = 'returning'
+        request_summary = {**request_summary, 'dispatcher-state': 'returning'}
 
-        logger.info("returning data %s", result.data[:100])
-
-        try:
-            result_json = json.loads(result.data)
-            logger.debug("query result keys: %s", result_json.keys())
-            request_summary['return_exit_status']=result_json['exit_status']
-            request_summary['return_job_status']=result_json['job_status']
-        except Exception:
-            logger.warning("not returning json")
-
-        request_summary_json = json.dumps(request_summary)
-        logger.debug("request_summary: %s", request_summary_json)
-        logstash_message(app, request_summary_json)
+        if response_summary is not None:
+            # the statuses are taken from the query output, the response itself is not decoded
+            request_summary['return_exit_status'] = response_summary['exit_status']
+            request_summary['return_job_status'] = response_summary['job_status']
+        else:
+            logger.info("returning data %s", result.data[:100])
+
+            try:
+                result_json = json.loads(result.data)
+                logger.debug("query result keys: %s", result_json.keys())
+                request_summary['return_exit_status']=result_json['exit_status']
+                request_summary['return_job_status']=result_json['job_status']
+            except Exception:
+                logger.warning("not returning json")
+
+        logger.debug("request_summary: %s", request_summary)
+        logstash_message(app, request_summary)
     except Exception as e:
         logger.warning("failed to output request %s", e)
         raise
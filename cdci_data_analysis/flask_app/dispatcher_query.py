@@ -24,30 +24,31 @@ import string
 import random
 import fcntl
 
-from flask import jsonify, send_from_directory, make_response
+from flask import jsonify, send_file, make_response, Response
 from flask import request, g
 import time as time_
 
 import tempfile
-import tarfile
-import gzip
+import base64
+import mimetypes
 import socket
 import logstash
 import shutil
 import jwt
-import re
 import logging
 import json
 import typing
 
 from ..plugins import importer
 from ..analysis.queries import SourceQuery
-from ..analysis import tokenHelper, email_helper, matrix_helper
+from ..analysis import tokenHelper, email_helper, matrix_helper, notification_outbox
 from ..analysis.instrument import params_not_to_be_included
-from ..analysis.hash import make_hash
+from ..analysis.hash import make_hash, canonical_serialization, format_canonical_hash
 from ..analysis.hash import default_kw_black_list
 from ..analysis.job_manager import job_factory
-from ..analysis.io_helper import FilePath, format_size
+from ..analysis.job_index import job_index
+from ..analysis.download_cache import DownloadCache, store_temporary
+from ..analysis.io_helper import FilePath, format_size, iter_gzip_stream, iter_tar_gz_stream
 from .mock_data_server import mock_query
 from ..analysis.products import QueryOutput
 from ..configurer import DataServerConf
@@ -58,10 +59,12 @@ from ..flask_app.sentry import sentry
 from oda_api.api import DispatcherAPI
 
 from .logstash import logstash_message
+from .tracing import span
+from .metrics import metrics
 
 from oda_api.data_products import NumpyDataProduct
 import oda_api
-from cdci_data_analysis.timer import block_timer
+from werkzeug.datastructures import Headers
 
 logger = logging.getLogger(__name__)
 
@@ -129,6 +132,12 @@ class InstrumentQueryBackEnd:
 
         self.request_files_dir = self.get_request_files_dir()
 
+        # job_id computed during this request, by canonical serialization of the parameters
+        self.job_id_cache = {}
+
+        # statuses of the last response built, for the request summary, without decoding the response
+        self.response_summary = None
+
         params_not_to_be_included.clear()
         params_not_to_be_included.append('user_catalog')
 
@@ -298,21 +307,25 @@ class InstrumentQueryBackEnd:
                         products_url = self.app.config.get('conf').products_url
                         bind_host = self.app.config.get('conf').bind_host
                         bind_port = self.app.config.get('conf').bind_port
-                        self.instrument.parse_inputs_files(
-                            par_dic=self.par_dic,
-                            request=request,
-                            temp_dir=self.temp_dir,
-                            verbose=verbose,
-                            use_scws=self.use_scws,
-                            upload_dir=self.request_files_dir,
-                            products_url=products_url,
-                            bind_host=bind_host,
-                            bind_port=bind_port,
-                            request_files_dir=self.request_files_dir,
-                            decoded_token=self.decoded_token,
-                            sentry_dsn=self.sentry_dsn
-                        )
-                        self.par_dic = self.instrument.set_pars_from_dic(self.par_dic, verbose=verbose)
+                        with span('parse_inputs_files'):
+                            self.instrument.parse_inputs_files(
+                                par_dic=self.par_dic,
+                                request=request,
+                                temp_dir=self.temp_dir,
+                                verbose=verbose,
+                                use_scws=self.use_scws,
+                                upload_dir=self.request_files_dir,
+                                products_url=products_url,
+                                bind_host=bind_host,
+                                bind_port=bind_port,
+                                request_files_dir=self.request_files_dir,
+                                decoded_token=self.decoded_token,
+                                sentry_dsn=self.sentry_dsn,
+                                upload_hash_algorithm=self.app.config.get('conf').upload_hash_algorithm,
+                                upload_hash_chunk_size=self.app.config.get('conf').upload_hash_chunk_size
+                            )
+                        with span('set_pars_from_dic'):
+                            self.par_dic = self.instrument.set_pars_from_dic(self.par_dic, verbose=verbose)
                         # self.update_ownership_files(uploaded_files_obj)
                 # update the job_id
                 if not (data_server_call_back or resolve_job_url or download_files):
@@ -393,11 +406,21 @@ class InstrumentQueryBackEnd:
         else:
             soft_minimum_folder_age_days = int(soft_minimum_folder_age_days)
 
-        list_scratch_dir = sorted(glob.glob("scratch_sid_*_jid_*"), key=os.path.getmtime)
+        # the directories created by the dispatchers of other hosts are not in the index of this one,
+        # the working directory is scanned for them at most once a minute
+        job_index.register_scratch_dirs_from_disk(min_interval=60)
+        scratch_dir_mtimes = {}
+        for scratch_dir in job_index.list_scratch_dirs():
+            try:
+                scratch_dir_mtimes[scratch_dir] = os.path.getmtime(scratch_dir)
+            except FileNotFoundError:
+                logger.info("scratch_dir %s not existing anymore, removing it from the job index", scratch_dir)
+                job_index.remove_scratch_dir(scratch_dir)
+        list_scratch_dir = sorted(scratch_dir_mtimes, key=scratch_dir_mtimes.get)
         list_scratch_dir_to_delete = []
 
         for scratch_dir in list_scratch_dir:
-            scratch_dir_age_days = (current_time_secs - os.path.getmtime(scratch_dir)) / (60 * 60 * 24)
+            scratch_dir_age_days = (current_time_secs - scratch_dir_mtimes[scratch_dir]) / (60 * 60 * 24)
             if scratch_dir_age_days >= hard_minimum_folder_age_days:
                 list_scratch_dir_to_delete.append(scratch_dir)
             elif scratch_dir_age_days >= soft_minimum_folder_age_days:
@@ -437,12 +460,18 @@ class InstrumentQueryBackEnd:
 
         for d in list_scratch_dir_to_delete:
             shutil.rmtree(d)
+            job_index.remove_scratch_dir(d)
+
+        # downloads are now streamed, download folders can only be left over by previous versions
+        for d in glob.glob("download_*"):
+            if os.path.isdir(d) and (current_time_secs - os.path.getmtime(d)) / (60 * 60 * 24) >= hard_minimum_folder_age_days:
+                shutil.rmtree(d)
 
         list_lock_files = sorted(glob.glob(".lock_*"), key=os.path.getatime)
         num_lock_files_removed = 0
         for l in list_lock_files:
             lock_file_job_id = l.split('_')[-1]
-            list_job_id_scratch_dir = glob.glob(f"scratch_sid_*_jid_{lock_file_job_id}*")
+            list_job_id_scratch_dir = job_index.find_scratch_dirs(lock_file_job_id)
             if len(list_job_id_scratch_dir) == 0:
                 os.remove(l)
                 num_lock_files_removed += 1
@@ -450,7 +479,7 @@ class InstrumentQueryBackEnd:
         post_clean_space_space = shutil.disk_usage(os.getcwd())
         post_clean_available_space = format_size(post_clean_space_space.free, format_returned='M')
 
-        list_scratch_dir = sorted(glob.glob("scratch_sid_*_jid_*"))
+        list_scratch_dir = job_index.list_scratch_dirs()
         list_lock_files = sorted(glob.glob(".lock_*"))
         logger.info(f"Number of scratch folder after clean-up: {len(list_scratch_dir)}, "
                     f"number of lock files after clean-up: {len(list_lock_files)}.\n"
@@ -482,89 +511,118 @@ class InstrumentQueryBackEnd:
                 roles = tokenHelper.get_token_roles(decoded_token)
                 email = tokenHelper.get_token_user_email_address(decoded_token)
 
-        with block_timer(logger=logger, 
-                         message_template="Instrument factory iteration took {:.1f} seconds"):
-            out_instrument_list = []
-            for instrument_factory in importer.instrument_factory_iter:
-                if hasattr(instrument_factory, 'instrument_query'):
-                    instrument_query = instrument_factory.instrument_query
-                    if hasattr(instrument_factory, 'instr_name'):
-                        instr_name = instrument_factory.instr_name
-                    else:
-                        instr_name = instrument_factory().name
-                else:
-                    instrument = instrument_factory()
-                    instrument_query = instrument.instrumet_query
-                    instr_name = instrument.name
-                    
-
-                if instrument_query.check_instrument_access(roles, email):
-                    out_instrument_list.append(instr_name)
+        out_instrument_list = importer.instrument_factory_iter.accessible_instrument_names(roles, email)
 
         return jsonify(out_instrument_list)
 
 
+    @staticmethod
+    def encode_inspect_state_cursor(record):
+        return base64.urlsafe_b64encode(json.dumps([record['mtime'], record['scratch_dir']]).encode()).decode()
+
+    @staticmethod
+    def decode_inspect_state_cursor(cursor):
+        try:
+            cursor_mtime, cursor_scratch_dir = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return float(cursor_mtime), str(cursor_scratch_dir)
+        except Exception as e:
+            raise RequestNotUnderstood(f"the provided cursor {cursor} could not be decoded: {repr(e)}")
+
     @staticmethod
     def inspect_state():
+        """
+        scratch directories are listed from the job index, ordered by their last update;
+        when a limit is set, the next_cursor returned can be used to fetch the following records,
+        or, later on, the records updated in the meantime
+        """
         recent_days = request.args.get('recent_days', 3, type=float)
+        min_mtime = request.args.get('min_mtime', None, type=float)
+        max_mtime = request.args.get('max_mtime', None, type=float)
         job_id = request.args.get('job_id', None)
+        status = request.args.get('status', None)
+        limit = request.args.get('limit', None, type=int)
+        cursor = request.args.get('cursor', None)
         include_session_log = request.args.get('include_session_log', False) == 'True'
         include_status_query_output = request.args.get('include_status_query_output', False) == 'True'
         exclude_analysis_parameters = request.args.get('exclude_analysis_parameters', False) == 'True'
         group_by_job = request.args.get('group_by_job', False) == 'True'
-        records_content = []
 
-        for scratch_dir in glob.glob("scratch_sid_*_jid_*"):
-            r = re.match(
-                r"scratch_sid_(?P<session_id>[A-Z0-9]{16})_jid_(?P<job_id>[a-z0-9]{16})(?P<aliased_marker>_aliased|)",
-                scratch_dir)
-            if r is not None:
-                if job_id is not None:
-                    if r.group('job_id')[:8] != job_id:
-                        continue
-                scratch_dir_job_id = r.group('job_id')
-                if os.path.exists(scratch_dir):
-                    if (time_.time() - os.stat(scratch_dir).st_mtime) < recent_days * 24 * 3600:
-                        if group_by_job:
-                            result_job_status = InstrumentQueryBackEnd.read_job_status_scratch_dir(scratch_dir,
-                                                                                                   include_session_log=include_session_log,
-                                                                                                   include_status_query_output=include_status_query_output,
-                                                                                                   exclude_analysis_parameters=exclude_analysis_parameters
-                                                                                                   )
-                            job_status_search_result = [(index, job_status_obj)
-                                                        for index, job_status_obj in enumerate(records_content) if
-                                                        job_status_obj.get('job_id') == scratch_dir_job_id]
-                            if len(job_status_search_result) > 0:
-                                records_content[job_status_search_result[0][0]]['job_status_data'].append(dict(**result_job_status))
-                            else:
-                                records_content.append(dict(
-                                    job_id=scratch_dir_job_id,
-                                    job_status_data=[dict(**result_job_status)]
-                                )
-                                )
-                        else:
-                            result_content, request_completed, token_expired = InstrumentQueryBackEnd.read_content_scratch_dir(scratch_dir,
-                                                                                                                include_session_log=include_session_log,
-                                                                                                                include_status_query_output=include_status_query_output,
-                                                                                                                exclude_analysis_parameters=exclude_analysis_parameters)
-                            record = dict(
-                                mtime=os.stat(scratch_dir).st_mtime,
-                                ctime=os.stat(scratch_dir).st_ctime,
-                                session_id=r.group('session_id'),
-                                job_id=scratch_dir_job_id,
-                                request_completed=request_completed,
-                                aliased_marker=r.group('aliased_marker'),
-                                **result_content
-                            )
-                            if token_expired is not None:
-                                record['token_expired'] = token_expired
-                            records_content.append(record)
-                else:
-                    logger.warning(f"scratch_dir {scratch_dir} not existing, cannot be inspected")
+        recent_min_mtime = time_.time() - recent_days * 24 * 3600
+        if min_mtime is None or min_mtime < recent_min_mtime:
+            min_mtime = recent_min_mtime
+
+        if status is not None:
+            status = status.split(',')
+
+        after = None
+        if cursor is not None:
+            after = InstrumentQueryBackEnd.decode_inspect_state_cursor(cursor)
+
+        # the directories created by the dispatchers of other hosts are not in the index of this one,
+        # the working directory is scanned for them at most once a minute
+        job_index.register_scratch_dirs_from_disk(min_interval=60)
+        index_records = job_index.list_records(min_mtime=min_mtime,
+                                               max_mtime=max_mtime,
+                                               job_id_prefix=job_id,
+                                               status=status,
+                                               after=after,
+                                               limit=None if limit is None else limit + 1,
+                                               check_exists=True)
+        # one more record is fetched, to tell whether there are more records than the limit
+        more_records = limit is not None and len(index_records) > limit
+        if more_records:
+            index_records = index_records[:limit]
+
+        records_content = []
+        records_by_job_id = {}
+
+        for index_record in index_records:
+            scratch_dir = index_record['scratch_dir']
+            scratch_dir_job_id = index_record['job_id']
+            if group_by_job:
+                result_job_status = InstrumentQueryBackEnd.read_job_status_scratch_dir(scratch_dir,
+                                                                                       include_session_log=include_session_log,
+                                                                                       include_status_query_output=include_status_query_output,
+                                                                                       exclude_analysis_parameters=exclude_analysis_parameters
+                                                                                       )
+                if scratch_dir_job_id not in records_by_job_id:
+                    records_by_job_id[scratch_dir_job_id] = dict(
+                        job_id=scratch_dir_job_id,
+                        job_status_data=[]
+                    )
+                    records_content.append(records_by_job_id[scratch_dir_job_id])
+                records_by_job_id[scratch_dir_job_id]['job_status_data'].append(dict(**result_job_status))
+            else:
+                result_content, request_completed, token_expired = InstrumentQueryBackEnd.read_content_scratch_dir(scratch_dir,
+                                                                                                                    include_session_log=include_session_log,
+                                                                                                                    include_status_query_output=include_status_query_output,
+                                                                                                                    exclude_analysis_parameters=exclude_analysis_parameters)
+                scratch_dir_stat = os.stat(scratch_dir)
+                record = dict(
+                    mtime=scratch_dir_stat.st_mtime,
+                    ctime=scratch_dir_stat.st_ctime,
+                    session_id=index_record['session_id'],
+                    job_id=scratch_dir_job_id,
+                    request_completed=request_completed,
+                    aliased_marker='_aliased' if index_record['aliased'] else '',
+                    **result_content
+                )
+                if token_expired is not None:
+                    record['token_expired'] = token_expired
+                records_content.append(record)
 
         logger.info("found %s records", len(records_content))
 
-        return dict(records=records_content)
+        state_data_obj = dict(records=records_content)
+
+        if limit is not None:
+            state_data_obj['more_records'] = more_records
+            if len(index_records) > 0:
+                state_data_obj['next_cursor'] = InstrumentQueryBackEnd.encode_inspect_state_cursor(index_records[-1])
+            else:
+                state_data_obj['next_cursor'] = cursor
+
+        return state_data_obj
 
     @staticmethod
     def read_analysis_parameters_scratch_dir(scratch_dir, decode_token=False):
@@ -719,7 +777,15 @@ class InstrumentQueryBackEnd:
         user_par_dict = self.user_specific_par_dic(par_dic)
         user_restricted_par_dict = self.restricted_par_dic(user_par_dict, kw_black_list)
 
-        return make_hash(user_restricted_par_dict)
+        serialized_par_dict = canonical_serialization(user_restricted_par_dict)
+        if serialized_par_dict not in self.job_id_cache:
+            job_id_hash_mode = self.app.config.get('conf').job_id_hash_mode
+            if job_id_hash_mode == 'canonical':
+                self.job_id_cache[serialized_par_dict] = format_canonical_hash(serialized_par_dict)
+            else:
+                self.job_id_cache[serialized_par_dict] = make_hash(user_restricted_par_dict, hash_mode=job_id_hash_mode)
+
+        return self.job_id_cache[serialized_par_dict]
 
     def generate_job_id(self, kw_black_list=None):
         self.logger.info("\033[31m---> GENERATING JOB ID <---\033[0m")
@@ -871,6 +937,7 @@ class InstrumentQueryBackEnd:
                 if self.use_scws is None:
                     self.use_scws = 'form_list'
 
+    @span('set_args')
     def set_args(self, request, verbose=False, download_products=False, download_files=False):
         supported_methods = ['GET', 'POST']
         if download_files or download_products:
@@ -907,6 +974,7 @@ class InstrumentQueryBackEnd:
         request_files_dir.mkdir()
         return request_files_dir.path
 
+    @span('set_scratch_dir')
     def set_scratch_dir(self, session_id, job_id=None, verbose=False):
         lock_file = f".lock_{self.job_id}"
         scratch_dir_retry_attempts = 6
@@ -926,25 +994,36 @@ class InstrumentQueryBackEnd:
 
         for attempt in range(scratch_dir_retry_attempts):
             try:
-                with open(lock_file, 'w') as lock:
-                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    alias_workdir = self.get_existing_job_ID_path(wd=FilePath(file_dir=wd).path)
+                with open(lock_file, 'a') as lock:
+                    # timed apart from the lookup and the creation of the directory
+                    with span('set_scratch_dir.lock'):
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # the names of the scratch directories created for the job, by any host, are appended to the lock file:
+                    # if it is empty, the job is new, and its scratch directories do not need to be looked up on disk,
+                    # otherwise the working directory is scanned for those created elsewhere, if modified since the last scan
+                    job_is_new = os.fstat(lock.fileno()).st_size == 0
+                    alias_workdir = self.get_existing_job_ID_path(wd=FilePath(file_dir=wd).path,
+                                                                  scan_disk=not job_is_new)
                     if alias_workdir is not None:
                         wd = wd + '_aliased'
 
                     wd_path_obj = FilePath(file_dir=wd)
                     wd_path_obj.mkdir()
                     self.scratch_dir = wd_path_obj.path
+                    job_index.register_scratch_dir(self.scratch_dir)
+                    lock.write(wd + '\n')
                     scratch_dir_created = True
                     break
             except (OSError, IOError) as io_e:
                 scratch_dir_created = False
+                metrics.inc('dispatcher_scratch_dir_lock_retries_total')
                 self.logger.warning(f'Failed to acquire lock for the scratch directory "{wd}" creation, attempt number {attempt + 1} ({scratch_dir_retry_attempts - (attempt + 1)} left), sleeping {scratch_dir_retry_delay} seconds until retry.\nError: {str(io_e)}')
                 time.sleep(scratch_dir_retry_delay)
                 scratch_dir_retry_delay *= 2
 
         if not scratch_dir_created:
-            dir_list = glob.glob(f"*_jid_{job_id}*")
+            metrics.inc('dispatcher_scratch_dir_lock_failures_total')
+            dir_list = job_index.find_scratch_dirs(job_id)
             sentry.capture_message(f"Failed to acquire lock for \"{wd}\" directory creation after multiple attempts.\njob_id: {self.job_id}\ndir_list: {dir_list}")
             raise InternalError(f"Failed to acquire lock for directory \"{wd}\" creation after {scratch_dir_retry_attempts} attempts.", status_code=500)
 
@@ -966,6 +1045,7 @@ class InstrumentQueryBackEnd:
         td = tempfile.mkdtemp(suffix=suffix, dir=temp_parent_dir)
         self.temp_dir = td
 
+    @span('move_temp_content')
     def move_temp_content(self):
         if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir) \
                 and os.path.exists(self.scratch_dir):
@@ -973,11 +1053,13 @@ class InstrumentQueryBackEnd:
                 file_full_path = os.path.join(self.temp_dir, f)
                 shutil.copy(file_full_path, self.scratch_dir)
 
+    @span('clear_temp_dir')
     def clear_temp_dir(self, temp_scratch_dir=None, temp_job_id=None):
         if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir):
             shutil.rmtree(self.temp_dir)
         if temp_scratch_dir is not None and temp_scratch_dir != self.scratch_dir and os.path.exists(temp_scratch_dir):
             shutil.rmtree(temp_scratch_dir)
+            job_index.remove_scratch_dir(temp_scratch_dir)
         if temp_job_id is not None and os.path.exists(f".lock_{temp_job_id}"):
             os.remove(f".lock_{temp_job_id}")
 
@@ -1010,6 +1092,12 @@ class InstrumentQueryBackEnd:
 
     
     def prepare_download(self, file_list, file_name, return_archive=True, from_request_files_dir=False):
+        """
+        validates the requested files and returns the response sending them, as a single (possibly gzipped) file
+        or as a tar.gz archive; archives are streamed while they are built, and kept in the download cache,
+        but those needed in full to answer, i.e. HEAD requests with the size of the archive and range requests,
+        are built beforehand
+        """
         if from_request_files_dir:
             origin_dir = self.request_files_dir
         else:
@@ -1017,44 +1105,81 @@ class InstrumentQueryBackEnd:
 
         file_name = file_name.replace(' ', '_')
 
-        if hasattr(file_list, '__iter__'):
-            print('file_list is iterable')
-        else:
+        if isinstance(file_list, str) or not hasattr(file_list, '__iter__'):
             file_list = [file_list]
 
+        file_list = list(file_list)
         for ID, f in enumerate(file_list):
             file_list[ID] = self.validated_download_file_path(origin_dir, f)
             if from_request_files_dir:
                 self.verify_access_to_file(f)
 
-        file_dir = tempfile.mkdtemp(prefix='download_', dir='./')
-        file_path = self.validated_download_file_path(file_dir, file_name, should_exist=False)
+        # the name is only used in the response headers, but it is still validated as it used to be a path
+        self.validated_download_file_path(origin_dir, file_name, should_exist=False)
+
+        if len(file_list) == 1 and not return_archive:
+            # the file can be sent as it is, also by ranges
+            etag = True
+            if from_request_files_dir:
+                # request files are named after the hash of their content
+                etag = os.path.basename(file_list[0])
+            return send_file(file_list[0], as_attachment=True, download_name=file_name, conditional=True, etag=etag)
+
+        # name stored in the gzip header, as gzip.open would do
+        gzip_fname = file_name[:-3] if file_name.endswith('.gz') else file_name
+        # the archive is reproducible as long as the files are not modified, so that an interrupted download
+        # can be resumed even if the archive had to be built again
+        gzip_mtime = max(os.path.getmtime(f) for f in file_list)
 
         if len(file_list) > 1:
             out_dir = file_name.replace('.tar', '')
             out_dir = out_dir.replace('.gz', '')
-            tar = tarfile.open("%s" % (file_path), "w:gz")
-            for name in file_list:
-                if name is not None:
-                    tar.add(name, arcname='%s/%s' %
-                            (out_dir, os.path.basename(name)))
-            tar.close()
+            mimetype = mimetypes.guess_type(file_name)[0] or 'application/x-tar'
+            generate_download = lambda: iter_tar_gz_stream(file_list, arcname_dir=out_dir, fname=gzip_fname, mtime=gzip_mtime)
         else:
-            if return_archive:
-                with open(file_list[0], "rb") as f_in:
-                    in_data = f_in.read()
-                with gzip.open(file_path, 'wb') as f:
-                    f.write(in_data)
-            else:
-                file_to_download = file_list[0].split('/')[-1]
-                if file_name == file_to_download:
-                    file_dir = os.path.dirname(file_list[0])
-                else:
-                    shutil.copy(file_list[0], file_path)
+            mimetype = 'application/x-gzip-compressed'
+            generate_download = lambda: iter_gzip_stream(file_list[0], fname=gzip_fname, mtime=gzip_mtime)
+
+        app_config = self.app.config.get('conf')
+        download_cache = DownloadCache(app_config.download_cache_dir,
+                                       app_config.download_cache_max_size_mb * 1024 * 1024)
+
+        archive_key = download_cache.archive_key(self.job_id, file_list, file_name, return_archive)
 
-        file_dir = os.path.abspath(file_dir)
+        if download_cache.enabled:
+            archive_path = download_cache.get(archive_key)
+            if archive_path is None and (request.method == 'HEAD' or request.range is not None):
+                # the archive size, or part of the archive, is needed: it is built before answering
+                archive_path = download_cache.store(archive_key, generate_download())
 
-        return file_dir, file_name
+            if archive_path is not None:
+                try:
+                    return send_file(archive_path, as_attachment=True, download_name=file_name, mimetype=mimetype,
+                                     conditional=True, etag=archive_key)
+                except FileNotFoundError:
+                    logger.info("download archive %s evicted meanwhile, streaming it", archive_key)
+
+            download_stream = download_cache.store_stream(archive_key, generate_download())
+        elif request.method == 'HEAD' or request.range is not None:
+            # without the cache, the archive is built in a temporary file, removed once the response is sent
+            archive_path = store_temporary(generate_download())
+            try:
+                response = send_file(archive_path, as_attachment=True, download_name=file_name, mimetype=mimetype,
+                                     conditional=True, etag=archive_key)
+            except Exception:
+                os.remove(archive_path)
+                raise
+            response.call_on_close(lambda: os.remove(archive_path))
+            return response
+        else:
+            download_stream = generate_download()
+
+        headers = Headers()
+        headers.set('Content-Disposition', 'attachment', filename=file_name)
+        headers.set('ETag', f'"{archive_key}"')
+
+        # the compressed size is only known once compressed, the archive is sent without Content-Length
+        return Response(download_stream, mimetype=mimetype, headers=headers)
 
     def resolve_job_url(self):
         expected_pars = set(['job_id', 'session_id', 'token'])
@@ -1169,20 +1294,10 @@ class InstrumentQueryBackEnd:
             if file_name is None:
                 file_name = file_list[0] if len(file_list) == 1 else 'download.tar.gz'
             return_archive = self.args.get('return_archive', 'True') == 'True'
-            mimetype = 'application/x-gzip-compressed' if return_archive and len(file_list) == 1 else None
-            # otherwise, for one file, the mimetype of the uncompressed file is determined, and gz only affects Content-Encoding
-            # but Content-Encoding header isn't set if as_attachment=True
-
-            tmp_dir, target_file = self.prepare_download(
-                file_list, file_name,
-                return_archive=return_archive,
-                from_request_files_dir=from_request_files_dir)
-            try:
-                return send_from_directory(directory=tmp_dir, path=target_file, attachment_filename=target_file,
-                                        as_attachment=True, mimetype=mimetype)
-            except Exception as e:
-                return send_from_directory(directory=tmp_dir, filename=target_file, attachment_filename=target_file,
-                                           as_attachment=True, mimetype=mimetype)
+
+            return self.prepare_download(file_list, file_name,
+                                         return_archive=return_archive,
+                                         from_request_files_dir=from_request_files_dir)
         except RequestNotAuthorized as e:
             extract_job_monitor = True
             if not hasattr(self, 'scratch_dir') or self.scratch_dir is None:
@@ -1239,17 +1354,7 @@ class InstrumentQueryBackEnd:
         return jsonify(self.par_dic)
 
     def get_instr_list(self, name=None):
-        with block_timer(logger=logger, 
-                         message_template="Instrument factory iteration took {:.1f} seconds"):
-            _l = []
-            for instrument_factory in importer.instrument_factory_iter:
-                if hasattr(instrument_factory, 'instr_name'):
-                    iname = instrument_factory.instr_name
-                else:
-                    iname = instrument_factory().name
-                _l.append(iname)
-
-        return jsonify(_l)
+        return jsonify(importer.instrument_factory_iter.instrument_names)
 
     @property
     def dispatcher_callback_url_base(self):
@@ -1387,7 +1492,7 @@ class InstrumentQueryBackEnd:
             if time_request_first_submitted is not None:
                 time_request = time_request_first_submitted
 
-            res_content = matrix_helper.send_job_message(
+            job_message_kwargs = dict(
                 config=self.app.config['conf'],
                 logger=self.logger,
                 decoded_token=self.decoded_token,
@@ -1403,20 +1508,30 @@ class InstrumentQueryBackEnd:
                 api_code=email_api_code,
                 scratch_dir=self.scratch_dir)
 
-            matrix_message_status_details = {
-                "res_content": res_content
-            }
-            if status_details is not None:
-                matrix_message_status_details['status_details'] = status_details
+            if self.app.config['conf'].notification_outbox_enabled:
+                # recorded before the message is queued, so that it does not replace the outcome of the delivery
+                job.write_dataserver_status(status_dictionary_value=status,
+                                            full_dict=self.par_dic,
+                                            matrix_message_status='matrix message queued')
 
-            matrix_message_status = 'matrix message sent'
-            if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
-                matrix_message_status = 'sending message via matrix failed'
+                notification_outbox.enqueue_job_message(job_monitor_file_name=job.file_name, **job_message_kwargs)
+            else:
+                res_content = matrix_helper.send_job_message(**job_message_kwargs)
 
-            job.write_dataserver_status(status_dictionary_value=status,
-                                        full_dict=self.par_dic,
-                                        matrix_message_status=matrix_message_status,
-                                        matrix_message_status_details=json.dumps(matrix_message_status_details))
+                matrix_message_status_details = {
+                    "res_content": res_content
+                }
+                if status_details is not None:
+                    matrix_message_status_details['status_details'] = status_details
+
+                matrix_message_status = 'matrix message sent'
+                if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
+                    matrix_message_status = 'sending message via matrix failed'
+
+                job.write_dataserver_status(status_dictionary_value=status,
+                                            full_dict=self.par_dic,
+                                            matrix_message_status=matrix_message_status,
+                                            matrix_message_status_details=json.dumps(matrix_message_status_details))
         else:
             job.write_dataserver_status(status_dictionary_value=status, full_dict=self.par_dic)
 
@@ -1429,7 +1544,7 @@ class InstrumentQueryBackEnd:
                 if time_request_first_submitted is not None:
                     time_request = time_request_first_submitted
 
-                email_helper.send_job_email(
+                job_email_kwargs = dict(
                     config=self.config,
                     logger=self.logger,
                     decoded_token=self.decoded_token,
@@ -1448,10 +1563,21 @@ class InstrumentQueryBackEnd:
                     scratch_dir=self.scratch_dir,
                     )
 
-                job.write_dataserver_status(status_dictionary_value=status,
-                                            full_dict=self.par_dic,
-                                            email_status='email sent',
-                                            email_status_details=status_details)
+                if self.app.config['conf'].notification_outbox_enabled:
+                    # recorded before the email is queued, so that it does not replace the outcome of the delivery
+                    job.write_dataserver_status(status_dictionary_value=status,
+                                                full_dict=self.par_dic,
+                                                email_status='email queued',
+                                                email_status_details=status_details)
+
+                    notification_outbox.enqueue_job_email(job_monitor_file_name=job.file_name, **job_email_kwargs)
+                else:
+                    email_helper.send_job_email(**job_email_kwargs)
+
+                    job.write_dataserver_status(status_dictionary_value=status,
+                                                full_dict=self.par_dic,
+                                                email_status='email sent',
+                                                email_status_details=status_details)
             else:
                 job.write_dataserver_status(status_dictionary_value=status, full_dict=self.par_dic)
 
@@ -1489,7 +1615,9 @@ class InstrumentQueryBackEnd:
         returns parameters from current job and any session
         """
 
-        scratch_dir_parameters = glob.glob(f'scratch*_jid_{job_id}*/analysis_parameters.json')
+        scratch_dir_parameters = [os.path.join(scratch_dir, 'analysis_parameters.json')
+                                  for scratch_dir in job_index.find_scratch_dirs(job_id)]
+        scratch_dir_parameters = [fn for fn in scratch_dir_parameters if os.path.exists(fn)]
         if len(scratch_dir_parameters) == 0:
             return None
         else:
@@ -1580,6 +1708,9 @@ class InstrumentQueryBackEnd:
 
         out_dict['time_request'] = self.time_request
 
+        self.response_summary = dict(exit_status=out_dict.get('exit_status'),
+                                     job_status=out_dict.get('job_status'))
+
         if off_line:
             return out_dict
         else:
@@ -1618,6 +1749,7 @@ class InstrumentQueryBackEnd:
 
         return out_dict
 
+    @span('set_instrument')
     def set_instrument(self, instrument_name, roles, email):
 
         known_instruments = []
@@ -1628,32 +1760,15 @@ class InstrumentQueryBackEnd:
         if instrument_name == 'mock':
             new_instrument = 'mock'
         else:
-            with block_timer(logger=logger, 
-                             message_template="Instrument factory iteration took {:.1f} seconds"):
-                for instrument_factory in importer.instrument_factory_iter:
-                    _instrument = None
-                    if hasattr(instrument_factory, 'instr_name'):
-                        instr_name = instrument_factory.instr_name
+            for registry_entry in importer.instrument_factory_iter.registry:
+                if registry_entry.name == instrument_name:
+                    if registry_entry.check_instrument_access(roles, email):
+                        new_instrument = registry_entry.build_instrument(
+                            use_template=self.app.config.get('conf').reuse_instrument_templates)  # multiple assignment? TODO
                     else:
-                        _instrument = instrument_factory()
-                        instr_name = _instrument.name
-                    
-                    if instr_name == instrument_name:
-                        if _instrument is None and hasattr(instrument_factory, 'instrument_query'):
-                            instr_query = instrument_factory.instrument_query
-                        else:
-                            if _instrument is None:
-                                _instrument = instrument_factory()
-                            instr_query = _instrument.instrumet_query
-                                
-                        if instr_query.check_instrument_access(roles, email):
-                            if _instrument is None:
-                                _instrument = instrument_factory()
-                            new_instrument = _instrument  # multiple assignment? TODO
-                        else:
-                            no_access = True
+                        no_access = True
 
-                    known_instruments.append(instr_name)
+                known_instruments.append(registry_entry.name)
         if new_instrument is None:
             if no_access:
                 raise RequestNotAuthorized(f"Unfortunately, your priviledges are not sufficient "
@@ -1703,10 +1818,10 @@ class InstrumentQueryBackEnd:
 
         return config, self.config_data_server
 
-    def get_existing_job_ID_path(self, wd):
+    def get_existing_job_ID_path(self, wd, scan_disk=None):
         # exist same job_ID, different session ID
-        dir_list = glob.glob(f'*_jid_{self.job_id}')
-        dir_list = [d for d in dir_list if 'aliased' not in d]
+        # by default, checked on disk when not in the index, the directory might have been created by a dispatcher with another index
+        dir_list = job_index.find_scratch_dirs(self.job_id, aliased=False, scan_disk=scan_disk)
 
         if len(dir_list) == 1:
             if dir_list[0] != wd:
@@ -1761,6 +1876,7 @@ class InstrumentQueryBackEnd:
 
         return None  # it's good
 
+    @span('validate_token')
     def validate_query_from_token(self):
         """
         read base64 token
@@ -1920,6 +2036,7 @@ class InstrumentQueryBackEnd:
             args=[self.dispatcher_callback_url_base + "/run_analysis"],
             kwargs={**self.par_dic, 'async_dispatcher': False}
         )
+        metrics.inc('dispatcher_celery_submissions_total')
         self.logger.info("submitted celery job with pars %s", self.par_dic)
         self.logger.info("submitted celery job: %s state: %s", r.id, r.state)
         json.dump({'celery-id': r.id},
@@ -1989,7 +2106,8 @@ class InstrumentQueryBackEnd:
                                 time_request=None,
                                 instrument_name=None,
                                 status_details=None,
-                                arg_par_dic=None):
+                                arg_par_dic=None,
+                                job_monitor_file_name='job_monitor.json'):
         if time_request is None:
             time_request = self.time_request
         if instrument_name is None:
@@ -2006,7 +2124,7 @@ class InstrumentQueryBackEnd:
         if time_request_first_submitted is not None:
             time_request = time_request_first_submitted
 
-        email_helper.send_job_email(
+        job_email_kwargs = dict(
             config=self.config,
             logger=self.logger,
             decoded_token=self.decoded_token,
@@ -2022,6 +2140,13 @@ class InstrumentQueryBackEnd:
             api_code=email_api_code,
             scratch_dir=self.scratch_dir)
 
+        if self.app.config['conf'].notification_outbox_enabled:
+            notification_outbox.enqueue_job_email(job_monitor_file_name=job_monitor_file_name, **job_email_kwargs)
+            return 'email queued'
+
+        email_helper.send_job_email(**job_email_kwargs)
+        return 'email sent'
+
 
     def run_query(self, off_line=False, disp_conf=None):
         """
@@ -2119,6 +2244,13 @@ class InstrumentQueryBackEnd:
             job_is_aliased = True
 
         self.logger.info('--> is job aliased? : %s', job_is_aliased)
+        if job_is_aliased:
+            aliasing_decision = 'aliased'
+        elif alias_workdir is not None:
+            aliasing_decision = 'not_aliased_synchronous'
+        else:
+            aliasing_decision = 'no_identical_job'
+        metrics.inc('dispatcher_aliasing_decisions_total', dict(decision=aliasing_decision))
         job = job_factory(self.instrument_name,
                           self.scratch_dir,
                           self.dispatcher_host,
@@ -2170,6 +2302,7 @@ class InstrumentQueryBackEnd:
                 # NOTE it will be resubmitted anyhow
                 print('==>aliased job status', job_monitor['status'])
                 job_is_aliased = False
+                metrics.inc('dispatcher_aliasing_decisions_total', dict(decision='alias_switched_off'))
                 job.work_dir = original_work_dir
                 job_monitor = job.updated_dataserver_monitor()
                 # Note this is necessary to avoid a never ending loop in the non-aliased job-status is set to progress
@@ -2227,9 +2360,10 @@ class InstrumentQueryBackEnd:
                                                                    self.app.config['conf'],
                                                                    decoded_token=self.decoded_token):
                             try:
-                                self.send_query_new_status_email(product_type, query_new_status)
+                                email_status = self.send_query_new_status_email(product_type, query_new_status,
+                                                                                job_monitor_file_name=job.file_name)
                                 # store an additional information about the sent email
-                                query_out.set_status_field('email_status', 'email sent')
+                                query_out.set_status_field('email_status', email_status)
                             except email_helper.EMailNotSent as e:
                                 query_out.set_status_field('email_status', 'sending email failed')
                                 logging.warning(f'email sending failed: {e}')
@@ -2327,7 +2461,7 @@ class InstrumentQueryBackEnd:
                         if time_request_first_submitted is not None:
                             time_request = time_request_first_submitted
 
-                        res_content = matrix_helper.send_job_message(
+                        job_message_kwargs = dict(
                             config=self.app.config['conf'],
                             logger=self.logger,
                             decoded_token=self.decoded_token,
@@ -2342,16 +2476,22 @@ class InstrumentQueryBackEnd:
                             api_code=email_api_code,
                             scratch_dir=self.scratch_dir)
 
-                        matrix_message_status_details =  json.dumps({
-                            "res_content": res_content
-                        })
+                        if self.app.config['conf'].notification_outbox_enabled:
+                            notification_outbox.enqueue_job_message(job_monitor_file_name=job.file_name, **job_message_kwargs)
+                            query_out.set_status_field('matrix_message_status', 'matrix message queued')
+                        else:
+                            res_content = matrix_helper.send_job_message(**job_message_kwargs)
+
+                            matrix_message_status_details =  json.dumps({
+                                "res_content": res_content
+                            })
 
-                        matrix_message_status = 'matrix message sent'
-                        if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
-                            matrix_message_status = 'sending message via matrix failed'
+                            matrix_message_status = 'matrix message sent'
+                            if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
+                                matrix_message_status = 'sending message via matrix failed'
 
-                        query_out.set_status_field('matrix_message_status', matrix_message_status)
-                        query_out.set_status_field('matrix_message_status_details', matrix_message_status_details)
+                            query_out.set_status_field('matrix_message_status', matrix_message_status)
+                            query_out.set_status_field('matrix_message_status_details', matrix_message_status_details)
 
                     if email_helper.is_email_to_send_run_query(self.logger,
                                                                query_new_status,
@@ -2367,7 +2507,7 @@ class InstrumentQueryBackEnd:
                             if time_request_first_submitted is not None:
                                 time_request = time_request_first_submitted
 
-                            email_helper.send_job_email(
+                            job_email_kwargs = dict(
                                 config=self.app.config['conf'],
                                 logger=self.logger,
                                 decoded_token=self.decoded_token,
@@ -2382,8 +2522,15 @@ class InstrumentQueryBackEnd:
                                 api_code=email_api_code,
                                 scratch_dir=self.scratch_dir)
 
+                            if self.app.config['conf'].notification_outbox_enabled:
+                                notification_outbox.enqueue_job_email(job_monitor_file_name=job.file_name, **job_email_kwargs)
+                                email_status = 'email queued'
+                            else:
+                                email_helper.send_job_email(**job_email_kwargs)
+                                email_status = 'email sent'
+
                             # store an additional information about the sent email
-                            query_out.set_status_field('email_status', 'email sent')
+                            query_out.set_status_field('email_status', email_status)
                         except email_helper.EMailNotSent as e:
                             query_out.set_status_field('email_status', 'sending email failed')
                             logging.warning(f'email sending failed: {e}')
@@ -1,35 +1,225 @@
-import time
+"""
+Shipping of the dispatcher events to logstash.
+
+The messages are queued, and flattened, encoded and sent by a background thread of each process; the requests never
+wait for logstash.
+When the queue is full, because logstash is slow or unreachable, the new messages are dropped and counted. The queue is
+flushed when the process exits.
+
+With the "json" codec, the default, each message is sent over its own connection, as expected by a logstash tcp input
+with the json codec. With the "json_lines" codec, the messages are sent in batches, as JSON lines, over a connection
+kept open between the batches; the tcp input of logstash should then use the json_lines codec.
+"""
+
+import os
 import json
+import time
+import queue
+import socket
+import typing
+import atexit
 import logging
-import pylogstash
+import threading
+import collections.abc
+from collections import Counter
 
 logger = logging.getLogger(__name__)
 
-def logstash_message(app, message_dict: dict):
-    t0 = time.time()
 
-    logger.warning("logstash_message at %s s", t0)
-    conf = app.config['conf']
+def flatten(d, parent_key='', sep='.'):
+    # same flattening of the messages as pylogstash
+    items = []
+    for k, v in d.items():
+        new_key = str(parent_key) + sep + str(k) if parent_key else k
+        if isinstance(v, collections.abc.MutableMapping):
+            items.extend(flatten(v, new_key, sep=sep).items())
+        elif isinstance(v, collections.abc.Iterable) and not isinstance(v, str):
+            items.extend(flatten(dict(enumerate(v)), new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
 
-    logger.warning("logstash_message before encoding %s in %s s", t0, time.time() - t0)
-    message_json = json.dumps(message_dict)
-    logger.warning("logstash_message after encoding %s size %s in %s s", t0, len(message_json), time.time() - t0)    
-    
-    if conf.logstash_host not in [None, "None"] and conf.logstash_port not in [None, "None"]:
-        url = f"{conf.logstash_host}:{conf.logstash_port}"
 
-        LS = pylogstash.LogStasher(url)
+codecs = ('json', 'json_lines')
 
-        logger.warning("logstash_message constructed at %s in %s s", t0, time.time() - t0)
 
-        LS.log(
-            message_dict
-        )
+class LogstashShipper:
+    def __init__(self, host, port, queue_size=1000, batch_size=100, poll_interval_s=1, timeout_s=5, codec='json'):
+        if codec not in codecs:
+            raise ValueError(f"unknown logstash codec {codec}, it should be one of {codecs}")
 
-        logger.warning("logstash_message sent at %s in %s s", t0, time.time() - t0)
+        self.host = host
+        self.port = int(port)
+        self.codec = codec
+        self.batch_size = batch_size
+        self.poll_interval_s = poll_interval_s
+        self.timeout_s = timeout_s
+        self.counters = Counter()
 
-    logger.debug(f"\033[35m stashing to {conf.logstash_host}:{conf.logstash_port}\033[0m")
-    logger.debug("\033[35m%s\033[0m", message_dict)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._sock = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {self.host}:{self.port} {self.codec} ]"
+
+    def _ensure_started(self):
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    # the thread, queue and connection of the parent process are not usable after a fork
+                    self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                    self._sock = None
+                    self._stopping.clear()
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name=f'logstash-shipper-{self.host}', daemon=True)
+                    self._thread.start()
+
+    def ship(self, message):
+        """
+        queues the message, a dictionary or an already encoded JSON string, flattened in the same way;
+        the dictionary is encoded later, by the background thread, and should not be changed once shipped
+        """
+        self._ensure_started()
+
+        try:
+            self._queue.put_nowait(message)
+            self.counters['queued'] += 1
+        except queue.Full:
+            self.counters['dropped'] += 1
+            if self.counters['dropped'] % 100 == 1:
+                logger.warning("logstash queue full, %s messages dropped so far", self.counters['dropped'])
+
+    def _next_batch(self):
+        # the messages queued while the previous batch was sent, at most batch_size of them
+        try:
+            batch = [self._queue.get(timeout=self.poll_interval_s)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set() or self._queue.qsize() > 0:
+            batch = self._next_batch()
+            if len(batch) > 0:
+                self._send(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+        self._close_connection()
+
+    def _encode(self, batch):
+        encoded_batch = []
+        for message in batch:
+            try:
+                if isinstance(message, str):
+                    message = json.loads(message)
+                encoded_batch.append(json.dumps(flatten(message)).encode())
+            except (TypeError, ValueError) as e:
+                logger.warning("unable to encode a message for logstash: %s", repr(e))
+                self.counters['failed'] += 1
+        return encoded_batch
+
+    def _send(self, batch):
+        batch = self._encode(batch)
+        if len(batch) == 0:
+            return
+
+        if self.codec == 'json':
+            for encoded_message in batch:
+                self._send_data([encoded_message], encoded_message)
+                self._close_connection()
+        else:
+            self._send_data(batch, b''.join(encoded_message + b'\n' for encoded_message in batch))
 
-    logger.warning("logstash_message done at %s in %s s", t0, time.time() - t0)
-    
+    def _send_data(self, batch, data):
+        # a connection closed by logstash while idle is noticed only when sending, in which case it is opened again
+        for attempt in range(2):
+            try:
+                if self._sock is None:
+                    self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout_s)
+                    self.counters['connections'] += 1
+                self._sock.sendall(data)
+                self.counters['sent'] += len(batch)
+                self.counters['batches'] += 1
+                return
+            except OSError as e:
+                logger.warning("error sending %s messages to logstash %s:%s: %s", len(batch), self.host, self.port, repr(e))
+                self._close_connection()
+
+        self.counters['failed'] += len(batch)
+
+    def _close_connection(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def flush(self, timeout_s=5) -> bool:
+        """
+        waits until the queued messages are sent, returns False if they are not within timeout_s
+        """
+        t0 = time.time()
+        while self._queue.unfinished_tasks > 0:
+            if time.time() - t0 > timeout_s or self._thread is None or not self._thread.is_alive():
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout_s=5):
+        if self._thread is not None and self._pid == os.getpid():
+            self._stopping.set()
+            self._thread.join(timeout=timeout_s)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return dict(queued=self.counters['queued'],
+                    sent=self.counters['sent'],
+                    dropped=self.counters['dropped'],
+                    failed=self.counters['failed'],
+                    batches=self.counters['batches'],
+                    connections=self.counters['connections'],
+                    queue_length=self._queue.qsize())
+
+
+_shippers = {}
+_shippers_lock = threading.Lock()
+
+
+def get_logstash_shipper(conf) -> LogstashShipper:
+    key = (conf.logstash_host, int(conf.logstash_port))
+    with _shippers_lock:
+        if key not in _shippers:
+            _shippers[key] = LogstashShipper(conf.logstash_host,
+                                             conf.logstash_port,
+                                             queue_size=conf.logstash_queue_size,
+                                             batch_size=conf.logstash_batch_size,
+                                             codec=conf.logstash_codec)
+        return _shippers[key]
+
+
+@atexit.register
+def close_logstash_shippers():
+    for shipper in list(_shippers.values()):
+        shipper.close()
+
+
+def logstash_message(app, message: typing.Union[dict, str]):
+    conf = app.config['conf']
+
+    if conf.logstash_host not in [None, "None"] and conf.logstash_port not in [None, "None"]:
+        get_logstash_shipper(conf).ship(message)
+
+    logger.debug(f"\033[35m stashing to {conf.logstash_host}:{conf.logstash_port}\033[0m")
+    logger.debug("\033[35m%s\033[0m", message)
@@ -0,0 +1,111 @@
+"""
+Cache of the instrument parameters descriptions, as returned by /meta-data, /api/meta-data and /api/par-names.
+
+Building them requires a complete InstrumentQueryBackEnd, while they only depend on the plugins,
+on the requested instrument and product, and on the access rights of the user. The cache is cleared
+when a plugin is reloaded.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import jwt
+from flask import request, make_response
+
+from ..analysis import tokenHelper
+
+logger = logging.getLogger(__name__)
+
+
+class MetaDataCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {len(self._entries)} entries ]"
+
+    @staticmethod
+    def request_key(app, endpoint):
+        """
+        returns the key of the current request, or None if it should not be served from the cache
+        """
+        instrument_name = request.values.get('instrument')
+        if instrument_name is None:
+            return None
+
+        roles = None
+        email = None
+        token = request.values.get('token')
+        if token not in ["", "None", None]:
+            try:
+                decoded_token = tokenHelper.get_decoded_token(token, app.config.get('conf').secret_key)
+            except jwt.exceptions.PyJWTError:
+                # the response will explain what is wrong with the token
+                return None
+            roles = tokenHelper.get_token_roles(decoded_token)
+            email = tokenHelper.get_token_user_email_address(decoded_token)
+
+        return (endpoint,
+                instrument_name,
+                request.values.get('product_type'),
+                tuple(sorted(roles)) if roles is not None else None,
+                email)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, mimetype):
+        entry = dict(body=body,
+                     mimetype=mimetype,
+                     etag=hashlib.md5(body).hexdigest())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        logger.info("instrument meta-data cache cleared")
+
+
+meta_data_cache = MetaDataCache()
+
+
+def meta_data_response(app, endpoint, build_response):
+    """
+    serves the response of a meta-data endpoint from the cache, calling build_response if needed;
+    the response carries an ETag, so that the clients can revalidate what they have
+    """
+    key = meta_data_cache.request_key(app, endpoint)
+
+    entry = None
+    if key is not None:
+        entry = meta_data_cache.get(key)
+
+    if entry is None:
+        response = build_response()
+        if key is None or response.status_code != 200:
+            return response
+        entry = meta_data_cache.set(key, response.get_data(), response.mimetype)
+
+    response = make_response(entry['body'])
+    response.mimetype = entry['mimetype']
+    response.set_etag(entry['etag'])
+    response.cache_control.no_cache = True
+    if key[3] is None and key[4] is None:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+
+    return response.make_conditional(request)
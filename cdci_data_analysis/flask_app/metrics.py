@@ -0,0 +1,348 @@
+"""
+Counters and histograms of the dispatcher, exposed by /metrics in the Prometheus text format.
+
+Each process counts in memory, and a background thread regularly writes its values to a SQLite database shared by
+the dispatcher processes of the host, e.g. the gunicorn workers, in which each of them has its own rows. The values
+exposed are the sums over all the processes, including those which exited, so that the counters never decrease when
+a worker is replaced: the rows of the processes which exited are added into those of the exited processes, by the
+process itself when it exits, or by the other processes of the host otherwise.
+
+The database is a local one (see ``local_sqlite``), its default path can be set with DISPATCHER_METRICS_PATH.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import atexit
+import socket
+import sqlite3
+import logging
+import threading
+
+from ..analysis.local_sqlite import LocalDatabase, default_path
+
+logger = logging.getLogger(__name__)
+
+EXITED_PROCESSES_ID = 'exited'
+
+DURATION_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRIC_FAMILIES = {
+    'dispatcher_requests_total':
+        ('counter', 'Requests served, by endpoint, method and status code.'),
+    'dispatcher_request_duration_seconds':
+        ('histogram', 'Duration of the requests, by endpoint.'),
+    'dispatcher_span_duration_seconds':
+        ('histogram', 'Duration of the steps of the requests.'),
+    'dispatcher_job_status_transitions_total':
+        ('counter', 'Job statuses written, by previous and new status.'),
+    'dispatcher_scratch_dir_lock_retries_total':
+        ('counter', 'Retries to acquire the lock for the creation of a scratch directory.'),
+    'dispatcher_scratch_dir_lock_failures_total':
+        ('counter', 'Scratch directories not created, the lock could not be acquired.'),
+    'dispatcher_product_gallery_requests_total':
+        ('counter', 'Requests to the product gallery, by method and outcome (success, retry, failure).'),
+    'dispatcher_notifications_total':
+        ('counter', 'Emails and matrix messages, by channel and outcome (sent, failed).'),
+    'dispatcher_celery_submissions_total':
+        ('counter', 'Requests submitted to celery by the asynchronous dispatcher.'),
+    'dispatcher_aliasing_decisions_total':
+        ('counter', 'Decisions to alias a request to an identical job, or not.'),
+}
+
+
+def default_metrics_path() -> str:
+    return default_path('metrics', 'DISPATCHER_METRICS_PATH')
+
+
+def is_process_running(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def labels_key(labels) -> str:
+    return json.dumps(sorted((str(k), str(v)) for k, v in (labels or {}).items()))
+
+
+def format_labels(labels) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def format_value(value) -> str:
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsRegistry:
+    def __init__(self, metrics_path=None, flush_interval_s=1, buckets=DURATION_BUCKETS_S, fold_interval_s=60):
+        self.metrics_path = metrics_path
+        self.flush_interval_s = flush_interval_s
+        self.fold_interval_s = fold_interval_s
+        self.buckets = tuple(buckets)
+
+        # (family, sample name, labels key) -> value, since the start of the process
+        self._samples = {}
+        self._dirty = set()
+        self._last_fold = 0
+        self._pid = None
+        self._process_id = None
+        self._folded = False
+        self._database = LocalDatabase(self._initialize)
+        self._lock = threading.Lock()
+
+        self._flusher = None
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._reset_after_fork = False
+
+    def __repr__(self):
+        return f"[ {self.__class__.__name__} : {len(self._samples)} samples, {self.metrics_path} ]"
+
+    def configure(self, metrics_path, flush_interval_s=1):
+        with self._lock:
+            self.metrics_path = metrics_path
+            self.flush_interval_s = flush_interval_s
+            self._dirty.update(self._samples)
+            self._database.reset()
+
+    def _ensure_process(self):
+        # a forked process starts counting from zero, under its own id, the parent keeps its values
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._process_id = f'{socket.gethostname()}-{self._pid}-{uuid.uuid4().hex[:8]}'
+            self._folded = False
+            self._samples.clear()
+            self._dirty.clear()
+
+    def _ensure_flusher(self):
+        if self.metrics_path is None or self._flusher_pid == os.getpid():
+            return
+
+        with self._flusher_lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                self._stopping.clear()
+                self._flusher = threading.Thread(target=self._run_flusher, name='metrics-flusher', daemon=True)
+                self._flusher.start()
+
+                if not self._reset_after_fork:
+                    os.register_at_fork(after_in_child=self._reset_in_child)
+                    self._reset_after_fork = True
+
+    def _reset_in_child(self):
+        # the flusher of the parent is not running in the child, and the locks might have been held by it
+        self._lock = threading.Lock()
+        self._flusher_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._flusher = None
+
+    def _run_flusher(self):
+        while not self._stopping.wait(self.flush_interval_s):
+            try:
+                self.flush()
+                if time.time() - self._last_fold >= self.fold_interval_s:
+                    self.fold_exited_processes()
+            except Exception as e:
+                logger.warning("unable to write the metrics to %s: %s", self.metrics_path, repr(e))
+
+    def stop_flusher(self, timeout_s=5):
+        if self._flusher is not None and self._flusher_pid == os.getpid():
+            self._stopping.set()
+            self._flusher.join(timeout=timeout_s)
+        self._flusher = None
+        self._flusher_pid = None
+
+    def _add(self, family, sample_name, labels, value):
+        key = (family, sample_name, labels_key(labels))
+        self._samples[key] = self._samples.get(key, 0) + value
+        self._dirty.add(key)
+
+    def inc(self, family, labels=None, value=1):
+        with self._lock:
+            self._ensure_process()
+            self._add(family, family, labels, value)
+        self._ensure_flusher()
+
+    def observe(self, family, value, labels=None):
+        labels = labels or {}
+        with self._lock:
+            self._ensure_process()
+            # the buckets are cumulative, as exposed
+            for upper_bound in self.buckets:
+                self._add(family, family + '_bucket', {**labels, 'le': str(upper_bound)}, 1 if value <= upper_bound else 0)
+            self._add(family, family + '_bucket', {**labels, 'le': '+Inf'}, 1)
+            self._add(family, family + '_count', labels, 1)
+            self._add(family, family + '_sum', labels, value)
+        self._ensure_flusher()
+
+    @staticmethod
+    def _initialize(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS metrics ("
+                     "process_id TEXT NOT NULL, "
+                     "family TEXT NOT NULL, "
+                     "name TEXT NOT NULL, "
+                     "labels TEXT NOT NULL, "
+                     "value REAL NOT NULL, "
+                     "PRIMARY KEY (process_id, family, name, labels))")
+
+    def _connect(self):
+        return self._database.connect(self.metrics_path)
+
+    def flush(self):
+        """
+        writes the values of this process which changed since the last flush
+        """
+        if self.metrics_path is None:
+            return
+
+        with self._lock:
+            self._ensure_process()
+            # the values of this process were already added into those of the exited processes
+            if self._folded:
+                return
+            rows = [(self._process_id, *key, self._samples[key]) for key in self._dirty]
+            dirty = self._dirty
+            self._dirty = set()
+
+        if len(rows) == 0:
+            return
+
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO metrics (process_id, family, name, labels, value) "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("unable to write the metrics to %s: %s", self.metrics_path, repr(e))
+            with self._lock:
+                self._dirty.update(dirty)
+
+    def _fold(self, conn, process_id):
+        conn.execute("INSERT INTO metrics (process_id, family, name, labels, value) "
+                     "SELECT ?, family, name, labels, value FROM metrics WHERE process_id = ? "
+                     "ON CONFLICT (process_id, family, name, labels) DO UPDATE SET value = value + excluded.value",
+                     (EXITED_PROCESSES_ID, process_id))
+        conn.execute("DELETE FROM metrics WHERE process_id = ?", (process_id,))
+
+    def fold_exited_processes(self) -> int:
+        """
+        adds the values of the processes of this host which exited into those of the exited processes,
+        and removes their rows; the processes of the other hosts are left to their own host
+        """
+        if self.metrics_path is None:
+            return 0
+
+        self._last_fold = time.time()
+        process_id_pattern = re.compile(rf'^{re.escape(socket.gethostname())}-(?P<pid>\d+)-[0-9a-f]{{8}}$')
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            exited_process_ids = []
+            for process_id, in conn.execute("SELECT DISTINCT process_id FROM metrics").fetchall():
+                r = process_id_pattern.match(process_id)
+                if r is None or process_id == self._process_id:
+                    continue
+                # the pid of this process was used by another one, which exited
+                if int(r.group('pid')) == os.getpid() or not is_process_running(int(r.group('pid'))):
+                    exited_process_ids.append(process_id)
+
+            for process_id in exited_process_ids:
+                self._fold(conn, process_id)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        if len(exited_process_ids) > 0:
+            logger.info("metrics of the exited processes %s folded", exited_process_ids)
+        return len(exited_process_ids)
+
+    def close(self):
+        """
+        writes the values of this process, and adds them into those of the exited processes
+        """
+        self.stop_flusher()
+        if self.metrics_path is None or self._process_id is None or self._pid != os.getpid():
+            return
+
+        self.flush()
+        with self._lock:
+            self._folded = True
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._fold(conn, self._process_id)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def collect(self) -> dict:
+        """
+        the values of all the processes, summed
+        """
+        if self.metrics_path is None:
+            with self._lock:
+                self._ensure_process()
+                return dict(self._samples)
+
+        self.flush()
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT family, name, labels, SUM(value) FROM metrics "
+                                "GROUP BY family, name, labels").fetchall()
+        finally:
+            conn.close()
+
+        return {(family, name, labels): value for family, name, labels, value in rows}
+
+    def render(self) -> str:
+        families = {}
+        for (family, name, labels), value in self.collect().items():
+            # the bucket bound comes last, as usual
+            labels = sorted((tuple(label) for label in json.loads(labels)), key=lambda label: label[0] == 'le')
+            families.setdefault(family, []).append((name, labels, value))
+
+        order = list(METRIC_FAMILIES)
+        lines = []
+        for family in sorted(families, key=lambda f: (order.index(f) if f in order else len(order), f)):
+            metric_type, help_text = METRIC_FAMILIES.get(family, ('untyped', ''))
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {metric_type}')
+
+            def sort_key(sample):
+                name, labels, _ = sample
+                le = dict(labels).get('le')
+                return ([label for label in labels if label[0] != 'le'], name, float(le) if le is not None else 0)
+
+            for name, labels, value in sorted(families[family], key=sort_key):
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+@atexit.register
+def close_metrics():
+    try:
+        metrics.close()
+    except Exception as e:
+        logger.warning("unable to write the metrics at exit: %s", repr(e))
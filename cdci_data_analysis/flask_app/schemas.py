@@ -91,11 +91,17 @@ class JobStatusSchema(Schema):
                                   required=True)
 
 
-class StateJobsInspectionScheme(Schema):
+class StateInspectionPaginationScheme(Schema):
+    next_cursor = fields.Str(description="Cursor to pass to the next request to fetch the following records",
+                             required=False, allow_none=True)
+    more_records = fields.Boolean(description="Are there more records after this page?", required=False)
+
+
+class StateJobsInspectionScheme(StateInspectionPaginationScheme):
     records = fields.List(fields.Nested(JobStatusSchema), required=False)
 
 
-class StateScratchDirsInspectionScheme(Schema):
+class StateScratchDirsInspectionScheme(StateInspectionPaginationScheme):
     records = fields.List(fields.Dict, required=False)
 
 
@@ -1,4 +1,8 @@
+import time
 import logging
+import threading
+from collections import Counter
+
 import sentry_sdk
 
 # logger = logging.getLogger(__name__)
@@ -7,6 +11,14 @@ class Sentry:
     def __init__(self) -> None:
         self._app = None
         self.logger = logging.getLogger(repr(self))
+        self.counters = Counter()
+
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        # messages captured in the current window, and the number of times each of them was seen
+        self._window_start = None
+        self._window_messages = Counter()
+        self._capture_lock = threading.Lock()
 
     @property
     def app(self):
@@ -27,13 +39,26 @@ class Sentry:
         return self._sentry_url
 
     @property
-    def have_sentry(self):
-        if self.sentry_url is None:
-            return False
-        else:
+    def capture_window_s(self):
+        return getattr(self.app.config.get('conf'), 'sentry_capture_window_s', 60)
+
+    @property
+    def capture_max_messages(self):
+        return getattr(self.app.config.get('conf'), 'sentry_capture_max_messages', 20)
+
+    def init(self):
+        # the client, with its background transport thread, is set up once; the forked processes inherit it
+        # and the sdk restarts the transport thread in each of them
+        if self._initialized:
+            return
+
+        with self._init_lock:
+            if self._initialized:
+                return
+
             try:
                 sentry_sdk.init(
-                    dsn=self._sentry_url,
+                    dsn=self.sentry_url,
                     # Set traces_sample_rate to 1.0 to capture 100%
                     # of transactions for performance monitoring.
                     # We recommend adjusting this value in production.
@@ -41,21 +66,74 @@ class Sentry:
                     debug=False,
                     max_breadcrumbs=10,
                     environment=getattr(self.app.config.get('conf'), 'sentry_environment', 'production'),
-                    before_send=self.filter_event
+                    before_send=self.filter_event,
+                    # the events are sent by the background thread of the transport, the process only waits
+                    # that long for the queued ones at exit
+                    shutdown_timeout=2
                 )
             except Exception as e:
                 self.logger.warning("can not setup sentry with URL %s due to %s", self.sentry_url, e)
 
+            self._initialized = True
+
+    @property
+    def have_sentry(self):
+        if self.sentry_url is None:
+            return False
+        else:
+            self.init()
             return True
 
+    def _admit(self, message: str) -> bool:
+        """
+        tells if the message should be sent: only the first occurrence of each message in a window is, and at most
+        capture_max_messages of them. What was held back in the previous window is summarized when a new one starts.
+        """
+        summary = None
+        now = time.time()
+        with self._capture_lock:
+            if self._window_start is None or now - self._window_start >= self.capture_window_s:
+                n_repeated = sum(n - 1 for n in self._window_messages.values())
+                n_limited = max(0, len(self._window_messages) - self.capture_max_messages)
+                if n_repeated + n_limited > 0:
+                    summary = (f"{n_repeated} repeated and {n_limited} rate-limited messages were not sent to sentry "
+                               f"in the last {now - self._window_start:.0f} s")
+                self._window_start = now
+                self._window_messages.clear()
+
+            self._window_messages[message] += 1
+            if self._window_messages[message] > 1:
+                self.counters['coalesced'] += 1
+                admitted = False
+            elif len(self._window_messages) > self.capture_max_messages:
+                self.counters['rate_limited'] += 1
+                admitted = False
+            else:
+                self.counters['sent'] += 1
+                admitted = True
+
+        if summary is not None:
+            self.logger.warning(summary)
+            sentry_sdk.capture_message(summary)
+
+        return admitted
+
     def capture_message(self, message: str):
         if self.have_sentry:
             self.logger.warning(message)
 
-            sentry_sdk.capture_message(message)
+            if self._admit(message):
+                sentry_sdk.capture_message(message)
+            else:
+                self.logger.info("message already sent to sentry or sentry rate limit reached, not sending it again")
         else:
             self.logger.warning("sentry not used, dropping %s", message)
 
+    def stats(self) -> dict:
+        return dict(sent=self.counters['sent'],
+                    coalesced=self.counters['coalesced'],
+                    rate_limited=self.counters['rate_limited'])
+
     @staticmethod
     def filter_event(event, hint):
         message = event.get("message", None)
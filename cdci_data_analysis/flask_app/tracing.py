@@ -0,0 +1,65 @@
+"""
+Timing spans of the dispatcher requests.
+
+The duration of each span is kept in the request, and returned in its Server-Timing header, and it is added to a
+histogram exposed by /metrics. When enabled, and if opentelemetry is installed, the spans are also
+opentelemetry spans, exported by the tracer provider set up for the process.
+"""
+
+import time
+import logging
+from contextlib import contextmanager, ExitStack
+
+from flask import g, has_app_context
+
+from .metrics import metrics
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+_opentelemetry_spans = False
+
+
+def configure(opentelemetry_spans=False):
+    global _opentelemetry_spans
+
+    if opentelemetry_spans and otel_trace is None:
+        logger.warning("opentelemetry spans requested, but opentelemetry is not installed")
+    _opentelemetry_spans = opentelemetry_spans and otel_trace is not None
+
+
+@contextmanager
+def span(name):
+    """
+    times the block, or the function it decorates
+    """
+    with ExitStack() as stack:
+        if _opentelemetry_spans:
+            stack.enter_context(otel_trace.get_tracer(__name__).start_as_current_span(name))
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_s = time.perf_counter() - t0
+            metrics.observe('dispatcher_span_duration_seconds', duration_s, {'span': name})
+            if has_app_context():
+                g.setdefault('spans', []).append((name, duration_s))
+
+
+def request_spans() -> list:
+    if has_app_context():
+        return list(g.get('spans', []))
+    return []
+
+
+def server_timing_header(spans, total_s=None) -> str:
+    # the durations of the Server-Timing header are in milliseconds
+    entries = [f'{name};dur={duration_s * 1000:.1f}' for name, duration_s in spans]
+    if total_s is not None:
+        entries.append(f'total;dur={total_s * 1000:.1f}')
+    return ', '.join(entries)
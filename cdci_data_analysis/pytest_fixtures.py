@@ -10,6 +10,7 @@ from cdci_data_analysis.flask_app.dispatcher_query import InstrumentQueryBackEnd
 from cdci_data_analysis.analysis.hash import make_hash, make_hash_file
 from cdci_data_analysis.configurer import ConfigEnv
 from cdci_data_analysis.analysis.email_helper import textify_email
+from cdci_data_analysis.analysis.job_index import job_index
 
 from oda_api.api import RemoteException
 
@@ -33,6 +34,7 @@ import glob
 import uuid
 
 from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from collections import OrderedDict
 from urllib import parse
 
@@ -314,6 +316,43 @@ def dispatcher_local_mail_server(pytestconfig, dispatcher_test_conf):
     controller.stop()
 
 
+@pytest.fixture
+def local_http_server():
+    """
+    a local http server answering the get requests with the json responses queued by the test, or with their path
+    """
+    responses = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status_code, body):
+            content = json.dumps(body).encode()
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/hal+json')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Set-Cookie', 'SESSabc=user-session; Path=/')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self.send_json(*(responses.pop(0) if responses else (200, {'path': self.path})))
+
+        do_DELETE = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_port}', responses
+
+    server.shutdown()
+    server.server_close()
+
+
 @pytest.fixture
 def dispatcher_local_matrix_message_server(dispatcher_test_conf_with_matrix_options):
 
@@ -494,13 +533,41 @@ dispatcher:
     dispatcher_callback_url_base: http://0.0.0.0:8011
     sentry_url: "https://2ba7e5918358439485632251fa73658c@sentry.io/1467382"
     sentry_environment: "production"
+    sentry_capture_window_s: 60
+    sentry_capture_max_messages: 20
     logstash_host: 
     logstash_port: 
+    logstash_options:
+        logstash_codec: json
+        logstash_queue_size: 1000
+        logstash_batch_size: 100
+        request_summary_max_field_length: 1000
+    tracing_options:
+        server_timing: True
+        opentelemetry_spans: False
+    metrics_options:
+        metrics_path: null
+        metrics_flush_interval_s: 1
     secret_key: 'secretkey_test'
     token_max_refresh_interval: 604800
     resubmit_timeout: 1800
+    job_id_hash_mode: legacy
+    reuse_instrument_templates: true
+    notification_outbox_options:
+        notification_outbox_enabled: false
+        notification_outbox_path: null
+        notification_outbox_workers: 2
+        notification_outbox_max_attempts: 5
+        notification_outbox_retry_delay_s: 10
+        notification_outbox_retention_s: 604800
     soft_minimum_folder_age_days: 5
     hard_minimum_folder_age_days: 30
+    download_options:
+        download_cache_dir: .download_cache
+        download_cache_max_size_mb: 1024
+    upload_options:
+        upload_hash_algorithm: md5
+        upload_hash_chunk_size: 1048576
     bind_options:
         bind_host: 0.0.0.0
         bind_port: 8011
@@ -514,6 +581,8 @@ dispatcher:
         bcc_receivers_email_addresses: ['teamBcc@odahub.io']
         smtp_port: 61025
         smtp_server_password: ''
+        smtp_connection_pool_size: 2
+        smtp_connection_max_idle_s: 60
         email_sending_timeout: True
         email_sending_timeout_default_threshold: 1800
         email_sending_job_submitted: True
@@ -592,6 +661,19 @@ def dispatcher_test_conf_no_resubmit_timeout_fn(dispatcher_test_conf_fn):
     yield fn
 
 
+@pytest.fixture
+def dispatcher_test_conf_no_download_cache_fn(dispatcher_test_conf_fn):
+    fn = dispatcher_test_conf_fn
+    with open(fn, "r+") as f:
+        data = f.read()
+        data = re.sub('(\s+download_cache_max_size_mb:).*\n', '\n        download_cache_max_size_mb: 0\n', data)
+        f.seek(0)
+        f.write(data)
+        f.truncate()
+
+    yield fn
+
+
 @pytest.fixture
 def dispatcher_test_conf_with_gallery_fn(dispatcher_test_conf_fn):
     fn = "test-dispatcher-conf-with-gallery.yaml"
@@ -607,7 +689,15 @@ def dispatcher_test_conf_with_gallery_fn(dispatcher_test_conf_fn):
                 '\n        local_name_resolver_url: "https://resolver-prod.obsuks1.unige.ch/api/v1.1/byname/{}"'
                 '\n        external_name_resolver_url: "http://cdsweb.u-strasbg.fr/cgi-bin/nph-sesame/-oxp/NSV?{}"'
                 '\n        entities_portal_url: "http://cdsportal.u-strasbg.fr/?target={}"'
-                '\n        converttime_revnum_service_url: "https://www.astro.unige.ch/mmoda/dispatch-data/gw/timesystem/api/v1.0/converttime/UTC/{}/REVNUM"')
+                '\n        converttime_revnum_service_url: "https://www.astro.unige.ch/mmoda/dispatch-data/gw/timesystem/api/v1.0/converttime/UTC/{}/REVNUM"'
+                '\n        gallery_lookup_cache_ttl_s: 300'
+                '\n        gallery_lookup_cache_max_entries: 1024'
+                '\n        gallery_upload_max_workers: 4'
+                '\n        name_resolver_cache_path: .name_resolver_cache.sqlite'
+                '\n        name_resolver_cache_positive_ttl_s: 604800'
+                '\n        name_resolver_cache_negative_ttl_s: 3600'
+                '\n        revnum_cache_path: .revnum_cache.sqlite'
+                '\n        revnum_cache_max_entries: 4096')
 
     yield fn
 
@@ -713,7 +803,8 @@ def dispatcher_test_conf_with_renku_options_fn(dispatcher_test_conf_fn):
         f.write('\n    renku_options:'
                 '\n        renku_gitlab_repository_url: "git@gitlab.renkulab.io:gabriele.barni/old-test-dispatcher-endpoint.git"'
                 '\n        renku_base_project_url: "http://renkulab.io/projects"'
-               f'\n        ssh_key_path: "{os.getenv("SSH_KEY_FILE", "ssh_key_file")}"')
+               f'\n        ssh_key_path: "{os.getenv("SSH_KEY_FILE", "ssh_key_file")}"'
+                '\n        renku_repository_mirror_dir: ".renku_mirrors"')
 
     yield fn
 
@@ -1003,6 +1094,7 @@ def empty_products_files_fixture(default_params_dict):
     scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
     # set the scratch directory
     os.makedirs(scratch_dir_path)
+    job_index.register_scratch_dir(scratch_dir_path)
 
     with open(scratch_dir_path + '/test.fits.gz', 'wb') as fout:
         scratch_params['content'] = os.urandom(20)
@@ -1068,6 +1160,7 @@ def empty_products_user_files_fixture(default_params_dict, default_token_payload
     scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
     # set the scratch directory
     os.makedirs(scratch_dir_path)
+    job_index.register_scratch_dir(scratch_dir_path)
 
     with open(scratch_dir_path + '/test.fits.gz', 'wb') as fout:
         scratch_params['content'] = os.urandom(20)
@@ -1252,6 +1345,19 @@ def dispatcher_live_fixture_no_resubmit_timeout(pytestconfig, dispatcher_test_co
     os.kill(pid, signal.SIGINT)
 
 
+@pytest.fixture
+def dispatcher_live_fixture_no_download_cache(pytestconfig, dispatcher_test_conf_no_download_cache_fn, dispatcher_debug):
+    dispatcher_state = start_dispatcher(pytestconfig.rootdir, dispatcher_test_conf_no_download_cache_fn)
+
+    service = dispatcher_state['url']
+    pid = dispatcher_state['pid']
+
+    yield service
+
+    kill_child_processes(pid, signal.SIGINT)
+    os.kill(pid, signal.SIGINT)
+
+
 @pytest.fixture
 def dispatcher_live_fixture_no_debug_mode(pytestconfig, dispatcher_test_conf_fn, dispatcher_nodebug):
     dispatcher_state = start_dispatcher(pytestconfig.rootdir, dispatcher_test_conf_fn)
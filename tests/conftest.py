@@ -6,6 +6,7 @@ from cdci_data_analysis.pytest_fixtures import (
             dispatcher_local_mail_server,
             dispatcher_local_mail_server_subprocess,
             dispatcher_local_matrix_message_server,
+            local_http_server,
             dispatcher_live_fixture,
             gunicorn_dispatcher_live_fixture,
             dispatcher_live_fixture_no_debug_mode,
@@ -42,6 +43,8 @@ from cdci_data_analysis.pytest_fixtures import (
             dispatcher_live_fixture_no_products_url,
             dispatcher_live_fixture_no_resubmit_timeout,
             dispatcher_test_conf_no_resubmit_timeout,
+            dispatcher_live_fixture_no_download_cache,
+            dispatcher_test_conf_no_download_cache_fn,
             dispatcher_test_conf_fn,
             dispatcher_debug,
             sentry_sdk_fixture,
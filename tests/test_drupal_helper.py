@@ -0,0 +1,156 @@
+import io
+import json
+import time
+import types
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from cdci_data_analysis.analysis import drupal_helper
+from cdci_data_analysis.analysis.exceptions import InternalError
+
+
+@pytest.fixture
+def local_gallery_upload_server():
+    state = types.SimpleNamespace(uploaded={}, deleted=[], n_posted=0, n_uploading=0, max_n_uploading=0, lock=threading.Lock())
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status_code, body):
+            content = json.dumps(body).encode()
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/hal+json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_POST(self):
+            file_name = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['filename'][0]['value']
+            with state.lock:
+                state.n_uploading += 1
+                state.max_n_uploading = max(state.max_n_uploading, state.n_uploading)
+            time.sleep(0.2)
+            with state.lock:
+                state.n_uploading -= 1
+                state.n_posted += 1
+                fid = state.n_posted
+                if not file_name.startswith('broken'):
+                    state.uploaded[fid] = file_name
+
+            if file_name.startswith('broken'):
+                self.send_json(500, {'message': 'broken file'})
+            else:
+                self.send_json(201, {'fid': [{'value': fid}]})
+
+        def do_DELETE(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            state.deleted.append(int(self.path.split('/')[2].split('?')[0]))
+            self.send_json(200, {})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_port}', state
+
+    server.shutdown()
+    server.server_close()
+
+
+def make_upload_files(*file_names):
+    return {key: FileStorage(stream=io.BytesIO(b'content'), filename=file_name) for key, file_name in file_names}
+
+
+@pytest.mark.fast
+def test_gallery_lookup_cache(local_http_server, monkeypatch):
+    url, responses = local_http_server
+    lookup_cache = drupal_helper.GalleryLookupCache(ttl_s=300, max_entries=10)
+    monkeypatch.setattr(drupal_helper, 'gallery_lookup_cache', lookup_cache)
+
+    responses.append((200, [{'title': '0001'}, {'title': '0002'}]))
+    assert drupal_helper.get_all_revolutions(url, 'token') == ['0001', '0002']
+    # served from the cache, the default response of the server would not be a list
+    assert drupal_helper.get_all_revolutions(url, 'other-token') == ['0001', '0002']
+    assert lookup_cache.stats()['revolutions'] == dict(hits=1, misses=1, entries=1)
+
+    # the users not found are looked up again
+    assert drupal_helper.get_user_id(url, 'mtm@mtmco.net') is None
+    responses.append((200, [{'uid': [{'value': 1}]}]))
+    assert drupal_helper.get_user_id(url, 'mtm@mtmco.net') == [{'value': 1}]
+    assert drupal_helper.get_user_id(url, 'mtm@mtmco.net') == [{'value': 1}]
+    assert lookup_cache.stats()['users'] == dict(hits=1, misses=2, entries=1)
+
+    lookup_cache.invalidate('revolutions')
+    responses.append((200, [{'title': '0003'}]))
+    assert drupal_helper.get_all_revolutions(url, 'token') == ['0003']
+    assert lookup_cache.stats()['users']['entries'] == 1
+
+    # deleting content from the gallery invalidates the lookups listing content
+    drupal_helper.delete_node_gallery(url, 1, 'token')
+    responses.append((200, [{'title': '0005'}]))
+    assert drupal_helper.get_all_revolutions(url, 'token') == ['0005']
+    assert drupal_helper.get_all_revolutions(url, 'token') == ['0005']
+    assert lookup_cache.stats()['users']['entries'] == 1
+
+    # expired
+    lookup_cache.ttl_s = 0.1
+    lookup_cache.invalidate('revolutions')
+    assert drupal_helper.get_all_revolutions(url, 'token') == []
+    time.sleep(0.2)
+    responses.append((200, [{'title': '0004'}]))
+    assert drupal_helper.get_all_revolutions(url, 'token') == ['0004']
+    assert lookup_cache.stats()['revolutions'] == dict(hits=2, misses=5, entries=1)
+
+    lookup_cache.configure(ttl_s=0, max_entries=10)
+    assert not lookup_cache.enabled
+    responses.append((200, [{'title': '0001'}]))
+    assert drupal_helper.get_all_revolutions(url, 'token') == ['0001']
+    assert drupal_helper.get_all_revolutions(url, 'token') == []
+
+
+@pytest.mark.fast
+def test_post_files_to_gallery(local_gallery_upload_server):
+    url, state = local_gallery_upload_server
+
+    files = make_upload_files(('img', 'image.png'),
+                              *[(f'fits_file_{i}', f'file_{i}.fits') for i in range(5)])
+    fids = drupal_helper.post_files_to_gallery(url, files, 'token', max_workers=3)
+
+    assert list(fids) == list(files)
+    assert [state.uploaded[fid] for fid in fids.values()] == [file.filename for file in files.values()]
+    assert 1 < state.max_n_uploading <= 3
+
+
+@pytest.mark.fast
+def test_post_files_to_gallery_failed(local_gallery_upload_server):
+    url, state = local_gallery_upload_server
+
+    files = make_upload_files(('fits_file_0', 'file_0.fits'),
+                              ('fits_file_1', 'broken.fits'),
+                              ('fits_file_2', 'file_2.fits'))
+    with pytest.raises(InternalError):
+        drupal_helper.post_files_to_gallery(url, files, 'token', max_workers=3)
+
+    # the files uploaded are not left orphaned in the gallery
+    assert sorted(state.deleted) == sorted(state.uploaded)
+    assert len(state.deleted) == 2
+
+
+@pytest.mark.fast
+def test_post_files_to_gallery_failed_cancelled(local_gallery_upload_server):
+    url, state = local_gallery_upload_server
+
+    files = make_upload_files(('fits_file_0', 'broken.fits'),
+                              *[(f'fits_file_{i}', f'file_{i}.fits') for i in range(1, 5)])
+    with pytest.raises(InternalError):
+        drupal_helper.post_files_to_gallery(url, files, 'token', max_workers=2)
+
+    # the uploads not started when the first one failed are cancelled
+    assert state.n_posted < len(files)
+    assert sorted(state.deleted) == sorted(state.uploaded)
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+import pytest
+
+from cdci_data_analysis.analysis.hash import make_hash, canonical_serialization
+
+
+def request_parameters(scw_list=('066500230010.001', '066500250010.001')):
+    return OrderedDict(instrument='empty',
+                       product_type='dummy',
+                       RA=83.63,
+                       DEC=22.01,
+                       T1='2001-12-11T00:00:00.000',
+                       scw_list=list(scw_list),
+                       selected_catalog='{"cat_column_list": [[1, 2]], "cat_frame": "fk5"}',
+                       p=1,
+                       debug=True)
+
+
+@pytest.mark.fast
+def test_make_hash_legacy():
+    # values computed by the previous versions, stored as job_ids
+    assert make_hash(request_parameters()) == 'dc01453f13fa6098'
+    assert make_hash(['b', 'a']) == 'c32258940d028858'
+    assert make_hash("x") == '3690e9a2315c5199'
+    assert make_hash({"a": {"b": None}}) == '583cd7469302671b'
+    assert make_hash({}) == make_hash([]) == 'd751713988987e93'
+
+    long_string = '"\\é ' * 1000
+    assert make_hash(long_string) == make_hash(long_string[::-1])
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize("hash_mode", ['legacy', 'canonical'])
+def test_make_hash_order(hash_mode):
+    par_dic = request_parameters()
+    reordered_par_dic = OrderedDict(reversed(list(request_parameters(scw_list=reversed(par_dic['scw_list'])).items())))
+
+    assert make_hash(par_dic, hash_mode=hash_mode) == make_hash(reordered_par_dic, hash_mode=hash_mode)
+    assert canonical_serialization(par_dic) == canonical_serialization(reordered_par_dic)
+
+    assert make_hash(par_dic, hash_mode=hash_mode) != \
+           make_hash(request_parameters(scw_list=['066500230010.001']), hash_mode=hash_mode)
+    assert make_hash({'a': 1}, hash_mode=hash_mode) != make_hash({'a': 1.0}, hash_mode=hash_mode)
+    assert len(make_hash(par_dic, hash_mode=hash_mode)) == 16
+
+
+@pytest.mark.fast
+def test_make_hash_canonical():
+    assert make_hash(request_parameters(), hash_mode='canonical') != make_hash(request_parameters())
+    assert make_hash('ab', hash_mode='canonical') != make_hash('ba', hash_mode='canonical')
+
+    with pytest.raises(ValueError):
+        make_hash(request_parameters(), hash_mode='unknown')
@@ -0,0 +1,45 @@
+import pytest
+
+from cdci_data_analysis.analysis import drupal_helper
+from cdci_data_analysis.analysis.http_client import HTTPClient
+
+
+@pytest.mark.fast
+def test_http_client_keep_alive(local_http_server):
+    url, _ = local_http_server
+    events = []
+
+    http_client = HTTPClient('test', timeout=5)
+    http_client.add_hook(lambda client_name, event, **info: events.append((client_name, event, info.get('status_code'))))
+
+    for i in range(3):
+        assert http_client.get(f'{url}/node/{i}').json() == {'path': f'/node/{i}'}
+
+    stats = http_client.stats()
+    assert stats['requests'] == 3
+    assert stats['connections_opened'] == 1
+    assert events == [('test', 'request', 200)] * 3
+
+    # shared by the requests of all the users, the session does not keep their cookies
+    assert len(http_client.session.cookies) == 0
+
+    http_client.close()
+
+
+@pytest.mark.fast
+def test_drupal_request_retry(local_http_server, monkeypatch):
+    url, responses = local_http_server
+    monkeypatch.setattr(drupal_helper, 'retry_sleep_s', 0)
+
+    events = []
+    hook = lambda client_name, event, **info: events.append(event)
+    drupal_helper.gallery_http_client.add_hook(hook)
+    try:
+        responses.append((403, {'message': 'not completed'}))
+        res = drupal_helper.execute_drupal_request(f'{url}/user/1')
+    finally:
+        drupal_helper.gallery_http_client.remove_hook(hook)
+
+    assert res.json() == {'path': '/user/1?_format=hal_json'}
+    assert events == ['request', 'retry', 'request']
+    assert drupal_helper.gallery_http_client.stats()['pools'][f'http://{url.split("//")[1]}']['connections_opened'] == 1
@@ -0,0 +1,170 @@
+import os
+import time
+import shutil
+import contextlib
+
+import pytest
+
+from cdci_data_analysis.analysis.job_index import JobIndex, parse_scratch_dir_name
+
+
+@contextlib.contextmanager
+def remember_cwd():
+    curdir = os.getcwd()
+    try: yield
+    finally: os.chdir(curdir)
+
+
+def test_parse_scratch_dir_name():
+    assert parse_scratch_dir_name('scratch_sid_01234567890ABCDE_jid_0123456789abcdef') == \
+           dict(session_id='01234567890ABCDE', job_id='0123456789abcdef', aliased=False)
+    assert parse_scratch_dir_name('scratch_sid_01234567890ABCDE_jid_0123456789abcdef_aliased') == \
+           dict(session_id='01234567890ABCDE', job_id='0123456789abcdef', aliased=True)
+    assert parse_scratch_dir_name('scratch_jid_0123456789abcdef')['session_id'] is None
+    assert parse_scratch_dir_name('scratch_sid_01234567890ABCDE') is None
+    assert parse_scratch_dir_name('download_0123456789abcdef') is None
+
+
+@pytest.mark.fast
+def test_job_index(tmpdir):
+    with remember_cwd():
+        os.chdir(tmpdir)
+
+        os.makedirs('scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef')
+        os.makedirs('scratch_sid_BBBBBBBBBBBBBBBB_jid_0123456789abcdef_aliased')
+
+        job_index = JobIndex()
+
+        # existing directories are indexed at the first access
+        assert job_index.find_scratch_dirs('0123456789abcdef') == [
+            'scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef',
+            'scratch_sid_BBBBBBBBBBBBBBBB_jid_0123456789abcdef_aliased'
+        ]
+        assert job_index.find_scratch_dirs('0123456789abcdef', aliased=False) == [
+            'scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef'
+        ]
+
+        # directories created outside the dispatcher are found on disk when the index has no entry for the job
+        os.makedirs('scratch_sid_CCCCCCCCCCCCCCCC_jid_fedcba9876543210')
+        assert job_index.find_scratch_dirs('fedcba9876543210') == ['scratch_sid_CCCCCCCCCCCCCCCC_jid_fedcba9876543210']
+
+        # or when asked to
+        os.makedirs('scratch_sid_EEEEEEEEEEEEEEEE_jid_0123456789abcdef')
+        assert job_index.find_scratch_dirs('0123456789abcdef', aliased=False) == [
+            'scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef'
+        ]
+        assert job_index.find_scratch_dirs('0123456789abcdef', aliased=False, scan_disk=True) == [
+            'scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef',
+            'scratch_sid_EEEEEEEEEEEEEEEE_jid_0123456789abcdef'
+        ]
+        # unless the working directory was not modified since the previous scan
+        os.utime('.', ns=(time.time_ns() - 10 ** 10, time.time_ns() - 10 ** 10))
+        assert job_index.register_job_scratch_dirs_from_disk('0123456789abcdef') == 0
+        assert job_index.register_job_scratch_dirs_from_disk('0123456789abcdef', if_changed=True) == 0
+        os.makedirs('scratch_sid_HHHHHHHHHHHHHHHH_jid_0123456789abcdef')
+        assert job_index.register_job_scratch_dirs_from_disk('0123456789abcdef', if_changed=True) == 1
+        shutil.rmtree('scratch_sid_HHHHHHHHHHHHHHHH_jid_0123456789abcdef')
+        job_index.remove_scratch_dir('scratch_sid_HHHHHHHHHHHHHHHH_jid_0123456789abcdef')
+        # or not at all
+        os.makedirs('scratch_sid_FFFFFFFFFFFFFFFF_jid_0123456789abcdee')
+        assert job_index.find_scratch_dirs('0123456789abcdee', scan_disk=False) == []
+        assert job_index.find_scratch_dirs('0123456789abcdee') == ['scratch_sid_FFFFFFFFFFFFFFFF_jid_0123456789abcdee']
+        shutil.rmtree('scratch_sid_EEEEEEEEEEEEEEEE_jid_0123456789abcdef')
+        shutil.rmtree('scratch_sid_FFFFFFFFFFFFFFFF_jid_0123456789abcdee')
+
+        # the listings do not check the directories on disk, the removed ones are dropped by the lookups of their job
+        assert len(job_index.list_scratch_dirs()) == 5
+        assert job_index.find_scratch_dirs('0123456789abcdee') == []
+        job_index.remove_scratch_dir('scratch_sid_EEEEEEEEEEEEEEEE_jid_0123456789abcdef')
+
+        job_index.update_status('scratch_sid_CCCCCCCCCCCCCCCC_jid_fedcba9876543210', 'done')
+        assert job_index.find_job_records('fedcba9876543210')[0]['status'] == 'done'
+
+        assert job_index.list_scratch_dirs(job_id_prefix='fedcba98') == ['scratch_sid_CCCCCCCCCCCCCCCC_jid_fedcba9876543210']
+        assert len(job_index.list_scratch_dirs()) == 3
+
+        # removed directories disappear from the index
+        shutil.rmtree('scratch_sid_BBBBBBBBBBBBBBBB_jid_0123456789abcdef_aliased')
+        assert job_index.find_scratch_dirs('0123456789abcdef') == ['scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef']
+
+        # directories created by another host are listed once the working directory is scanned
+        os.makedirs('scratch_sid_DDDDDDDDDDDDDDDD_jid_0000000000000000')
+        assert len(job_index.list_scratch_dirs()) == 2
+        assert job_index.register_scratch_dirs_from_disk() == 1
+        assert len(job_index.list_scratch_dirs()) == 3
+
+        os.makedirs('scratch_sid_GGGGGGGGGGGGGGGG_jid_0000000000000001')
+        assert job_index.register_scratch_dirs_from_disk(min_interval=3600) == 0
+        assert job_index.register_scratch_dirs_from_disk() == 1
+        shutil.rmtree('scratch_sid_GGGGGGGGGGGGGGGG_jid_0000000000000001')
+
+        assert job_index.rebuild_from_disk() == 3
+        assert job_index.find_scratch_dirs('0000000000000000') == ['scratch_sid_DDDDDDDDDDDDDDDD_jid_0000000000000000']
+
+
+@pytest.mark.fast
+def test_notification_ledger(tmpdir):
+    with remember_cwd():
+        os.chdir(tmpdir)
+
+        # history of a job sent before the ledger existed
+        scratch_dir = 'scratch_sid_AAAAAAAAAAAAAAAA_jid_0123456789abcdef'
+        os.makedirs(os.path.join(scratch_dir, 'email_history'))
+        for file_name in ['email_submitted_1700000010.0_1700000000.0.email',
+                          'email_submitted_1700000020.0_1700000000.0.email',
+                          'email_history_log_submitted_1700000020.0_0123456789abcdef.log',
+                          'not_sent_email_1700000030.0.email',
+                          'email_submitted_notatime_1700000000.0.email']:
+            open(os.path.join(scratch_dir, 'email_history', file_name), 'w').close()
+
+        job_index = JobIndex()
+
+        submitted_emails = job_index.find_notifications('email', 'submitted', job_id='0123456789abcdef')
+        assert [email['sending_time'] for email in submitted_emails] == [1700000010.0, 1700000020.0]
+        assert job_index.last_notification_time('email', 'submitted', '0123456789abcdef') == 1700000020.0
+        assert job_index.first_notification('email', 'submitted', scratch_dir)['first_submitted_time'] == 1700000000.0
+        assert job_index.find_notifications('email', 'done', job_id='0123456789abcdef') == []
+        assert job_index.find_notifications('matrix', 'submitted', job_id='0123456789abcdef') == []
+
+        # notifications sent from another session
+        aliased_scratch_dir = 'scratch_sid_BBBBBBBBBBBBBBBB_jid_0123456789abcdef_aliased'
+        os.makedirs(os.path.join(aliased_scratch_dir, 'matrix_message_history'))
+        matrix_message_file = os.path.join(aliased_scratch_dir, 'matrix_message_history',
+                                           'matrix_message_done_1700000100.0_1700000000.0.json')
+        open(matrix_message_file, 'w').close()
+        job_index.register_scratch_dir(aliased_scratch_dir)
+        job_index.record_notification(aliased_scratch_dir, 'matrix', 'done', matrix_message_file,
+                                      sending_time=1700000100.0, first_submitted_time=1700000000.0)
+
+        done_matrix_message, = job_index.find_notifications('matrix', 'done', job_id='0123456789abcdef')
+        assert done_matrix_message['notification_file'] == matrix_message_file
+        assert job_index.first_notification('matrix', 'done', scratch_dir) is None
+
+        # notifications sent by another host, with its own job index, are read from the history when the ledger has none
+        done_email_file = os.path.join(scratch_dir, 'email_history', 'email_done_1700000200.0_1700000000.0.email')
+        open(done_email_file, 'w').close()
+        done_email, = job_index.find_notifications('email', 'done', job_id='0123456789abcdef')
+        assert done_email['notification_file'] == done_email_file
+        assert job_index.first_notification('email', 'done', scratch_dir)['sending_time'] == 1700000200.0
+        os.remove(done_email_file)
+        job_index.remove_notification(done_email_file)
+
+        # the first notification, from which the times of the following ones are derived, is checked
+        first_submitted_email_file = os.path.join(scratch_dir, 'email_history', 'email_submitted_1700000010.0_1700000000.0.email')
+        faulty_submitted_email_file = first_submitted_email_file.replace('1700000000.0', '325666656000000000')
+        os.rename(first_submitted_email_file, faulty_submitted_email_file)
+        assert job_index.first_notification('email', 'submitted', scratch_dir)['sending_time'] == 1700000020.0
+        job_index.rebuild_from_disk()
+        assert job_index.first_notification('email', 'submitted', scratch_dir)['first_submitted_time'] is None
+        os.rename(faulty_submitted_email_file, first_submitted_email_file)
+
+        # the others are not checked against the history files, only rebuilt from them
+        os.remove(os.path.join(scratch_dir, 'email_history', 'email_submitted_1700000020.0_1700000000.0.email'))
+        assert job_index.last_notification_time('email', 'submitted', '0123456789abcdef') == 1700000020.0
+
+        shutil.rmtree(aliased_scratch_dir)
+        job_index.remove_scratch_dir(aliased_scratch_dir)
+        assert job_index.find_notifications('matrix', 'done', job_id='0123456789abcdef') == []
+
+        job_index.rebuild_from_disk()
+        assert job_index.last_notification_time('email', 'submitted', '0123456789abcdef') == 1700000010.0
@@ -16,7 +16,7 @@ import glob
 from cdci_data_analysis.analysis.catalog import BasicCatalog
 from cdci_data_analysis.pytest_fixtures import DispatcherJobState, make_hash, ask
 from cdci_data_analysis.plugins.dummy_plugin.data_server_dispatcher import DataServerQuery
-from cdci_data_analysis.flask_app.schemas import StateJobsInspectionScheme
+from cdci_data_analysis.flask_app.schemas import StateJobsInspectionScheme, StateScratchDirsInspectionScheme
 
 from datetime import datetime
 
@@ -3088,6 +3088,73 @@ def test_inspect_jobs_failed(dispatcher_live_fixture, include_status_query_outpu
         assert jdata_inspection['records'][0]['job_status_data'][0]['scratch_dir_content']['status_query_output']['message'] == 'Error when getting query products'
 
 
+def test_inspect_state_pagination(dispatcher_live_fixture):
+    server = dispatcher_live_fixture
+    token_payload = {**default_token_payload, "roles": 'job manager'}
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+    DispatcherJobState.remove_scratch_folders()
+    params = {
+        'query_status': 'new',
+        'product_type': 'dummy',
+        'query_type': "Dummy",
+        'instrument': 'empty',
+        'token': encoded_token,
+    }
+
+    # same job from three different sessions, i.e. three scratch directories
+    for i in range(3):
+        jdata = ask(server,
+                    params,
+                    expected_query_status='done'
+                    )
+    dispatcher_job_state = DispatcherJobState.from_run_analysis_response(jdata)
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, limit=2))
+    assert c.status_code == 200
+    jdata_inspection = c.json()
+    assert StateScratchDirsInspectionScheme().validate(jdata_inspection) == {}
+    assert len(jdata_inspection['records']) == 2
+    assert jdata_inspection['more_records']
+    scratch_dirs_first_page = [r['session_id'] for r in jdata_inspection['records']]
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, limit=2, cursor=jdata_inspection['next_cursor']))
+    assert c.status_code == 200
+    jdata_inspection = c.json()
+    assert len(jdata_inspection['records']) == 1
+    assert not jdata_inspection['more_records']
+    assert jdata_inspection['records'][0]['session_id'] not in scratch_dirs_first_page
+    assert jdata_inspection['records'][0]['job_id'] == dispatcher_job_state.job_id
+
+    # exactly as many records as the limit, in the same order as the pages
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, limit=3))
+    jdata_inspection = c.json()
+    assert len(jdata_inspection['records']) == 3
+    assert not jdata_inspection['more_records']
+    assert [r['session_id'] for r in jdata_inspection['records'][:2]] == scratch_dirs_first_page
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, limit=3, min_mtime=time.time() + 3600))
+    assert c.json()['records'] == []
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, limit=2, cursor='not-a-cursor'))
+    assert c.status_code == 400
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, status='failed'))
+    assert c.json()['records'] == []
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, status='done,failed', group_by_job=True))
+    jdata_inspection = c.json()
+    assert StateJobsInspectionScheme().validate(jdata_inspection) == {}
+    assert len(jdata_inspection['records']) == 1
+    assert len(jdata_inspection['records'][0]['job_status_data']) == 3
+
+
 @pytest.mark.parametrize("include_status_query_output", [True, False, None])
 def test_inspect_jobs_expired_token(dispatcher_live_fixture, include_status_query_output):
     server = dispatcher_live_fixture
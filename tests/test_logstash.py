@@ -0,0 +1,154 @@
+import json
+import time
+import types
+import socket
+import threading
+import socketserver
+
+import pytest
+
+from cdci_data_analysis.flask_app import logstash
+from cdci_data_analysis.flask_app.logstash import LogstashShipper, logstash_message
+
+
+@pytest.fixture
+def local_logstash():
+    state = types.SimpleNamespace(messages=[], connections=0)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            state.connections += 1
+            for line in self.rfile:
+                state.messages.append(json.loads(line))
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server.server_address, state
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.fast
+def test_logstash_shipper(local_logstash, monkeypatch):
+    (host, port), state = local_logstash
+    monkeypatch.setattr(logstash, '_shippers', {})
+
+    app = types.SimpleNamespace(config={'conf': types.SimpleNamespace(logstash_host=host, logstash_port=str(port),
+                                                                      logstash_queue_size=1000,
+                                                                      logstash_batch_size=10,
+                                                                      logstash_codec='json_lines')})
+    for i in range(49):
+        logstash_message(app, {'origin': 'dispatcher-run-analysis', 'i': i, 'decoded-token': {'roles': ['general']}})
+    logstash_message(app, json.dumps({'origin': 'dispatcher-run-analysis', 'i': 49}))
+
+    shipper = logstash.get_logstash_shipper(app.config['conf'])
+    assert shipper.flush()
+    shipper.close()
+
+    assert shipper.stats()['sent'] == 50
+    assert shipper.stats()['batches'] >= 5
+    assert shipper.stats()['connections'] == 1
+    for _ in range(100):
+        if len(state.messages) == 50:
+            break
+        time.sleep(0.05)
+    assert state.messages[0] == {'origin': 'dispatcher-run-analysis', 'i': 0, 'decoded-token.roles.0': 'general'}
+    assert [message['i'] for message in state.messages] == list(range(50))
+    assert state.connections == 1
+
+
+@pytest.mark.fast
+def test_logstash_shipper_json_codec(local_logstash):
+    (host, port), state = local_logstash
+
+    shipper = LogstashShipper(host, port, batch_size=10)
+    for i in range(5):
+        shipper.ship({'i': i, 'decoded-token': {'roles': ['general']}})
+    shipper.ship(json.dumps({'i': 5, 'decoded-token': {'roles': ['general']}}))
+    # the messages are encoded by the shipper thread, which skips those that can not be encoded
+    shipper.ship({'i': 6, 'content': object()})
+    assert shipper.flush()
+    shipper.close()
+
+    # one message per connection, as expected by the json codec of logstash
+    assert shipper.stats()['sent'] == 6
+    assert shipper.stats()['failed'] == 1
+    assert shipper.stats()['connections'] == 6
+    for _ in range(100):
+        if len(state.messages) == 6:
+            break
+        time.sleep(0.05)
+    assert sorted(message['i'] for message in state.messages) == list(range(6))
+    assert all(message['decoded-token.roles.0'] == 'general' for message in state.messages)
+    assert state.connections == 6
+
+
+@pytest.mark.fast
+def test_logstash_shipper_overflow():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        unused_port = sock.getsockname()[1]
+
+    shipper = LogstashShipper('127.0.0.1', unused_port, queue_size=5, batch_size=2)
+
+    sending = threading.Event()
+    unblock = threading.Event()
+    send = shipper._send
+
+    def blocked_send(batch):
+        sending.set()
+        unblock.wait()
+        send(batch)
+
+    shipper._send = blocked_send
+
+    shipper.ship({'i': 0})
+    assert sending.wait(5)
+    # the shipper thread is blocked sending the first message
+    for i in range(1, 10):
+        shipper.ship({'i': i})
+
+    assert shipper.stats()['dropped'] == 4
+    assert shipper.stats()['queue_length'] == 5
+
+    unblock.set()
+    assert shipper.flush()
+    shipper.close()
+
+    # logstash could not be reached
+    assert shipper.stats()['failed'] == 6
+    assert shipper.stats()['sent'] == 0
+
+
+@pytest.mark.fast
+def test_log_run_query_summary(monkeypatch):
+    from cdci_data_analysis.flask_app import app as app_module
+
+    messages = []
+    monkeypatch.setattr(app_module, 'logstash_message', lambda app, message: messages.append(message))
+    monkeypatch.setitem(app_module.app.config, 'conf', types.SimpleNamespace(request_summary_max_field_length=20))
+
+    with app_module.app.test_request_context('/run_analysis',
+                                             method='POST',
+                                             query_string={'instrument': 'empty', 'product_type': 'dummy'},
+                                             data={'selected_catalog': 'x' * 1000},
+                                             headers={'X-Forwarded-For': '10.0.0.1, 10.0.0.2'}):
+        request_summary = app_module.log_run_query_request()
+
+        # the response is not decoded, its statuses are taken from the query output
+        result = types.SimpleNamespace()
+        assert app_module.log_run_query_result(request_summary, result,
+                                               dict(exit_status={'status': 0}, job_status='done')) is result
+
+    requested_json, returning = messages
+    requested = json.loads(requested_json)
+    assert requested['clientip'] == '10.0.0.1'
+    assert requested['request-data']['args'] == {'instrument': 'empty', 'product_type': 'dummy'}
+    assert requested['request-data']['form-data']['selected_catalog'] == 'x' * 20 + '... [truncated to 20 characters]'
+    assert 'dispatcher-state' not in requested
+    assert returning == {**requested, 'dispatcher-state': 'returning',
+                         'return_exit_status': {'status': 0}, 'return_job_status': 'done'}
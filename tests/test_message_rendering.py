@@ -0,0 +1,69 @@
+import time
+import types
+import logging
+
+import pytest
+
+from cdci_data_analysis.analysis import email_helper, matrix_helper
+
+logger = logging.getLogger(__name__)
+
+config = types.SimpleNamespace(products_url='http://localhost:8000',
+                               site_name='University of Geneva',
+                               contact_email_address='contact@odahub.io',
+                               manual_reference='possibly-non-site-specific-link')
+
+api_code = ("from oda_api.api import DispatcherAPI\n"
+            "disp=DispatcherAPI(url='http://localhost:8000/dispatch-data', instrument='mock')\n"
+            "par_dict={\"instrument\": \"empty\", \"product_type\": \"dummy\", \"token\": \"token\"}\n"
+            "data_collection = disp.get_product(**par_dict)\n")
+
+
+def render_kwargs(tmpdir):
+    return dict(decoded_token={'email': 'mtm@mtmco.net', 'name': 'mmeharga', 'sub': 'mtm@mtmco.net',
+                               'mxroomid': '!room:matrix.org', 'exp': 1700003600},
+                token='token',
+                job_id='0123456789abcdef',
+                session_id='01234567890ABCDE',
+                status='done',
+                instrument='empty',
+                product_type='dummy',
+                time_request=1700000000,
+                request_url='http://localhost:8000/?instrument=empty',
+                api_code=api_code,
+                scratch_dir=str(tmpdir))
+
+
+@pytest.mark.fast
+def test_cached_message_rendering(tmpdir, monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 1700000100)
+
+    email_helper.get_templates_environment.cache_clear()
+    email_helper._wrap_python_code.cache_clear()
+
+    rendered_email = email_helper.render_job_email(config, logger, **render_kwargs(tmpdir))
+    rendered_message = matrix_helper.render_job_message(config, logger, **render_kwargs(tmpdir))
+
+    # the api code formatted for the email is reused for the matrix message
+    assert email_helper._wrap_python_code.cache_info().hits == 1
+
+    # the templates of the emails and of the matrix messages are compiled in the same environment
+    assert email_helper.get_templates_environment() is email_helper.get_templates_environment()
+    assert email_helper.get_templates_environment.cache_info().misses == 1
+
+    assert email_helper.render_job_email(config, logger, **render_kwargs(tmpdir)) == rendered_email
+    assert matrix_helper.render_job_message(config, logger, **render_kwargs(tmpdir)) == rendered_message
+    assert 'data_collection = disp.get_product(**par_dict)' in rendered_email['email_text']
+
+
+@pytest.mark.fast
+def test_message_rendering_invalid_time(tmpdir):
+    kwargs = {**render_kwargs(tmpdir), 'time_request': 'not a time'}
+
+    with pytest.raises(email_helper.EMailNotSent) as e:
+        email_helper.render_job_email(config, logger, **kwargs)
+    assert e.value.message.startswith('Email not sent: ')
+
+    with pytest.raises(matrix_helper.MatrixMessageNotSent) as e:
+        matrix_helper.render_job_message(config, logger, **kwargs)
+    assert e.value.message.startswith('Matrix message not sent: ')
@@ -0,0 +1,135 @@
+import time
+import sqlite3
+import multiprocessing
+
+import pytest
+import requests
+
+from cdci_data_analysis.flask_app.metrics import MetricsRegistry, EXITED_PROCESSES_ID
+
+
+def count_requests(registry, n):
+    for _ in range(n):
+        registry.inc('dispatcher_requests_total', dict(endpoint='/run_analysis', method='GET', status_code=200))
+    registry.observe('dispatcher_request_duration_seconds', 0.3, dict(endpoint='/run_analysis'))
+    registry.flush()
+
+
+@pytest.mark.fast
+def test_metrics_processes(tmpdir):
+    registry = MetricsRegistry(str(tmpdir.join('metrics.sqlite')), buckets=(0.1, 1))
+    registry.inc('dispatcher_requests_total', dict(endpoint='/run_analysis', method='GET', status_code=200))
+    registry.inc('dispatcher_scratch_dir_lock_retries_total')
+
+    # the values of the parent, not yet written, are not counted again by the forked processes
+    processes = [multiprocessing.get_context('fork').Process(target=count_requests, args=(registry, 3))
+                 for _ in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    rendered = registry.render()
+    assert rendered.splitlines() == [
+        '# HELP dispatcher_requests_total Requests served, by endpoint, method and status code.',
+        '# TYPE dispatcher_requests_total counter',
+        'dispatcher_requests_total{endpoint="/run_analysis",method="GET",status_code="200"} 7',
+        '# HELP dispatcher_request_duration_seconds Duration of the requests, by endpoint.',
+        '# TYPE dispatcher_request_duration_seconds histogram',
+        'dispatcher_request_duration_seconds_bucket{endpoint="/run_analysis",le="0.1"} 0',
+        'dispatcher_request_duration_seconds_bucket{endpoint="/run_analysis",le="1"} 2',
+        'dispatcher_request_duration_seconds_bucket{endpoint="/run_analysis",le="+Inf"} 2',
+        'dispatcher_request_duration_seconds_count{endpoint="/run_analysis"} 2',
+        'dispatcher_request_duration_seconds_sum{endpoint="/run_analysis"} 0.6',
+        '# HELP dispatcher_scratch_dir_lock_retries_total Retries to acquire the lock for the creation of a scratch directory.',
+        '# TYPE dispatcher_scratch_dir_lock_retries_total counter',
+        'dispatcher_scratch_dir_lock_retries_total 1',
+    ]
+
+    # the values written are replaced, not added
+    registry.inc('dispatcher_scratch_dir_lock_retries_total')
+    assert 'dispatcher_scratch_dir_lock_retries_total 2' in registry.render().splitlines()
+
+
+@pytest.mark.fast
+def test_metrics_fold_exited_processes(tmpdir):
+    metrics_path = str(tmpdir.join('metrics.sqlite'))
+    registry = MetricsRegistry(metrics_path, buckets=(0.1, 1))
+    registry.inc('dispatcher_scratch_dir_lock_retries_total')
+    registry.flush()
+
+    processes = [multiprocessing.get_context('fork').Process(target=count_requests, args=(registry, 3))
+                 for _ in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    rendered = registry.render()
+
+    def process_ids():
+        with sqlite3.connect(metrics_path) as conn:
+            return {process_id for process_id, in conn.execute("SELECT DISTINCT process_id FROM metrics")}
+
+    assert len(process_ids()) == 3
+    assert registry.fold_exited_processes() == 2
+    assert registry.fold_exited_processes() == 0
+    assert len(process_ids()) == 2
+    assert EXITED_PROCESSES_ID in process_ids()
+    assert registry.render() == rendered
+
+    # the values of a process are folded when it exits
+    registry.close()
+    assert process_ids() == {EXITED_PROCESSES_ID}
+    assert registry.render() == rendered
+
+
+@pytest.mark.fast
+def test_metrics_background_flush(tmpdir):
+    metrics_path = str(tmpdir.join('metrics.sqlite'))
+    registry = MetricsRegistry(metrics_path, flush_interval_s=0.05)
+    registry.inc('dispatcher_celery_submissions_total')
+
+    for _ in range(100):
+        if MetricsRegistry(metrics_path).collect().get(
+                ('dispatcher_celery_submissions_total', 'dispatcher_celery_submissions_total', '[]')) == 1:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail('the metrics were not written in the background')
+
+    registry.close()
+
+
+@pytest.mark.fast
+def test_metrics_in_memory():
+    registry = MetricsRegistry()
+    registry.inc('dispatcher_notifications_total', dict(channel='email', outcome='sent'))
+    registry.inc('dispatcher_notifications_total', dict(channel='email', outcome='sent'))
+    registry.flush()
+
+    assert 'dispatcher_notifications_total{channel="email",outcome="sent"} 2' in registry.render().splitlines()
+
+
+def test_metrics_endpoint(dispatcher_live_fixture):
+    server = dispatcher_live_fixture
+
+    c = requests.get(server + "/run_analysis",
+                     params=dict(query_status="new",
+                                 query_type="Dummy",
+                                 instrument="empty",
+                                 product_type="dummy"))
+    assert c.status_code == 200
+
+    c = requests.get(server + "/metrics")
+    assert c.status_code == 200
+
+    lines = c.text.splitlines()
+    assert '# TYPE dispatcher_requests_total counter' in lines
+    assert any(line.startswith('dispatcher_requests_total{endpoint="/run_analysis",method="GET",status_code="200"} ')
+               for line in lines)
+    assert any(line.startswith('dispatcher_request_duration_seconds_count{endpoint="/run_analysis"} ')
+               for line in lines)
+    assert any(line.startswith('dispatcher_aliasing_decisions_total{decision=') for line in lines)
+    assert any(line.startswith('dispatcher_job_status_transitions_total{') for line in lines)
+    assert any(line.startswith('dispatcher_span_duration_seconds_count{span="set_scratch_dir"} ') for line in lines)
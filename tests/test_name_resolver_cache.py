@@ -0,0 +1,142 @@
+import json
+import time
+import types
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pytest
+
+from cdci_data_analysis.analysis import drupal_helper
+from cdci_data_analysis.analysis.name_resolver_cache import NameResolverCache, normalise_name
+
+entities_portal_url = 'http://cdsportal.u-strasbg.fr/?target={}'
+
+known_sources = {'mrk 421': dict(ra=166.11, dec=38.21, object_type='BLLac', object_ids=['Mrk 421', 'QSO B1101+384'])}
+
+
+@pytest.fixture
+def local_name_resolvers(monkeypatch):
+    state = types.SimpleNamespace(requests=[], n_running=0, max_n_running=0, delay_s=0, lock=threading.Lock())
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with state.lock:
+                state.requests.append(self.path)
+                state.n_running += 1
+                state.max_n_running = max(state.max_n_running, state.n_running)
+            time.sleep(state.delay_s)
+            with state.lock:
+                state.n_running -= 1
+
+            resolver, quoted_name = self.path.split('/')[1:3]
+            source = known_sources.get(normalise_name(urllib.parse.unquote(quoted_name)))
+            if resolver == 'local':
+                if source is None:
+                    content = json.dumps({'success': False}).encode()
+                else:
+                    content = json.dumps({'success': True, **source}).encode()
+            else:
+                if source is None:
+                    content = b'<Sesame><Target><INFO>*** Nothing found ***</INFO></Target></Sesame>'
+                else:
+                    content = (f'<Sesame><Target><Resolver><jradeg>{source["ra"]}</jradeg>'
+                               f'<jdedeg>{source["dec"]}</jdedeg></Resolver></Target></Sesame>').encode()
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    def query_object(name):
+        return [{'OTYPE': known_sources[normalise_name(urllib.parse.unquote(name))]['object_type']}]
+
+    def query_objectids(name):
+        return {'ID': np.array(known_sources[normalise_name(name)]['object_ids'])}
+
+    monkeypatch.setattr(drupal_helper, 'Simbad', types.SimpleNamespace(add_votable_fields=lambda *args: None,
+                                                                       query_object=query_object,
+                                                                       query_objectids=query_objectids))
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    def resolve(name, resolver_cache):
+        return drupal_helper.resolve_name(local_name_resolver_url=url + '/local/{}',
+                                          external_name_resolver_url=url + '/external/{}',
+                                          entities_portal_url=entities_portal_url,
+                                          name=name,
+                                          resolver_cache=resolver_cache)
+
+    yield resolve, state
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.fast
+def test_name_resolver_cache(local_name_resolvers, tmpdir):
+    resolve, state = local_name_resolvers
+    resolver_cache = NameResolverCache(str(tmpdir.join('name_resolver_cache.sqlite')))
+
+    resolved_obj = resolve('Mrk_421', None)
+    assert resolved_obj['name'] == 'Mrk 421'
+    assert resolved_obj['object_ids'] == known_sources['mrk 421']['object_ids']
+    assert resolved_obj['object_type'] == 'BLLac'
+    assert resolved_obj['message'] == 'Mrk_421 successfully resolved'
+    assert len(state.requests) == 2
+
+    assert resolve('Mrk_421', resolver_cache) == resolved_obj
+    assert len(state.requests) == 4
+
+    # same normalised name
+    cached_resolved_obj = resolve(' mrk  421', resolver_cache)
+    assert len(state.requests) == 4
+    assert cached_resolved_obj == {**resolved_obj,
+                                   'name': ' mrk  421',
+                                   'message': ' mrk  421 successfully resolved',
+                                   'entity_portal_link': entities_portal_url.format('mrk%20%20421')}
+    assert resolver_cache.stats() == dict(hits=1, misses=1, shared=0)
+
+    # persistent
+    assert NameResolverCache(resolver_cache.cache_path).get('MRK 421') == ('Mrk_421', resolved_obj)
+
+    not_resolved_obj = resolve('fake object', resolver_cache)
+    assert not_resolved_obj['message'] == 'fake object could not be resolved: *** Nothing found ***'
+    assert resolve('Fake_Object', resolver_cache)['message'] == 'Fake_Object could not be resolved: *** Nothing found ***'
+    assert len(state.requests) == 6
+
+    # the names not resolved expire sooner
+    resolver_cache.negative_ttl_s = -1
+    resolve('other fake object', resolver_cache)
+    resolve('other fake object', resolver_cache)
+    assert len(state.requests) == 10
+    assert resolve('Mrk 421', resolver_cache)['RA'] == 166.11
+    assert len(state.requests) == 10
+
+
+@pytest.mark.fast
+def test_name_resolver_single_flight(local_name_resolvers, tmpdir):
+    resolve, state = local_name_resolvers
+    resolver_cache = NameResolverCache(str(tmpdir.join('name_resolver_cache.sqlite')))
+    state.delay_s = 0.3
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        resolved_objs = list(executor.map(lambda name: resolve(name, resolver_cache),
+                                          ['Mrk 421', 'Mrk 421', 'Mrk_421', 'mrk 421']))
+
+    assert [resolved_obj['name'] for resolved_obj in resolved_objs] == ['Mrk 421', 'Mrk 421', 'Mrk 421', 'mrk 421']
+    # a single query of the two resolvers, at the same time
+    assert len(state.requests) == 2
+    assert state.max_n_running == 2
+    assert resolver_cache.stats()['misses'] == 1
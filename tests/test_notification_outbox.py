@@ -0,0 +1,350 @@
+import os
+import glob
+import json
+import time
+import types
+
+import pytest
+
+from cdci_data_analysis.analysis import notification_outbox, email_helper, smtp_pool
+from cdci_data_analysis.analysis.job_manager import Job, OsaJob, update_job_monitor
+from cdci_data_analysis.analysis.job_index import job_index
+from cdci_data_analysis.analysis.notification_outbox import NotificationOutbox, NotificationWorkerPool
+
+
+def make_config(tmpdir, **kwargs):
+    return types.SimpleNamespace(**{
+        'products_url': 'http://localhost:8000',
+        'site_name': 'University of Geneva',
+        'contact_email_address': 'contact@odahub.io',
+        'manual_reference': 'possibly-non-site-specific-link',
+        'smtp_server': 'localhost',
+        'smtp_port': 61025,
+        'smtp_server_password': None,
+        'smtp_connection_pool_size': 2,
+        'smtp_connection_max_idle_s': 60,
+        'sender_email_address': 'team@odahub.io',
+        'cc_receivers_email_addresses': [],
+        'bcc_receivers_email_addresses': [],
+        'notification_outbox_enabled': True,
+        'notification_outbox_path': str(tmpdir.join('outbox.sqlite')),
+        'notification_outbox_workers': 1,
+        'notification_outbox_max_attempts': 3,
+        'notification_outbox_retry_delay_s': 0,
+        'notification_outbox_retention_s': 604800,
+        **kwargs
+    })
+
+
+@pytest.fixture
+def recorded_smtp(monkeypatch):
+    sent = []
+    failures = []
+
+    class RecordingSMTP:
+        def __init__(self, host, port):
+            if failures:
+                raise failures.pop(0)
+
+        def sendmail(self, sender, receivers, message):
+            sent.append(dict(sender=sender, receivers=receivers, message=message))
+
+        def noop(self):
+            return 250, b'OK'
+
+        def quit(self):
+            pass
+
+    monkeypatch.setattr(smtp_pool.smtplib, 'SMTP', RecordingSMTP)
+    # the connections pooled by the previous tests use their own SMTP class
+    monkeypatch.setattr(smtp_pool, '_connection_pools', {})
+    return types.SimpleNamespace(sent=sent, failures=failures)
+
+
+@pytest.mark.fast
+def test_update_job_monitor(tmpdir):
+    with open(tmpdir.join('job_monitor.json'), 'w') as f:
+        json.dump({'job_id': '0123456789abcdef', 'status': 'done'}, f)
+
+    update_job_monitor(str(tmpdir), email_status='email sent', matrix_message_status=None)
+
+    with open(tmpdir.join('job_monitor.json')) as f:
+        assert json.load(f) == {'job_id': '0123456789abcdef', 'status': 'done', 'email_status': 'email sent'}
+
+
+@pytest.mark.fast
+def test_job_status_keeps_notification_outcome(tmpdir):
+    job = Job(instrument_name='empty',
+              work_dir=str(tmpdir),
+              dispatcher_callback_url_base=None,
+              dispatcher_host=None,
+              dispatcher_port=None,
+              callback_handle='call_back',
+              job_id='0123456789abcdef',
+              session_id='01234567890ABCDE')
+    job.write_dataserver_status(status_dictionary_value='submitted', email_status='email queued')
+
+    # delivered by a notification worker, while the job is handled by a request
+    update_job_monitor(str(tmpdir), email_status='email sent')
+    job.write_dataserver_status(status_dictionary_value='done')
+
+    with open(tmpdir.join('job_monitor.json')) as f:
+        monitor = json.load(f)
+    assert monitor['status'] == 'done'
+    assert monitor['email_status'] == 'email sent'
+
+    job.write_dataserver_status(email_status='sending email failed')
+    with open(tmpdir.join('job_monitor.json')) as f:
+        assert json.load(f)['email_status'] == 'sending email failed'
+
+
+@pytest.mark.fast
+def test_notification_outbox_retries(tmpdir, monkeypatch):
+    outcomes = []
+
+    def deliver(config, record):
+        outcomes.append(record['attempts'])
+        if record['attempts'] < 3:
+            raise ConnectionError("relay not available")
+
+    failed = []
+    monkeypatch.setitem(notification_outbox.delivery_handlers, 'email',
+                        (deliver, lambda config, record, error: failed.append(error)))
+
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')))
+    pool = NotificationWorkerPool(outbox, config=None, max_attempts=5, retry_delay_s=1)
+
+    notification_id = outbox.enqueue('email', str(tmpdir), '0123456789abcdef', 'done', {'email_subject': 'test'})
+
+    assert pool.deliver_next()
+    record, = outbox.list_notifications(job_id='0123456789abcdef')
+    assert record['state'] == 'pending'
+    assert record['attempts'] == 1
+    assert 'relay not available' in record['last_error']
+
+    # not due yet
+    assert not pool.deliver_next()
+    assert outbox.claim(now=time.time() + 0.5) is None
+
+    # the delay doubles at each attempt
+    record = outbox.claim(now=time.time() + 1.1)
+    assert record['id'] == notification_id
+    outbox.mark_retry(record['id'], 2, 'still not available')
+    assert outbox.claim(now=time.time() + 1.5) is None
+
+    record = outbox.claim(now=time.time() + 2.1)
+    outbox.mark_retry(record['id'], 0, 'still not available')
+    assert pool.deliver_next()
+    assert outcomes == [1, 4]
+    assert outbox.list_notifications(state='sent')[0]['id'] == notification_id
+    assert failed == []
+
+
+@pytest.mark.fast
+def test_notification_outbox_give_up(tmpdir, monkeypatch):
+    def deliver(config, record):
+        raise ConnectionError("relay not available")
+
+    failed = []
+    monkeypatch.setitem(notification_outbox.delivery_handlers, 'matrix',
+                        (deliver, lambda config, record, error: failed.append(error)))
+
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')))
+    pool = NotificationWorkerPool(outbox, config=None, max_attempts=2, retry_delay_s=0)
+    outbox.enqueue('matrix', str(tmpdir), '0123456789abcdef', 'done', {})
+
+    assert pool.deliver_next()
+    assert pool.deliver_next()
+    assert not pool.deliver_next()
+
+    record, = outbox.list_notifications(state='failed')
+    assert record['attempts'] == 2
+    assert len(failed) == 1
+
+
+@pytest.mark.fast
+def test_notification_outbox_lease(tmpdir):
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')), lease_s=60)
+    notification_id = outbox.enqueue('email', str(tmpdir), '0123456789abcdef', 'done', {})
+
+    assert outbox.claim()['id'] == notification_id
+    assert outbox.claim() is None
+
+    # claimed by a process which did not complete the delivery
+    record = outbox.claim(now=time.time() + 61)
+    assert record['id'] == notification_id
+    assert record['attempts'] == 2
+
+
+@pytest.mark.fast
+def test_notification_outbox_pending_ledger(tmpdir, monkeypatch):
+    delivered = []
+    monkeypatch.setitem(notification_outbox.delivery_handlers, 'email',
+                        (lambda config, record: delivered.append(record['id']), None))
+
+    scratch_dir = str(tmpdir.mkdir('scratch_sid_01234567890ABCDE_jid_fedcba9876543210'))
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')))
+    pool = NotificationWorkerPool(outbox, config=None, n_workers=0)
+
+    notification_id = pool.enqueue('email', scratch_dir, 'fedcba9876543210', 'done', {},
+                                   sending_time=1700000010.0, first_submitted_time=1700000000.0)
+
+    # the queued notification is taken into account by the decisions about sending further ones
+    pending_email, = job_index.find_notifications('email', 'done', job_id='fedcba9876543210')
+    assert pending_email['sending_time'] == 1700000010.0
+
+    assert pool.deliver_next()
+    assert delivered == [notification_id]
+    assert job_index.find_notifications('email', 'done', job_id='fedcba9876543210') == []
+
+
+@pytest.mark.fast
+def test_notification_worker_batch(tmpdir, monkeypatch):
+    delivered = []
+    monkeypatch.setitem(notification_outbox.delivery_handlers, 'email',
+                        (lambda config, record: delivered.append(record['id']), None))
+
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')))
+    pool = NotificationWorkerPool(outbox, config=None, n_workers=0, batch_size=2)
+    notification_ids = [outbox.enqueue('email', str(tmpdir), '0123456789abcdef', 'done', {}) for _ in range(3)]
+
+    assert pool.deliver_batch() == 2
+    assert pool.deliver_batch() == 1
+    assert pool.deliver_batch() == 0
+    assert delivered == notification_ids
+
+
+@pytest.mark.fast
+def test_pending_notification_delivered_elsewhere(tmpdir):
+    scratch_dir = str(tmpdir.mkdir('scratch_sid_01234567890ABCDE_jid_fedcba9876543211'))
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')))
+    pool = NotificationWorkerPool(outbox, config=None, n_workers=0)
+
+    pool.enqueue('email', scratch_dir, 'fedcba9876543211', 'done', {},
+                 sending_time=time.time() - 120, first_submitted_time=time.time() - 180)
+    assert pool.remove_delivered_pending_notifications() == 0
+
+    # delivered by the process of another host sharing the outbox, which has its own job index
+    record = outbox.claim()
+    outbox.mark_sent(record['id'])
+    assert len(job_index.find_notifications('email', 'done', job_id='fedcba9876543211')) == 1
+
+    assert pool.remove_delivered_pending_notifications() == 1
+    assert job_index.find_notifications('email', 'done', job_id='fedcba9876543211') == []
+
+
+@pytest.mark.fast
+def test_notification_outbox_reclaim_and_purge(tmpdir):
+    outbox = NotificationOutbox(str(tmpdir.join('outbox.sqlite')), lease_s=60)
+    claimed_id = outbox.enqueue('email', str(tmpdir), '0123456789abcdef', 'done', {})
+    outbox.enqueue('email', str(tmpdir), '0123456789abcdef', 'failed', {})
+
+    outbox.claim()
+    outbox.mark_sent(outbox.claim()['id'])
+
+    assert outbox.reclaim_expired() == 0
+    assert outbox.reclaim_expired(now=time.time() + 61) == 1
+    assert outbox.list_notifications(state='pending')[0]['id'] == claimed_id
+
+    assert outbox.purge(older_than_s=3600) == 0
+    assert outbox.purge(older_than_s=0) == 1
+    assert [record['id'] for record in outbox.list_notifications()] == [claimed_id]
+
+
+@pytest.mark.fast
+def test_enqueue_job_email(tmpdir, recorded_smtp):
+    config = make_config(tmpdir)
+    scratch_dir = str(tmpdir.mkdir('scratch_sid_01234567890ABCDE_jid_0123456789abcdef'))
+    with open(os.path.join(scratch_dir, 'job_monitor.json'), 'w') as f:
+        json.dump({'job_id': '0123456789abcdef', 'status': 'done'}, f)
+
+    recorded_smtp.failures.append(ConnectionRefusedError("relay not available"))
+
+    notification_outbox.enqueue_job_email(config,
+                                          email_helper.email_helper_logger,
+                                          job_id='0123456789abcdef',
+                                          scratch_dir=scratch_dir,
+                                          decoded_token={'email': 'mtm@mtmco.net', 'name': 'mmeharga', 'sub': 'mtm@mtmco.net',
+                                                         'exp': int(time.time()) + 3600},
+                                          token='token',
+                                          session_id='01234567890ABCDE',
+                                          status='done',
+                                          instrument='empty',
+                                          product_type='dummy',
+                                          time_request=time.time(),
+                                          request_url='http://localhost:8000/?instrument=empty',
+                                          api_code='print("hello")')
+
+    # the first attempt fails, the second one is made by the workers after the retry delay
+    worker_pool = notification_outbox.get_notification_worker_pool(config)
+    try:
+        for _ in range(100):
+            if worker_pool.outbox.list_notifications(state='sent'):
+                break
+            time.sleep(0.1)
+    finally:
+        worker_pool.stop(timeout=5)
+
+    record, = worker_pool.outbox.list_notifications(job_id='0123456789abcdef')
+    assert record['state'] == 'sent'
+    assert record['attempts'] == 2
+
+    assert len(recorded_smtp.sent) == 1
+    assert recorded_smtp.sent[0]['receivers'] == ['mtm@mtmco.net']
+    assert len(glob.glob(os.path.join(scratch_dir, 'email_history', 'email_done_*'))) == 1
+    # the queued email is replaced in the ledger by the one delivered
+    done_email, = job_index.find_notifications('email', 'done', scratch_dir=scratch_dir)
+    assert os.path.exists(done_email['notification_file'])
+
+    with open(os.path.join(scratch_dir, 'job_monitor.json')) as f:
+        assert json.load(f)['email_status'] == 'email sent'
+
+
+@pytest.mark.fast
+def test_enqueue_job_email_node_callback(tmpdir, recorded_smtp):
+    config = make_config(tmpdir)
+    scratch_dir = str(tmpdir.mkdir('scratch_sid_01234567890ABCDE_jid_0123456789abcdef'))
+
+    # the callbacks of the nodes of an OsaJob are recorded in their own job monitor
+    job = OsaJob(instrument_name='empty-async',
+                 work_dir=scratch_dir,
+                 dispatcher_callback_url_base=None,
+                 dispatcher_host=None,
+                 dispatcher_port=None,
+                 callback_handle='call_back',
+                 job_id='0123456789abcdef',
+                 session_id='01234567890ABCDE',
+                 par_dic={'node_id': 'node_1', 'message': 'node done'})
+    assert job.file_name == 'job_monitor_node_1_node_done_.json'
+    job.write_dataserver_status(status_dictionary_value='done', email_status='email queued')
+
+    notification_outbox.enqueue_job_email(config,
+                                          email_helper.email_helper_logger,
+                                          job_id='0123456789abcdef',
+                                          scratch_dir=scratch_dir,
+                                          job_monitor_file_name=job.file_name,
+                                          decoded_token={'email': 'mtm@mtmco.net', 'name': 'mmeharga', 'sub': 'mtm@mtmco.net',
+                                                         'exp': int(time.time()) + 3600},
+                                          token='token',
+                                          session_id='01234567890ABCDE',
+                                          status='done',
+                                          instrument='empty-async',
+                                          product_type='dummy',
+                                          time_request=time.time(),
+                                          request_url='http://localhost:8000/?instrument=empty-async',
+                                          api_code='print("hello")')
+
+    worker_pool = notification_outbox.get_notification_worker_pool(config)
+    try:
+        for _ in range(100):
+            if worker_pool.outbox.list_notifications(state='sent'):
+                break
+            time.sleep(0.1)
+    finally:
+        worker_pool.stop(timeout=5)
+
+    assert len(recorded_smtp.sent) == 1
+    # the outcome replaces the queued status in the job monitor of the node
+    with open(os.path.join(scratch_dir, job.file_name)) as f:
+        assert json.load(f)['email_status'] == 'email sent'
+    assert not os.path.exists(os.path.join(scratch_dir, 'job_monitor.json'))
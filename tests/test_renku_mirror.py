@@ -0,0 +1,101 @@
+import os
+
+import pytest
+from git import Repo, Actor
+
+from cdci_data_analysis.analysis import renku_helper
+
+api_code = ("from oda_api.api import DispatcherAPI\n"
+            "disp=DispatcherAPI(url='http://localhost:8000/dispatch-data', instrument='mock')\n"
+            "par_dict={\"instrument\": \"empty\", \"product_type\": \"dummy\", \"token\": \"token\"}\n"
+            "data_collection = disp.get_product(**par_dict)\n")
+
+
+@pytest.fixture
+def local_renku_repository(tmpdir, monkeypatch):
+    remote_path = str(tmpdir.join('remote', 'test-dispatcher-endpoint.git'))
+    Repo.init(remote_path, bare=True, initial_branch='master')
+
+    work_repo = Repo.clone_from(remote_path, str(tmpdir.join('work')))
+    os.makedirs(os.path.join(work_repo.working_dir, '.renku'))
+    with open(os.path.join(work_repo.working_dir, '.renku', 'renku.ini'), 'w') as f:
+        f.write('[renku "interactive"]\ndefault_url = /lab\n')
+    work_repo.index.add('.renku/renku.ini')
+    work_repo.index.commit('initial commit', author=Actor('mmoda', 'mmoda@odahub.io'),
+                           committer=Actor('mmoda', 'mmoda@odahub.io'))
+    work_repo.git.push('origin', 'HEAD:master')
+
+    # the ssh url of the repository points to the local one
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('GIT_CONFIG_KEY_0', f'url.file://{tmpdir}/remote/.insteadOf')
+    monkeypatch.setenv('GIT_CONFIG_VALUE_0', 'git@gitlab.renkulab.io:mmoda/')
+    monkeypatch.setenv('GIT_COMMITTER_NAME', 'mmoda')
+    monkeypatch.setenv('GIT_COMMITTER_EMAIL', 'mmoda@odahub.io')
+
+    yield 'git@gitlab.renkulab.io:mmoda/test-dispatcher-endpoint.git', Repo(remote_path)
+
+
+def push(repository_url, mirror_dir, job_id):
+    return renku_helper.push_api_code(api_code=api_code,
+                                      job_id=job_id,
+                                      token='token',
+                                      renku_gitlab_repository_url=repository_url,
+                                      renku_gitlab_ssh_key_path='ssh_key_file',
+                                      renku_base_project_url='http://renkulab.io/projects',
+                                      user_name='mmoda',
+                                      user_email='mmoda@odahub.io',
+                                      renku_repository_mirror_dir=mirror_dir)
+
+
+@pytest.mark.fast
+def test_push_api_code_from_mirror(local_renku_repository, tmpdir):
+    repository_url, remote = local_renku_repository
+    mirror_dir = str(tmpdir.join('renku_mirrors'))
+
+    session_url = push(repository_url, mirror_dir, '0123456789abcdef')
+
+    branch_name, = [head.name for head in remote.heads if head.name != 'master']
+    assert branch_name.startswith('mmoda_request_0123456789abcdef_')
+    assert session_url.startswith('http://renkulab.io/projects/mmoda/test-dispatcher-endpoint/sessions/new?autostart=1'
+                                  f'&branch={branch_name}&commit={remote.heads[branch_name].commit.hexsha}')
+    assert 'api_code.ipynb' in [blob.name for blob in remote.heads[branch_name].commit.tree.blobs]
+
+    mirror, = [Repo(os.path.join(mirror_dir, mirror_name)) for mirror_name in os.listdir(mirror_dir)
+               if mirror_name.endswith('.git')]
+    # the worktree and its branch are removed from the mirror
+    assert len(mirror.git.worktree('list').splitlines()) == 1
+    assert mirror.heads == []
+
+    # the existing branch is fetched into the mirror, and reused
+    assert push(repository_url, mirror_dir, '0123456789abcdef') == session_url
+    # as with a clone of the repository
+    assert push(repository_url, None, '0123456789abcdef') == session_url
+    push(repository_url, mirror_dir, 'fedcba9876543210')
+
+    assert len(remote.heads) == 3
+    assert len(mirror.git.worktree('list').splitlines()) == 1
+    assert 'origin/' + branch_name in renku_helper.get_list_remote_branches_repo(mirror)
+
+
+@pytest.mark.fast
+def test_push_api_code_from_mirror_stale_worktree(local_renku_repository, tmpdir):
+    repository_url, remote = local_renku_repository
+    mirror_dir = str(tmpdir.join('renku_mirrors'))
+
+    # the same branch checked out by two worktrees, one of them left by a process which was killed
+    repos = [renku_helper.create_renku_repo_worktree(repository_url, mirror_dir) for _ in range(2)]
+    # next to the mirror, where the other hosts sharing it see them
+    assert all(repo.working_dir.startswith(mirror_dir) for repo in repos)
+    for repo in repos:
+        renku_helper.checkout_branch_renku_repo(repo, 'mmoda_request_0123456789abcdef')
+    assert repos[0].active_branch.name != repos[1].active_branch.name
+    renku_helper.remove_repository(repos[1], repository_url)
+    os.utime(repos[0].working_dir, (0, 0))
+
+    push(repository_url, mirror_dir, '0123456789abcdef')
+
+    mirror = Repo(repos[0].common_dir)
+    assert len(mirror.git.worktree('list').splitlines()) == 1
+    assert mirror.heads == []
+    assert not os.path.exists(repos[0].working_dir)
+    assert len(remote.heads) == 2
@@ -0,0 +1,113 @@
+import time
+import types
+import threading
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from cdci_data_analysis.analysis import drupal_helper
+from cdci_data_analysis.analysis.revnum_cache import RevnumCache
+
+
+@pytest.fixture
+def local_timesystem_service(monkeypatch, tmpdir):
+    state = types.SimpleNamespace(requests=[], n_running=0, max_n_running=0, lock=threading.Lock())
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time_to_convert = urllib.parse.unquote(self.path.split('/')[3])
+            with state.lock:
+                state.requests.append(time_to_convert)
+                state.n_running += 1
+                state.max_n_running = max(state.max_n_running, state.n_running)
+            time.sleep(0.2)
+            with state.lock:
+                state.n_running -= 1
+
+            # a revolution lasts about 3 days, since the end of 2002
+            content = str(int((datetime.fromisoformat(time_to_convert) - datetime(2002, 10, 17)).days / 3)).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    monkeypatch.setattr(drupal_helper, 'revnum_cache', RevnumCache(str(tmpdir.join('revnum_cache.sqlite'))))
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{server.server_port}/converttime/UTC/{{}}/REVNUM', state
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.fast
+def test_get_revnums(local_timesystem_service):
+    service_url, state = local_timesystem_service
+
+    future_time = (datetime.now() + timedelta(days=3)).strftime('%Y-%m-%dT%H:%M:%S')
+    revnums = drupal_helper.get_revnums(service_url, ['2020-01-01T00:00:00', '2020-01-04T00:00:00+0200', future_time,
+                                                      '2020-01-01 00:00:00', 'not a time'])
+
+    assert revnums == {'2020-01-01T00:00:00': 2095,
+                       '2020-01-04T00:00:00+0200': 2096,
+                       future_time: revnums[future_time],
+                       '2020-01-01 00:00:00': 2095}
+    # the times are converted concurrently, once each
+    assert sorted(state.requests) == ['2020-01-01T00:00:00', '2020-01-04T00:00:00', future_time]
+    assert state.max_n_running == 3
+
+    assert drupal_helper.get_revnum(service_url, '2020-01-01T00:00:00') == {'revnum': 2095}
+    assert drupal_helper.get_revnum(service_url, 'not a time') == {}
+    assert len(state.requests) == 3
+
+    # the future times are not cached
+    drupal_helper.get_revnum(service_url, future_time)
+    assert len(state.requests) == 4
+
+    # the times with a timezone are compared in UTC: 20 hours ago, but 32 hours ago in the formatted time, not cached
+    recent_time = (datetime.now(timezone.utc) - timedelta(hours=20)).astimezone(timezone(timedelta(hours=-12)))
+    recent_time = recent_time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    drupal_helper.get_revnums(service_url, [recent_time])
+    drupal_helper.get_revnums(service_url, [recent_time])
+    assert len(state.requests) == 6
+
+    # the revnums of the past times are kept on disk
+    revnum_cache = RevnumCache(drupal_helper.revnum_cache.cache_path)
+    assert revnum_cache.get(service_url, '2020-01-04T00:00:00') == 2096
+    assert revnum_cache.get(service_url, future_time) is None
+
+
+@pytest.mark.fast
+def test_get_revnum_endpoint(local_timesystem_service, monkeypatch):
+    from cdci_data_analysis.flask_app import app as app_module
+
+    service_url, state = local_timesystem_service
+    monkeypatch.setitem(app_module.app.config, 'conf', types.SimpleNamespace(converttime_revnum_service_url=service_url))
+
+    client = app_module.app.test_client()
+    assert client.get('/get_revnum', query_string={'time_to_convert': '2020-01-01T00:00:00'}).json == {'revnum': 2095}
+
+    c = client.get('/get_revnum', query_string={'times_to_convert': '2020-01-01T00:00:00, 2020-01-04T00:00:00,not a time'})
+    assert c.json == {'revnums': {'2020-01-01T00:00:00': 2095, '2020-01-04T00:00:00': 2096}}
+    assert sorted(state.requests) == ['2020-01-01T00:00:00', '2020-01-04T00:00:00']
+
+
+@pytest.mark.fast
+def test_revnum_cache_lru():
+    revnum_cache = RevnumCache(max_entries=2)
+
+    for i in range(3):
+        revnum_cache.store('service', f'2020-01-0{i + 1}T00:00:00', 2005 + i)
+    assert revnum_cache.get('service', '2020-01-01T00:00:00') is None
+    assert revnum_cache.get('service', '2020-01-02T00:00:00') == 2006
+    assert revnum_cache.stats() == dict(hits=1, misses=1, entries=2)
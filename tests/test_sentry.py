@@ -0,0 +1,58 @@
+import time
+import types
+
+import pytest
+
+from cdci_data_analysis.flask_app import sentry as sentry_module
+from cdci_data_analysis.flask_app.sentry import Sentry
+
+
+@pytest.fixture
+def captured_sentry_messages(monkeypatch):
+    calls = types.SimpleNamespace(init=[], messages=[])
+    monkeypatch.setattr(sentry_module.sentry_sdk, 'init', lambda **kwargs: calls.init.append(kwargs))
+    monkeypatch.setattr(sentry_module.sentry_sdk, 'capture_message', lambda message: calls.messages.append(message))
+    yield calls
+
+
+def make_sentry(**conf):
+    sentry = Sentry()
+    sentry.app = types.SimpleNamespace(config={'conf': types.SimpleNamespace(**conf)})
+    return sentry
+
+
+@pytest.mark.fast
+def test_sentry_capture_message(captured_sentry_messages):
+    sentry = make_sentry(sentry_url='https://public@sentry.example.org/1',
+                         sentry_environment='testing',
+                         sentry_capture_window_s=0.5,
+                         sentry_capture_max_messages=2)
+
+    for _ in range(5):
+        sentry.capture_message('error sending email')
+    sentry.capture_message('error posting on matrix')
+    sentry.capture_message('error posting on the gallery')
+
+    # sentry is set up once
+    assert len(captured_sentry_messages.init) == 1
+    assert captured_sentry_messages.init[0]['environment'] == 'testing'
+    assert captured_sentry_messages.messages == ['error sending email', 'error posting on matrix']
+    assert sentry.stats() == dict(sent=2, coalesced=4, rate_limited=1)
+
+    time.sleep(0.5)
+    sentry.capture_message('error sending email')
+
+    assert len(captured_sentry_messages.init) == 1
+    assert captured_sentry_messages.messages[2].startswith('4 repeated and 1 rate-limited messages were not sent')
+    assert captured_sentry_messages.messages[3] == 'error sending email'
+
+
+@pytest.mark.fast
+def test_sentry_not_configured(captured_sentry_messages):
+    sentry = make_sentry(sentry_url=None)
+
+    sentry.capture_message('error sending email')
+
+    assert not sentry.have_sentry
+    assert captured_sentry_messages.init == []
+    assert captured_sentry_messages.messages == []
@@ -8,6 +8,8 @@ import os
 import random
 import re
 import shutil
+import stat
+import tarfile
 import time
 import urllib
 import uuid
@@ -28,6 +30,8 @@ from cdci_data_analysis.analysis.drupal_helper import (
     execute_drupal_request, generate_gallery_jwt_token,
     get_drupal_request_headers, get_observations_for_time_range, get_revnum,
     get_source_astrophysical_entity_id_by_source_name, get_user_id)
+from cdci_data_analysis.analysis.download_cache import DownloadCache
+from cdci_data_analysis.analysis.io_helper import process_umask
 from cdci_data_analysis.analysis.renku_helper import (
     check_job_id_branch_is_present, checkout_branch_renku_repo,
     clone_renku_repo, create_new_notebook_with_code,
@@ -155,6 +159,68 @@ def test_reload_plugin(safe_dummy_plugin_conf, dispatcher_live_fixture):
     assert 'empty-async' not in jdata
     assert 'empty-semi-async' not in jdata
 
+@pytest.mark.fast
+def test_instrument_registry():
+    from cdci_data_analysis.analysis.instrument import InstrumentFactoryIterator
+    from cdci_data_analysis.plugins.dummy_plugin.empty_instrument import my_instr_factory
+    from cdci_data_analysis.plugins.dummy_plugin.empty_development_instrument import my_instr_factory as my_dev_instr_factory
+
+    n_calls = []
+
+    def counting_instr_factory():
+        n_calls.append(1)
+        return my_instr_factory()
+
+    def failing_instr_factory():
+        raise RuntimeError("broken plugin")
+
+    instrument_factory_iter = InstrumentFactoryIterator()
+    instrument_factory_iter.extend([counting_instr_factory, my_dev_instr_factory])
+
+    # the factory is called once while registering, to get the name and the access rules
+    assert len(n_calls) == 1
+    assert instrument_factory_iter.instrument_names == ['empty', 'empty-development']
+
+    assert instrument_factory_iter.accessible_instrument_names() == ['empty']
+    assert instrument_factory_iter.accessible_instrument_names(roles=['oda workflow developer']) == ['empty', 'empty-development']
+    assert len(n_calls) == 1
+
+    # the instruments are copied from the template
+    instrument = instrument_factory_iter.registry[0].build_instrument()
+    assert instrument.name == 'empty'
+    assert len(n_calls) == 1
+
+    instrument.set_pars_from_dic({'product_type': 'dummy', 'RA': 11.1, 'DEC': 22.2})
+    assert instrument.get_par_by_name('RA').value == 11.1
+    other_instrument = instrument_factory_iter.registry[0].build_instrument()
+    assert other_instrument is not instrument
+    assert other_instrument.get_par_by_name('RA').value != 11.1
+    assert other_instrument.get_par_by_name('RA') is not instrument.get_par_by_name('RA')
+
+    instrument_factory_iter.registry[0].build_instrument(use_template=False)
+    assert len(n_calls) == 2
+
+    # the factories added later are registered
+    assert list(instrument_factory_iter) == [counting_instr_factory, my_dev_instr_factory]
+    factory_list = []
+    instrument_factory_iter.extend(factory_list)
+    factory_list.append(my_instr_factory)
+    assert instrument_factory_iter.instrument_names == ['empty', 'empty-development', 'empty']
+    assert len(n_calls) == 2
+
+    # a failing factory is kept, and reported when the instruments are listed
+    factory_list.append(failing_instr_factory)
+    assert list(instrument_factory_iter) == [counting_instr_factory, my_dev_instr_factory, my_instr_factory, failing_instr_factory]
+    with pytest.raises(RuntimeError, match="broken plugin"):
+        instrument_factory_iter.instrument_names
+    with pytest.raises(RuntimeError, match="broken plugin"):
+        instrument_factory_iter.accessible_instrument_names()
+    assert len(n_calls) == 2
+
+    # without preventing the plugins from being loaded
+    InstrumentFactoryIterator().extend([failing_instr_factory])
+
+
 @pytest.mark.fast
 def test_empty_request(dispatcher_live_fixture):
     server = dispatcher_live_fixture
@@ -621,6 +687,192 @@ def test_head_download_products_public(dispatcher_long_living_fixture, empty_pro
     assert int(c.headers['Content-Length']) == size
 
 
+@pytest.mark.fast
+def test_head_download_products_no_download_cache(dispatcher_live_fixture_no_download_cache, empty_products_files_fixture):
+    server = dispatcher_live_fixture_no_download_cache
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz',
+        'download_file_name': 'output_test',
+        'session_id': session_id,
+        'job_id': job_id
+    }
+
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+    assert 'Content-Length' not in c.headers
+
+    # the archive is built in a temporary file, to tell its size
+    c_head = requests.head(server + "/download_products", params=params)
+    assert c_head.status_code == 200
+    assert int(c_head.headers['Content-Length']) == len(c.content)
+    assert c_head.headers['ETag'] == c.headers['ETag']
+
+
+@pytest.mark.fast
+def test_download_products_archive(dispatcher_long_living_fixture, empty_products_files_fixture):
+    server = dispatcher_long_living_fixture
+    DispatcherJobState.remove_download_folders()
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz,analysis_parameters.json',
+        'download_file_name': 'output_test.tar.gz',
+        'session_id': session_id,
+        'job_id': job_id
+    }
+
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+
+    with tarfile.open(fileobj=io.BytesIO(c.content), mode='r:gz') as tar:
+        assert sorted(tar.getnames()) == ['output_test/analysis_parameters.json', 'output_test/test.fits.gz']
+        assert tar.extractfile('output_test/test.fits.gz').read() == empty_products_files_fixture['content']
+
+    archive_key = DownloadCache.archive_key(
+        job_id,
+        [os.path.realpath(f'scratch_sid_{session_id}_jid_{job_id}/{file_name}') for file_name in params['file_list'].split(',')],
+        params['download_file_name'],
+        True)
+    cached_archive_path = os.path.join('.download_cache', archive_key)
+    assert os.path.exists(cached_archive_path)
+    assert os.path.getsize(cached_archive_path) == len(c.content)
+
+    # served from the cache
+    c_head = requests.head(server + "/download_products", params=params)
+    assert c_head.status_code == 200
+    assert int(c_head.headers['Content-Length']) == len(c.content)
+
+    c_cached = requests.get(server + "/download_products", params=params)
+    assert c_cached.content == open(cached_archive_path, 'rb').read()
+
+    # no temporary download folders
+    assert glob.glob('download_*') == []
+
+
+@pytest.mark.fast
+@pytest.mark.parametrize('return_archive', [True, False])
+def test_download_products_range(dispatcher_long_living_fixture, empty_products_files_fixture, return_archive):
+    server = dispatcher_long_living_fixture
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz',
+        'download_file_name': 'output_test',
+        'return_archive': return_archive,
+        'session_id': session_id,
+        'job_id': job_id
+    }
+
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+    etag = c.headers['ETag']
+    full_content = c.content
+
+    c = requests.get(server + "/download_products", params=params, headers={'Range': 'bytes=5-'})
+    assert c.status_code == 206
+    assert c.headers['ETag'] == etag
+    assert c.headers['Content-Range'] == f'bytes 5-{len(full_content) - 1}/{len(full_content)}'
+    assert c.content == full_content[5:]
+
+    c = requests.get(server + "/download_products", params=params, headers={'Range': 'bytes=0-3', 'If-Range': etag})
+    assert c.status_code == 206
+    assert c.content == full_content[:4]
+
+    # the content changed since the first part was downloaded
+    c = requests.get(server + "/download_products", params=params, headers={'Range': 'bytes=0-3', 'If-Range': '"outdated"'})
+    assert c.status_code == 200
+    assert c.content == full_content
+
+
+@pytest.mark.fast
+def test_download_products_range_no_download_cache(dispatcher_live_fixture_no_download_cache, empty_products_files_fixture):
+    server = dispatcher_live_fixture_no_download_cache
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz,analysis_parameters.json',
+        'download_file_name': 'output_test.tar.gz',
+        'session_id': session_id,
+        'job_id': job_id
+    }
+
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+    etag = c.headers['ETag']
+    full_content = c.content
+
+    # the archive is built again, reproducibly, in a temporary file to send the range
+    c = requests.get(server + "/download_products", params=params, headers={'Range': 'bytes=5-', 'If-Range': etag})
+    assert c.status_code == 206
+    assert c.headers['ETag'] == etag
+    assert c.headers['Content-Range'] == f'bytes 5-{len(full_content) - 1}/{len(full_content)}'
+    assert c.content == full_content[5:]
+
+
+@pytest.mark.fast
+def test_download_file_range(dispatcher_long_living_fixture, request_files_fixture):
+    server = dispatcher_long_living_fixture
+
+    params = {
+        'file_list': os.path.basename(request_files_fixture['file_path']),
+        'download_file_name': 'output_test',
+        'return_archive': False,
+    }
+
+    c = requests.get(server + "/download_file", params=params, headers={'Range': 'bytes=10-'})
+    assert c.status_code == 206
+    assert c.headers['ETag'] == f'"{request_files_fixture["file_hash"]}"'
+    assert c.content == request_files_fixture['content'][10:]
+
+
+def test_download_cache_eviction(tmpdir):
+    download_cache = DownloadCache(str(tmpdir), max_size_bytes=25)
+
+    for i, key in enumerate(['a', 'b', 'c']):
+        assert download_cache.get(key) is None
+        assert list(download_cache.store_stream(key, iter([b'0' * 5, b'1' * 5]))) == [b'0' * 5, b'1' * 5]
+        os.utime(download_cache.archive_path(key), (i, i))
+
+    # the archives can be read by the other users, as the files created by open
+    assert stat.S_IMODE(os.stat(download_cache.archive_path('c')).st_mode) == 0o666 & ~process_umask
+
+    # least recently used archive evicted
+    assert download_cache.get('a') is None
+    assert download_cache.get('b') is not None
+    assert download_cache.get('c') is not None
+
+    # a hit does not modify the archive
+    assert os.path.getmtime(download_cache.archive_path('b')) == 1
+
+    # the last use is the access time
+    os.utime(download_cache.archive_path('b'), (time.time(), 1))
+    list(download_cache.store_stream('e', iter([b'0' * 5, b'1' * 5])))
+    assert download_cache.get('b') is not None
+    assert download_cache.get('c') is None
+    os.remove(download_cache.archive_path('e'))
+
+    # interrupted stream not stored
+    stream = download_cache.store_stream('d', iter([b'0' * 5, b'1' * 5]))
+    next(stream)
+    stream.close()
+    assert download_cache.get('d') is None
+    assert sorted(os.listdir(tmpdir)) == ['b']
+
+
 @pytest.mark.fast
 def test_download_products_aliased_dir(dispatcher_live_fixture):
     DispatcherJobState.remove_scratch_folders()
@@ -1999,6 +2251,35 @@ def test_public_file_ownerships(dispatcher_live_fixture):
     assert ownerships['user_roles'] == []
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize("seekable", [True, False])
+def test_upload_file_by_hash(tmpdir, seekable):
+    from werkzeug.datastructures import FileStorage
+    from cdci_data_analysis.analysis.io_helper import upload_file_by_hash
+
+    class NonSeekableStream(io.BytesIO):
+        def seekable(self):
+            return False
+
+    content = os.urandom(3 * 1024 + 17)
+    stream_class = io.BytesIO if seekable else NonSeekableStream
+
+    file_hash = upload_file_by_hash(FileStorage(stream_class(content), filename='test.fits'), str(tmpdir), chunk_size=1024)
+    assert file_hash == make_hash_file(os.path.join(tmpdir, file_hash))
+    with open(os.path.join(tmpdir, file_hash), 'rb') as f:
+        assert f.read() == content
+
+    # the same content is stored only once
+    upload_mtime = os.stat(os.path.join(tmpdir, file_hash)).st_mtime_ns
+    assert upload_file_by_hash(FileStorage(stream_class(content), filename='other.fits'), str(tmpdir)) == file_hash
+    assert os.stat(os.path.join(tmpdir, file_hash)).st_mtime_ns == upload_mtime
+    assert os.listdir(tmpdir) == [file_hash]
+
+    sha256_hash = upload_file_by_hash(FileStorage(stream_class(content), filename='test.fits'), str(tmpdir), hash_algorithm='sha256')
+    assert sha256_hash == make_hash_file(os.path.join(tmpdir, sha256_hash), hash_algorithm='sha256')
+    assert len(sha256_hash) == 64
+
+
 @pytest.mark.parametrize("include_file_arg", [True, False])
 def test_default_value_empty_posix_path(dispatcher_live_fixture, include_file_arg):
     DispatcherJobState.remove_scratch_folders()
@@ -4666,6 +4947,43 @@ def test_parameter_bounds_metadata(dispatcher_live_fixture):
     assert meta_for_par('bounded_float_par')['restrictions'] == {'is_optional': False, 'min_value': 2.2, 'max_value': 7.7}
     assert meta_for_par('string_select_par')['restrictions'] == {'is_optional': False, 'allowed_values': ['spam', 'eggs', 'ham']}
     
+@pytest.mark.fast
+@pytest.mark.parametrize("endpoint", ['meta-data', 'api/meta-data', 'api/par-names'])
+def test_meta_data_cache(safe_dummy_plugin_conf, dispatcher_live_fixture, endpoint):
+    server = dispatcher_live_fixture
+
+    params = {'instrument': 'empty', 'product_type': 'dummy'}
+    c = requests.get(os.path.join(server, endpoint), params=params)
+    assert c.status_code == 200
+    etag = c.headers['ETag']
+    assert 'no-cache' in c.headers['Cache-Control']
+    assert 'public' in c.headers['Cache-Control']
+
+    c_cached = requests.get(os.path.join(server, endpoint), params=params)
+    assert c_cached.status_code == 200
+    assert c_cached.headers['ETag'] == etag
+    assert c_cached.json() == c.json()
+
+    c_revalidated = requests.get(os.path.join(server, endpoint), params=params, headers={'If-None-Match': etag})
+    assert c_revalidated.status_code == 304
+    assert c_revalidated.content == b''
+
+    # the response for a user depends on their roles
+    encoded_token = jwt.encode(default_token_payload, secret_key, algorithm='HS256')
+    c_token = requests.get(os.path.join(server, endpoint), params={**params, 'token': encoded_token})
+    assert c_token.status_code == 200
+    assert 'private' in c_token.headers['Cache-Control']
+
+    with open(safe_dummy_plugin_conf, 'w') as fd:
+        fd.write('instruments: []\n')
+
+    c = requests.get(server + "/reload-plugin/dummy_plugin")
+    assert c.status_code == 200
+
+    c = requests.get(os.path.join(server, endpoint), params=params, headers={'If-None-Match': etag})
+    assert c.status_code == 400
+
+
 @pytest.mark.fast
 def test_restricted_parameters_good_request(dispatcher_live_fixture):
     server = dispatcher_live_fixture   
@@ -0,0 +1,193 @@
+import types
+import smtplib
+
+import pytest
+
+from cdci_data_analysis.analysis import smtp_pool, email_helper
+from cdci_data_analysis.analysis.smtp_pool import SMTPConnectionPool, get_smtp_connection_pool, get_tls_context
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    state = types.SimpleNamespace(connections=[], sent=[], fail_next_sendmail=[])
+
+    class FakeSMTP:
+        def __init__(self, host, port):
+            self.host = host
+            self.port = port
+            self.tls_context = None
+            self.logged_in_as = None
+            self.alive = True
+            self.n_noop = 0
+            self.closed = False
+            state.connections.append(self)
+
+        def starttls(self, context=None):
+            self.tls_context = context
+
+        def login(self, user, password):
+            self.logged_in_as = user
+
+        def noop(self):
+            self.n_noop += 1
+            if not self.alive:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            return 250, b'OK'
+
+        def sendmail(self, sender, receivers, message):
+            if state.fail_next_sendmail:
+                raise state.fail_next_sendmail.pop(0)
+            state.sent.append(dict(connection=self, sender=sender, receivers=receivers))
+
+        def quit(self):
+            self.closed = True
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(smtp_pool.smtplib, 'SMTP', FakeSMTP)
+    monkeypatch.setattr(email_helper, 'email_sending_retry_sleep_s', 0)
+    return state
+
+
+def send(connection_pool, subject='test'):
+    return email_helper.send_email('smtp.odahub.io',
+                                   587,
+                                   'team@odahub.io',
+                                   None,
+                                   None,
+                                   'mtm@mtmco.net',
+                                   'contact@odahub.io',
+                                   subject,
+                                   'text',
+                                   '<html></html>',
+                                   'password',
+                                   email_helper.email_helper_logger,
+                                   connection_pool=connection_pool)
+
+
+@pytest.mark.fast
+def test_smtp_connection_reused(fake_smtp):
+    connection_pool = SMTPConnectionPool('smtp.odahub.io', 587, 'team@odahub.io', 'password')
+
+    send(connection_pool)
+    send(connection_pool)
+
+    connection, = fake_smtp.connections
+    assert connection.logged_in_as == 'team@odahub.io'
+    assert connection.tls_context is get_tls_context()
+    assert connection.n_noop == 1
+    assert not connection.closed
+    assert len(fake_smtp.sent) == 2
+
+    connection_pool.close()
+    assert connection.closed
+
+
+@pytest.mark.fast
+def test_smtp_connection_not_pooled(fake_smtp):
+    send(None)
+    send(None)
+
+    assert len(fake_smtp.connections) == 2
+    assert all(connection.closed for connection in fake_smtp.connections)
+    # the TLS context is created once per process
+    assert fake_smtp.connections[0].tls_context is fake_smtp.connections[1].tls_context
+
+
+@pytest.mark.fast
+def test_smtp_connection_reconnect(fake_smtp):
+    connection_pool = SMTPConnectionPool('smtp.odahub.io', 587, 'team@odahub.io', 'password')
+
+    send(connection_pool)
+    # closed by the server while idle
+    fake_smtp.connections[0].alive = False
+    send(connection_pool)
+
+    assert len(fake_smtp.connections) == 2
+    assert fake_smtp.connections[0].closed
+    assert fake_smtp.sent[-1]['connection'] is fake_smtp.connections[1]
+
+    # failing while sending
+    fake_smtp.fail_next_sendmail.append(smtplib.SMTPServerDisconnected("Connection unexpectedly closed"))
+    send(connection_pool)
+
+    assert len(fake_smtp.connections) == 3
+    assert fake_smtp.connections[1].closed
+    assert fake_smtp.sent[-1]['connection'] is fake_smtp.connections[2]
+    assert len(fake_smtp.sent) == 3
+
+
+@pytest.mark.fast
+def test_smtp_connection_max_idle_time(fake_smtp):
+    connection_pool = SMTPConnectionPool('smtp.odahub.io', 587, 'team@odahub.io', 'password', max_idle_time_s=-1)
+
+    send(connection_pool)
+    send(connection_pool)
+
+    assert len(fake_smtp.connections) == 2
+    assert fake_smtp.connections[0].closed
+    assert fake_smtp.connections[0].n_noop == 0
+
+
+@pytest.mark.fast
+def test_smtp_concurrent_sessions(fake_smtp):
+    connection_pool = SMTPConnectionPool('smtp.odahub.io', 587, 'team@odahub.io', None, max_idle_connections=1)
+
+    with connection_pool.session() as server_1, connection_pool.session() as server_2:
+        assert server_1 is not server_2
+        server_1.sendmail('team@odahub.io', ['mtm@mtmco.net'], 'message')
+        server_2.sendmail('team@odahub.io', ['team@odahub.io'], 'message')
+
+    assert len(fake_smtp.sent) == 2
+    assert server_1.logged_in_as is None
+    # only one of the two connections is kept
+    assert [connection.closed for connection in fake_smtp.connections].count(True) == 1
+
+
+@pytest.mark.fast
+def test_smtp_session_batch(fake_smtp):
+    connection_pool = SMTPConnectionPool('smtp.odahub.io', 587, 'team@odahub.io', 'password', max_idle_connections=1)
+
+    with connection_pool.batch():
+        for subject in ['first', 'second', 'third']:
+            send(connection_pool, subject=subject)
+
+    connection, = fake_smtp.connections
+    assert len(fake_smtp.sent) == 3
+    # held for the whole batch, not checked between the emails
+    assert connection.n_noop == 0
+    assert not connection.closed
+
+    # a connection failing within a batch is replaced for the following emails
+    fake_smtp.fail_next_sendmail.append(smtplib.SMTPServerDisconnected("Connection unexpectedly closed"))
+    with connection_pool.batch():
+        send(connection_pool)
+        send(connection_pool)
+
+    assert connection.closed
+    assert len(fake_smtp.connections) == 2
+    assert [sent['connection'] for sent in fake_smtp.sent[3:]] == [fake_smtp.connections[1]] * 2
+    assert connection.n_noop == 1
+
+    # returned to the pool at the end of the batch
+    send(connection_pool)
+    assert len(fake_smtp.connections) == 2
+
+
+@pytest.mark.fast
+def test_get_smtp_connection_pool():
+    config = types.SimpleNamespace(smtp_server='smtp.odahub.io',
+                                   smtp_port=587,
+                                   sender_email_address='team@odahub.io',
+                                   smtp_server_password='password',
+                                   smtp_connection_pool_size=2,
+                                   smtp_connection_max_idle_s=60)
+
+    connection_pool = get_smtp_connection_pool(config)
+    assert get_smtp_connection_pool(config) is connection_pool
+    assert connection_pool.max_idle_connections == 2
+
+    incident_report_connection_pool = get_smtp_connection_pool(config, 'postmaster@in.odahub.io')
+    assert incident_report_connection_pool is not connection_pool
+    assert incident_report_connection_pool.sender_email_address == 'postmaster@in.odahub.io'
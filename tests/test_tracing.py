@@ -0,0 +1,82 @@
+import types
+
+import flask
+import pytest
+import requests
+
+from cdci_data_analysis.flask_app import tracing
+from cdci_data_analysis.flask_app.tracing import span
+from cdci_data_analysis.flask_app.metrics import MetricsRegistry
+
+
+@pytest.mark.fast
+def test_spans(monkeypatch):
+    registry = MetricsRegistry(buckets=(0.1, 1))
+    monkeypatch.setattr(tracing, 'metrics', registry)
+
+    @span('decorated')
+    def decorated():
+        pass
+
+    with flask.Flask(__name__).app_context():
+        with span('block'):
+            decorated()
+        decorated()
+
+        assert [name for name, _ in tracing.request_spans()] == ['decorated', 'block', 'decorated']
+        header = tracing.server_timing_header(tracing.request_spans(), total_s=0.25)
+        assert header.startswith('decorated;dur=0.0, block;dur=')
+        assert header.endswith(', total;dur=250.0')
+
+    # outside of a request the durations are only added to the histograms
+    decorated()
+    assert tracing.request_spans() == []
+
+    rendered = registry.render()
+    assert 'dispatcher_span_duration_seconds_bucket{span="decorated",le="0.1"} 3' in rendered
+    assert 'dispatcher_span_duration_seconds_bucket{span="decorated",le="+Inf"} 3' in rendered
+    assert 'dispatcher_span_duration_seconds_count{span="block"} 1' in rendered
+
+
+@pytest.mark.fast
+def test_opentelemetry_spans(monkeypatch):
+    pytest.importorskip('opentelemetry.sdk')
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, 'otel_trace', types.SimpleNamespace(get_tracer=tracer_provider.get_tracer))
+    monkeypatch.setattr(tracing, '_opentelemetry_spans', False)
+
+    tracing.configure(opentelemetry_spans=True)
+    with span('request'):
+        with span('set_args'):
+            pass
+
+    set_args, request = exporter.get_finished_spans()
+    assert (set_args.name, request.name) == ('set_args', 'request')
+    assert set_args.parent.span_id == request.context.span_id
+
+
+def test_server_timing(dispatcher_live_fixture):
+    server = dispatcher_live_fixture
+
+    c = requests.get(server + "/run_analysis",
+                     params=dict(query_status="new",
+                                 query_type="Dummy",
+                                 instrument="empty",
+                                 product_type="dummy"))
+    assert c.status_code == 200
+
+    span_names = [entry.split(';')[0] for entry in c.headers['Server-Timing'].split(', ')]
+    for span_name in ['set_args', 'set_instrument', 'set_scratch_dir', 'set_scratch_dir.lock', 'move_temp_content',
+                      'query.test_communication', 'query.get_query_products', 'total']:
+        assert span_name in span_names
+
+    c = requests.get(server + "/metrics")
+    assert c.status_code == 200
+    assert c.headers['Content-Type'].startswith('text/plain')
+    assert 'dispatcher_span_duration_seconds_count{span="set_args"}' in c.text